@@ -0,0 +1,397 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from json import dumps
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+
+from click import group, option, pass_context, secho
+
+
+def report(name, calls, seconds):
+    # type: (str, int, float) -> None
+    """Prints the result of a single benchmark run."""
+
+    secho(
+        "{0:<40} {1:>10.2f} us/call".format(name, seconds / calls * 1e6),
+        fg="green",
+    )
+
+
+def timed(fn, calls):
+    # type: (object, int) -> float
+    """Calls `fn` with the call index `calls` times, returns the seconds."""
+
+    start = default_timer()
+    for i in range(calls):
+        fn(i)  # type: ignore
+    return default_timer() - start
+
+
+@group(invoke_without_command=True)
+@pass_context
+def cli(ctx):
+    """Cakebot micro-benchmarks, runs all of them if none are picked."""
+
+    if ctx.invoked_subcommand is None:
+        for command in cli.commands.values():
+            ctx.invoke(command)
+
+
+@cli.command("cookie-store")
+@option("--users", type=int, default=10000, help="Users to seed.")
+@option("--calls", type=int, default=200, help="Operations to time.")
+def cookie_store(users=10000, calls=200):
+    """Compares the JSON, SQLite and journal cookie stores."""
+
+    from filehandlers import AbstractFile, FileManipulator
+
+    from cakebot import Database
+
+    seed = {str(100000 + i): {"cookie_count": i} for i in range(users)}
+
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "config.json")
+        with open(path, "w") as f:
+            f.write(dumps({"tokens": {}, "users": seed}))
+
+        json_store = Database.JsonStore(FileManipulator(AbstractFile(path)))
+        sqlite_store = Database.SqliteStore(os.path.join(tmp, "cakebot.db"))
+        sqlite_store.migrate(seed)
+        journal_store = Database.JournalStore(
+            os.path.join(tmp, "cakebot.journal")
+        )
+        journal_store.migrate(seed)
+
+        secho(f"\ncookie store ({users} users)", bold=True)
+        for name, engine in (
+            ("json", json_store),
+            ("sqlite", sqlite_store),
+            ("journal", journal_store),
+        ):
+            report(
+                name + " add_cookie",
+                calls,
+                timed(lambda i: engine.add_cookie(100000 + i), calls),
+            )
+            report(
+                name + " get_count",
+                calls,
+                timed(lambda i: engine.get_count(100000 + i), calls),
+            )
+
+        sqlite_store.close()
+        journal_store.close()
+
+
+@cli.command("content")
+@option("--calls", type=int, default=20000, help="Lines to pick.")
+def content(calls=20000):
+    """Compares reading a content file per call with the registry."""
+
+    from random import choice
+
+    from cakebot.Content import ContentRegistry
+
+    def per_call_read(i):
+        # type: (int) -> str
+        fileobj = open("content/jokes.txt", mode="r")
+        lines = fileobj.readlines()
+        fileobj.close()
+        return choice(lines)
+
+    registry = ContentRegistry()
+    registry.load_all()
+    mapped = ContentRegistry(mmap_threshold=0)
+    mapped.load_all()
+
+    secho("\ncontent (jokes.txt)", bold=True)
+    report("per-call read", calls, timed(per_call_read, calls))
+    report("registry", calls, timed(lambda i: registry.pick("jokes"), calls))
+    report(
+        "registry (mmap)", calls, timed(lambda i: mapped.pick("jokes"), calls)
+    )
+
+
+@cli.command("embeds")
+@option("--calls", type=int, default=20000, help="Embeds to build.")
+def embeds(calls=20000):
+    """Compares building embeds from scratch with the templates."""
+
+    from random import choice
+
+    from discord import Color, Embed, Permissions
+    from discord.utils import oauth_url
+
+    from cakebot import EmbedUtil
+
+    def old_prep(title, description):
+        # type: (str, str) -> Embed
+        # how EmbedUtil.prep worked before the colour palette was cached
+        embed = Embed(
+            title=title,
+            description=description,
+            color=choice(
+                [
+                    Color.teal(),
+                    Color.dark_teal(),
+                    Color.green(),
+                    Color.dark_green(),
+                    Color.blue(),
+                    Color.dark_blue(),
+                    Color.purple(),
+                    Color.dark_purple(),
+                    Color.magenta(),
+                    Color.dark_magenta(),
+                    Color.gold(),
+                    Color.dark_gold(),
+                    Color.orange(),
+                    Color.dark_orange(),
+                    Color.red(),
+                    Color.dark_red(),
+                    Color.lighter_grey(),
+                    Color.darker_grey(),
+                    Color.blurple(),
+                    Color(0xBEAA3E),
+                    Color(0xB18F6A),
+                    Color(0x9B1B30),
+                ]
+            ),
+        )
+        embed.set_footer(text=EmbedUtil.FOOTER)
+        embed.set_author(**EmbedUtil.AUTHOR)
+        return embed
+
+    def invite(prep):
+        # type: (object) -> Embed
+        return prep(  # type: ignore
+            "Invite Cakebot",
+            f"[Click here to invite me!]({oauth_url(580573141898887199, permissions=Permissions.all())})",
+        )
+
+    secho("\nembeds", bold=True)
+    report(
+        "prep (rebuilt palette)",
+        calls,
+        timed(lambda i: old_prep("a", "b"), calls),
+    )
+    report(
+        "prep (cached palette)",
+        calls,
+        timed(lambda i: EmbedUtil.prep("a", "b"), calls),
+    )
+    report(
+        "invite (rebuilt)", calls, timed(lambda i: invite(old_prep), calls)
+    )
+    report(
+        "invite (static copy)",
+        calls,
+        timed(
+            lambda i: EmbedUtil.static(
+                "invite", lambda: invite(EmbedUtil.prep)
+            ),
+            calls,
+        ),
+    )
+
+
+@cli.command("decks")
+@option("--calls", type=int, default=20000, help="Lines to draw.")
+@option("--guilds", type=int, default=100, help="Guilds to spread over.")
+def decks(calls=20000, guilds=100):
+    """Compares random picks with drawing from per-guild decks."""
+
+    from random import choice
+    from sys import getsizeof
+
+    from cakebot.Content import ContentRegistry
+    from cakebot.Decks import Decks, Pool
+
+    registry = ContentRegistry()
+    registry.load_all()
+    strings = ["Fact number {0} about cake.".format(i) for i in range(5000)]
+    pool = Pool(strings)
+
+    secho("\ndecks", bold=True)
+    report("choice (list)", calls, timed(lambda i: choice(strings), calls))
+    for name, lines in (
+        ("facts", pool),
+        ("jokes", registry.get("jokes")),
+        ("8ball", registry.get("8ball")),
+    ):
+        engine = Decks()
+        report(
+            "deck ({0})".format(name),
+            calls,
+            timed(lambda i: engine.draw(i % guilds, lines), calls),
+        )
+    secho(
+        "  pool of {0} facts: {1} bytes, list: {2} bytes".format(
+            len(pool),
+            len(pool.data) + pool.offsets.itemsize * len(pool.offsets),
+            getsizeof(strings) + sum(getsizeof(item) for item in strings),
+        )
+    )
+
+
+def rss():
+    # type: () -> int
+    """This process's resident set size in bytes (Linux only)."""
+
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def guild_rss(low_memory, guilds, members, messages):
+    # type: (bool, int, int, int) -> None
+    """
+    Feeds a client simulated guilds and prints how much its RSS grew.
+
+    Run in a fresh interpreter by the memory benchmark, so the two modes
+    don't share freed memory.
+    """
+
+    import gc
+
+    import discord
+
+    from cakebot.LowMemory import client_options
+
+    if low_memory:
+        options = client_options(low_memory=True)
+    else:
+        # what a big bot with the members intent caches
+        intents = discord.Intents.default()
+        intents.members = True
+        options = {
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags.from_intents(
+                intents
+            ),
+        }
+    client = discord.Client(**options)
+    state = client._connection
+
+    def user(i):
+        # type: (int) -> dict
+        return {
+            "id": str(i),
+            "username": "user" + str(i),
+            "discriminator": "0001",
+            "avatar": None,
+        }
+
+    gc.collect()
+    before = rss()
+    for guild in range(1, guilds + 1):
+        guild_id = guild << 32
+        state._add_guild_from_data(
+            {
+                "id": str(guild_id),
+                "name": "Guild {0}".format(guild),
+                "owner_id": str(guild_id + 1),
+                "member_count": members,
+                "large": members > 250,
+                "roles": [
+                    {"id": str(guild_id), "name": "@everyone", "position": 0}
+                ],
+                "channels": [
+                    {
+                        "id": str(guild_id + channel),
+                        "type": 0,
+                        "name": "channel-{0}".format(channel),
+                        "position": channel,
+                        "permission_overwrites": [],
+                    }
+                    for channel in range(5)
+                ],
+                "members": [
+                    {
+                        "user": user(guild_id + member + 1),
+                        "roles": [],
+                        "joined_at": "2020-01-01T00:00:00+00:00",
+                        "deaf": False,
+                        "mute": False,
+                        "flags": 0,
+                    }
+                    for member in range(members)
+                ],
+            }
+        )
+        for message in range(messages):
+            state.parse_message_create(
+                {
+                    "id": str(guild_id + message),
+                    "channel_id": str(guild_id),
+                    "guild_id": str(guild_id),
+                    "author": user(guild_id + message % members + 1),
+                    "content": "+cookie give someone a cookie",
+                    "timestamp": "2020-01-01T00:00:00+00:00",
+                    "edited_timestamp": None,
+                    "tts": False,
+                    "mention_everyone": False,
+                    "mentions": [],
+                    "mention_roles": [],
+                    "attachments": [],
+                    "embeds": [],
+                    "pinned": False,
+                    "type": 0,
+                }
+            )
+    gc.collect()
+    print(rss() - before, len(client.guilds), len(client.cached_messages))
+
+
+@cli.command("memory")
+@option("--guilds", type=int, default=1000, help="Guilds to simulate.")
+@option("--members", type=int, default=250, help="Members per guild.")
+@option("--messages", type=int, default=20, help="Messages per guild.")
+def memory(guilds=1000, members=250, messages=20):
+    """Compares the RSS of the member cache with low memory mode."""
+
+    from subprocess import check_output
+    from sys import executable
+
+    secho("\nmemory ({0} guilds)".format(guilds), bold=True)
+    for name, low_memory in (
+        ("member cache", False),
+        ("low memory", True),
+    ):
+        grown, cached_guilds, cached_messages = check_output(
+            [
+                executable,
+                "-c",
+                "import benchmarks; benchmarks.guild_rss({0}, {1}, {2}, {3})".format(
+                    low_memory, guilds, members, messages
+                ),
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).split()
+        secho(
+            "{0:<40} {1:>10.2f} MiB/1000 guilds ({2} messages cached)".format(
+                name,
+                int(grown) / 1024 ** 2 * 1000 / int(cached_guilds),
+                int(cached_messages),
+            ),
+            fg="green",
+        )
+
+
+if __name__ == "__main__":
+    cli()
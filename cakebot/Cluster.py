@@ -0,0 +1,325 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from asyncio import sleep
+from signal import SIGTERM, signal
+from sqlite3 import connect
+from subprocess import Popen
+from sys import exit as _exit
+from time import monotonic
+from time import sleep as thread_sleep
+from time import time
+from typing import Any
+
+from click import secho
+
+from .Database import JournalStore, SqliteStore
+
+GATEWAY_URL = "https://discord.com/api/v7/gateway/bot"
+
+
+def shard_ranges(shard_count, workers):
+    # type: (int, int) -> list
+    """Splits the shard IDs into `workers` contiguous, even-ish ranges."""
+
+    workers = max(1, min(workers, shard_count))
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for worker in range(workers):
+        end = start + size + (1 if worker < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def describe(shard_ids):
+    # type: (list) -> str
+    if len(shard_ids) == 1:
+        return str(shard_ids[0])
+    return "{0}-{1}".format(shard_ids[0], shard_ids[-1])
+
+
+def shared_store(conf, path):
+    # type: (Any, str) -> dict
+    """
+    The cookie store config for worker processes.
+
+    Workers can't share the in-memory journal store, so unless the config
+    already uses SQLite, they use the SQLite database at `path`.
+    """
+
+    if isinstance(conf, str):
+        return {"engine": "sqlite", "path": conf}
+    if conf.get("engine", "journal") == "sqlite":
+        return conf
+    return {"engine": "sqlite", "path": path}
+
+
+def copy_journal(conf, path):
+    # type: (Any, str) -> bool
+    """
+    Copies a journal store into the workers' database, the first time.
+
+    Returns if it did anything.
+    """
+
+    if isinstance(conf, str) or conf.get("engine", "journal") == "sqlite":
+        return False
+
+    journal_path = conf.get("path", "cakebot.journal")
+    if not os.path.exists(journal_path) and not os.path.exists(
+        journal_path + ".snapshot"
+    ):
+        return False
+
+    journal = JournalStore(journal_path)
+    store = SqliteStore(path)
+    try:
+        return store.migrate(journal.users)
+    finally:
+        journal.close()
+        store.close()
+
+
+async def recommended_shards(http, token):
+    # type: (Any, str) -> int
+    """Asks Discord how many shards the bot should use."""
+
+    resp = await http.get(
+        GATEWAY_URL, headers={"Authorization": "Bot " + token}
+    )
+    if resp.status != 200:
+        raise RuntimeError(
+            "Discord said {0} when asked for the shard count.".format(
+                resp.status
+            )
+        )
+    return int(resp.data["shards"])
+
+
+class StatusBoard:
+    """
+    Where workers post their status, in a SQLite database they share.
+
+    It's also how a `+reboot` on one worker reaches all of them.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        self.connection = connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            "worker INTEGER PRIMARY KEY, pid INTEGER, shards TEXT, "
+            "latency REAL, guilds INTEGER, updated REAL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS reboots (issued REAL NOT NULL)"
+        )
+
+    def reset(self):
+        # type: () -> None
+        """Forgets everything, for a fresh cluster."""
+
+        self.connection.execute("DELETE FROM workers")
+        self.connection.execute("DELETE FROM reboots")
+
+    def report(self, worker, shard_ids, latency, guilds):
+        # type: (int, list, float, int) -> None
+        self.connection.execute(
+            "INSERT OR REPLACE INTO workers "
+            "(worker, pid, shards, latency, guilds, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                worker,
+                os.getpid(),
+                describe(shard_ids),
+                latency,
+                guilds,
+                time(),
+            ),
+        )
+
+    def workers(self):
+        # type: () -> list
+        """Every worker's (worker, shards, latency, guilds, age)."""
+
+        now = time()
+        return [
+            (worker, shards, latency, guilds, now - updated)
+            for worker, shards, latency, guilds, updated in self.connection.execute(
+                "SELECT worker, shards, latency, guilds, updated "
+                "FROM workers ORDER BY worker"
+            )
+        ]
+
+    def request_reboot(self):
+        # type: () -> None
+        self.connection.execute("INSERT INTO reboots VALUES (?)", (time(),))
+
+    def reboot_requested(self, since):
+        # type: (float) -> bool
+        """If any worker asked for a reboot after `since`."""
+
+        row = self.connection.execute(
+            "SELECT MAX(issued) FROM reboots"
+        ).fetchone()
+        return row[0] is not None and row[0] > since
+
+    def close(self):
+        # type: () -> None
+        self.connection.close()
+
+
+async def publish_status(board, worker, client, interval=5):
+    # type: (StatusBoard, int, Any, float) -> None
+    """
+    Posts this worker's status every `interval` seconds.
+
+    When another worker asks for a reboot, this one exits too, so the
+    supervisor restarts the whole cluster.
+    """
+
+    started = time()
+    while True:
+        latency = client.latency
+        board.report(
+            worker,
+            client.shard_ids,
+            0.0 if latency != latency else latency,
+            len(client.guilds),
+        )
+        if board.reboot_requested(started):
+            _exit(1)
+        await sleep(interval)
+
+
+class Supervisor:
+    """
+    Runs the worker processes, restarting any that exit.
+
+    A worker that keeps crashing is restarted with exponential backoff,
+    which resets once it has stayed up for `stable_after` seconds.
+    """
+
+    def __init__(
+        self,
+        command,
+        shard_count,
+        workers,
+        backoff=1,
+        max_backoff=60,
+        stable_after=60,
+    ):
+        # type: (list, int, int, float, float, float) -> None
+        self.command = command
+        self.shard_count = shard_count
+        self.ranges = shard_ranges(shard_count, workers)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.processes = [None] * len(self.ranges)  # type: list
+        self.started = [0.0] * len(self.ranges)
+        self.failures = [0] * len(self.ranges)
+        self.restart_at = [0.0] * len(self.ranges)
+
+    def _spawn(self, worker):
+        # type: (int) -> None
+        self.processes[worker] = Popen(
+            self.command
+            + [
+                "--worker",
+                str(worker),
+                "--shard-ids",
+                ",".join(str(shard) for shard in self.ranges[worker]),
+                "--shard-count",
+                str(self.shard_count),
+            ]
+        )
+        self.started[worker] = monotonic()
+        secho(
+            "Started worker {0} (shards {1}), pid {2}".format(
+                worker,
+                describe(self.ranges[worker]),
+                self.processes[worker].pid,
+            ),
+            fg="green",
+        )
+
+    def check(self):
+        # type: () -> None
+        """Restarts workers that have exited, once their backoff is up."""
+
+        now = monotonic()
+        for worker, process in enumerate(self.processes):
+            if process is None:
+                if now >= self.restart_at[worker]:
+                    self._spawn(worker)
+                continue
+
+            code = process.poll()
+            if code is None:
+                continue
+
+            if now - self.started[worker] >= self.stable_after:
+                self.failures[worker] = 0
+            delay = min(
+                self.max_backoff, self.backoff * 2 ** self.failures[worker]
+            )
+            self.failures[worker] += 1
+            self.restart_at[worker] = now + delay
+            self.processes[worker] = None
+            secho(
+                "Worker {0} exited with code {1}, restarting in {2:.0f}s".format(
+                    worker, code, delay
+                ),
+                fg="yellow",
+            )
+
+    def stop(self):
+        # type: () -> None
+        for process in self.processes:
+            if process is not None and process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.wait()
+
+    def run(self, interval=1):
+        # type: (float) -> None
+        """Runs until interrupted or terminated."""
+
+        signal(SIGTERM, _interrupt)
+        try:
+            while True:
+                self.check()
+                thread_sleep(interval)
+        except KeyboardInterrupt:
+            secho("\nStopping the cluster...", fg="blue")
+        finally:
+            self.stop()
+
+
+def _interrupt(signum, frame):
+    # type: (int, Any) -> None
+    raise KeyboardInterrupt()
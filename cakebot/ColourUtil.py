@@ -21,36 +21,34 @@ from random import choice
 from discord import Color
 
 
+# built once, so picking a colour is just a random index
+PALETTE = (
+    Color.teal(),
+    Color.dark_teal(),
+    Color.green(),
+    Color.dark_green(),
+    Color.blue(),
+    Color.dark_blue(),
+    Color.purple(),
+    Color.dark_purple(),
+    Color.magenta(),
+    Color.dark_magenta(),
+    Color.gold(),
+    Color.dark_gold(),
+    Color.orange(),
+    Color.dark_orange(),
+    Color.red(),
+    Color.dark_red(),
+    Color.lighter_grey(),
+    Color.darker_grey(),
+    Color.blurple(),
+    Color(0xBEAA3E),  # tan
+    Color(0xB18F6A),  # iced coffee
+    Color(0x9B1B30),  # chili pepper
+)
+
+
 def random():
     # type: () -> Color
 
-    chilipepper = Color(0x9B1B30)
-    tan = Color(0xBEAA3E)
-    icedcoffee = Color(0xB18F6A)
-
-    return choice(
-        [
-            Color.teal(),
-            Color.dark_teal(),
-            Color.green(),
-            Color.dark_green(),
-            Color.blue(),
-            Color.dark_blue(),
-            Color.purple(),
-            Color.dark_purple(),
-            Color.magenta(),
-            Color.dark_magenta(),
-            Color.gold(),
-            Color.dark_gold(),
-            Color.orange(),
-            Color.dark_orange(),
-            Color.red(),
-            Color.dark_red(),
-            Color.lighter_grey(),
-            Color.darker_grey(),
-            Color.blurple(),
-            tan,
-            icedcoffee,
-            chilipepper,
-        ]
-    )
+    return choice(PALETTE)
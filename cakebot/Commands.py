@@ -0,0 +1,188 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from functools import partial
+from time import perf_counter
+from typing import Any
+
+from . import EmbedUtil, Metrics, Preconditions, Profiler, RateLimit
+
+
+class Command:
+    """A command, and what the dispatcher needs to know about it."""
+
+    __slots__ = (
+        "name",
+        "handler",
+        "aliases",
+        "needs_args",
+        "admin_only",
+        "blocking",
+        "cost",
+    )
+
+    def __init__(
+        self,
+        name,
+        handler,
+        aliases=(),
+        needs_args=False,
+        admin_only=False,
+        blocking=False,
+        cost=1,
+    ):
+        # type: (str, Any, tuple, bool, bool, bool, float) -> None
+        self.name = name
+        self.handler = handler
+        self.aliases = tuple(aliases)
+        self.needs_args = needs_args
+        self.admin_only = admin_only
+        # does synchronous work (disk, CPU) on the event loop
+        self.blocking = blocking
+        # how many rate limit tokens running it takes
+        self.cost = cost
+
+
+class Context:
+    """What a command handler gets called with."""
+
+    __slots__ = ("message", "command", "name", "args", "send")
+
+    def __init__(self, message, command, name, args, outbox=None):
+        # type: (Any, Command, str, list, Any) -> None
+        self.message = message
+        self.command = command
+        # the name it was called by, which might be an alias
+        self.name = name
+        self.args = args
+        if outbox is None:
+            self.send = message.channel.send
+        else:
+            self.send = partial(
+                outbox.send, message.channel, origin=message.id
+            )
+
+
+class Registry:
+    """
+    Maps command names and aliases to commands.
+
+    Everything that doesn't change between messages (the prefix and the
+    admin list) is worked out once, when the registry is created.
+    """
+
+    def __init__(self, prefix, admins, limiter=None, outbox=None):
+        # type: (str, list, Any, Any) -> None
+        self.prefix = prefix
+        self.admins = frozenset(admins)
+        self.commands = {}  # type: dict
+        # a RateLimit.RateLimiter, or None to let everything through
+        self.limiter = limiter
+        # an Outbox.Outbox replies go through, or None to send directly
+        self.outbox = outbox
+
+    def add(self, command):
+        # type: (Command) -> Command
+        for name in (command.name,) + command.aliases:
+            self.commands[name] = command
+        return command
+
+    def command(self, name, **kwargs):
+        # type: (str, Any) -> Any
+        """Decorator that registers a handler as a command."""
+
+        def decorator(handler):
+            self.add(Command(name, handler, **kwargs))
+            return handler
+
+        return decorator
+
+    def parse(self, content):
+        # type: (str) -> Any
+        """Splits a message into the command name and its arguments."""
+
+        if not content.startswith(self.prefix):
+            return None
+
+        args = content[len(self.prefix) :].split()
+        if len(args) == 0:
+            return None
+        return args[0].lower(), args[1:]
+
+    async def dispatch(self, message):
+        # type: (Any) -> Any
+        """Runs the command in a message, if there is one."""
+
+        parsed = self.parse(message.content)
+        if parsed is None:
+            return None
+
+        name, args = parsed
+        command = self.commands.get(name)
+        if command is None:
+            return None
+
+        ctx = Context(message, command, name, args, self.outbox)
+
+        if self.limiter is not None:
+            guild = message.guild
+            verdict = self.limiter.check(
+                message.author.id,
+                None if guild is None else guild.id,
+                command.name,
+                command.cost,
+            )
+            if verdict != RateLimit.ALLOW:
+                Metrics.commands_total.inc(command.name, "throttled")
+                if verdict == RateLimit.NOTIFY:
+                    return await ctx.send(
+                        ":hourglass: **Slow down!** Give it a few seconds and try again."
+                    )
+                return None
+
+        if command.needs_args and Preconditions.args_are_valid(args):
+            Metrics.commands_total.inc(command.name, "bad_args")
+            return await ctx.send(
+                embed=EmbedUtil.static(
+                    "needs-args",
+                    lambda: EmbedUtil.prep(
+                        "That command expected an argument (or arguments), but you didn't give it any!",
+                        "[Read the docs?](https://cakebot.club/docs/commands/)",
+                    ),
+                )
+            )
+
+        if command.admin_only and message.author.id not in self.admins:
+            Metrics.commands_total.inc(command.name, "denied")
+            return await ctx.send(
+                ":x: **You are not authorized to run this!**"
+            )
+
+        token = Profiler.current_command.set(command.name)
+        start = perf_counter()
+        outcome = "error"
+        try:
+            result = await command.handler(ctx)
+            outcome = "ok"
+            return result
+        finally:
+            Profiler.current_command.reset(token)
+            Metrics.command_seconds.observe(
+                perf_counter() - start, command.name
+            )
+            Metrics.commands_total.inc(command.name, outcome)
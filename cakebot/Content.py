@@ -0,0 +1,152 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from array import array
+from mmap import ACCESS_READ, mmap
+from random import randrange
+from time import monotonic
+from typing import Optional
+
+
+class ContentFile:
+    """
+    The lines of one content file.
+
+    Small files are kept as a tuple of strings. Big ones are memory-mapped
+    with an array of line start offsets instead, so only the lines we
+    actually pick get decoded.
+    """
+
+    __slots__ = ("path", "mtime", "checked", "lines", "mapped", "offsets")
+
+    def __init__(self, path, mmap_threshold):
+        # type: (str, int) -> None
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.checked = monotonic()
+        self.lines = ()  # type: tuple
+        self.mapped = None  # type: Optional[mmap]
+        self.offsets = array("Q")
+
+        if os.path.getsize(path) < mmap_threshold:
+            with open(path, "r") as f:
+                self.lines = tuple(f.readlines())
+            return
+
+        with open(path, "rb") as raw:
+            mapped = mmap(raw.fileno(), 0, access=ACCESS_READ)
+        offsets = array("Q", [0])
+        position = mapped.find(b"\n")
+        while position != -1:
+            offsets.append(position + 1)
+            position = mapped.find(b"\n", position + 1)
+        if offsets[-1] != len(mapped):
+            # the last line has no trailing newline
+            offsets.append(len(mapped))
+        self.mapped = mapped
+        self.offsets = offsets
+
+    def __len__(self):
+        # type: () -> int
+        if self.mapped is None:
+            return len(self.lines)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        # type: (int) -> str
+        if self.mapped is None:
+            return self.lines[index]
+        return self.mapped[
+            self.offsets[index] : self.offsets[index + 1]
+        ].decode("utf-8")
+
+    def close(self):
+        # type: () -> None
+        if self.mapped is not None:
+            self.mapped.close()
+
+
+class ContentRegistry:
+    """
+    Keeps the text files in `content/` loaded in memory.
+
+    A file is only re-read when its modification time changes, and the
+    modification time is checked at most once every `check_interval`
+    seconds.
+    """
+
+    def __init__(
+        self, directory="content", mmap_threshold=1 << 20, check_interval=5
+    ):
+        # type: (str, int, float) -> None
+        self.directory = directory
+        self.mmap_threshold = mmap_threshold
+        self.check_interval = check_interval
+        self.files = {}  # type: dict
+
+    def load_all(self):
+        # type: () -> None
+        """Loads every text file in the content directory."""
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".txt"):
+                self.get(filename[: -len(".txt")])
+
+    def get(self, name):
+        # type: (str) -> ContentFile
+        """Gets the lines of a content file, re-reading it if it changed."""
+
+        content = self.files.get(name)
+        if content is None:
+            return self._load(name)
+
+        now = monotonic()
+        if now - content.checked >= self.check_interval:
+            content.checked = now
+            if os.stat(content.path).st_mtime != content.mtime:
+                content.close()
+                return self._load(name)
+        return content
+
+    def reload(self):
+        # type: () -> None
+        """Forgets every file and loads the content directory again."""
+
+        for content in self.files.values():
+            content.close()
+        self.files = {}
+        self.load_all()
+
+    def _load(self, name):
+        # type: (str) -> ContentFile
+        content = ContentFile(
+            os.path.join(self.directory, name + ".txt"), self.mmap_threshold
+        )
+        self.files[name] = content
+        return content
+
+    def pick(self, name):
+        # type: (str) -> str
+        """Picks a random line from a content file."""
+
+        content = self.get(name)
+        return content[randrange(len(content))]
+
+
+registry = ContentRegistry()
@@ -16,37 +16,587 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from json import dumps
+import os
+from asyncio import get_event_loop, sleep
+from json import dump, dumps, load, loads
+from sqlite3 import connect
+from threading import Lock
 from typing import Any
 
+from .Leaderboard import Leaderboard
 
-def add_cookie(id, file_man):
-    # type: (int, Any) -> int
+# the `ranks` table's key for the global leaderboard, no guild has ID 0
+EVERYONE = 0
+# the biggest cookie count the `ranks` table can hold
+MAX_COUNT = 2**32
+
+
+def _path(count):
+    # type: (int) -> list
+    """The Fenwick tree nodes that count users with `count` cookies."""
+
+    nodes = []
+    while count <= MAX_COUNT:
+        nodes.append(count)
+        count += count & -count
+    return nodes
+
+
+def _prefix(count):
+    # type: (int) -> list
+    """The nodes that add up to how many users have `count` or fewer."""
+
+    nodes = []
+    while count > 0:
+        nodes.append(count)
+        count -= count & -count
+    return nodes
+
+
+class JsonStore:
+    """The original cookie store, which keeps users in the config file."""
+
+    def __init__(self, file_man):
+        # type: (Any) -> None
+        self.file_man = file_man
+
+    def add_cookie(self, id, guild_id=None):
+        # type: (int, Any) -> int
+        u = None
+        tmp = self.file_man.load_from_json()
+        for user in tmp["users"]:
+            if user == id:
+                u = user
+
+        if u is None:
+            tmp["users"][id] = {"cookie_count": 1}
+            self.file_man.write_to_file(dumps(tmp))
+            self.file_man.refresh()
+            return 1
+
+        tmp["users"][id]["cookie_count"] += 1
+        self.file_man.write_to_file(dumps(tmp))
+        self.file_man.refresh()
+        return self.file_man.load_from_json()["users"][id]["cookie_count"]
+
+    def get_count(self, id):
+        # type: (int) -> int
+        return self.file_man.load_from_json()["users"].get(
+            id, {"cookie_count": 0}
+        )["cookie_count"]
+
+    def _ranked(self):
+        # type: () -> list
+        # this store doesn't know about guilds, or keep an index
+        users = self.file_man.load_from_json()["users"]
+        return sorted(
+            (
+                (int(id), data["cookie_count"])
+                for id, data in users.items()
+                if data["cookie_count"] > 0
+            ),
+            key=lambda user: -user[1],
+        )
+
+    def top(self, n, guild_id=None):
+        # type: (int, Any) -> list
+        return self._ranked()[:n]
+
+    def rank(self, id, guild_id=None):
+        # type: (int, Any) -> Any
+        ranked = self._ranked()
+        for user, count in ranked:
+            if user == int(id):
+                return (
+                    sum(1 for _, other in ranked if other > count) + 1,
+                    count,
+                )
+        return None
+
+
+class SqliteStore:
     """
-    Gives a users a cookie count and returns the new number.
+    A cookie store backed by SQLite in WAL mode.
+
+    Users are keyed by their Discord ID (the table's primary key), so a
+    lookup or an increment only touches that user's row. An index on the
+    cookie count serves the leaderboard, so worker processes sharing the
+    database always agree on it.
+
+    Ranks come from the `ranks` table, which counts the users with each
+    cookie count in the same Fenwick tree layout as
+    `Leaderboard.CountIndex`, one tree per guild. Finding how many users
+    are ahead of someone reads O(log max count) rows, and a cookie only
+    changes the few nodes the old and new counts don't share.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = path
+        # autocommit mode, transactions are opened explicitly below
+        self.connection = connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "id INTEGER PRIMARY KEY, "
+            "cookie_count INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS users_by_count "
+            "ON users (cookie_count)"
+        )
+        # the guilds each user has been given cookies in
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "PRIMARY KEY (guild_id, user_id))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS members_by_user "
+            "ON members (user_id)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS ranks ("
+            "guild_id INTEGER NOT NULL, node INTEGER NOT NULL, "
+            "users INTEGER NOT NULL, PRIMARY KEY (guild_id, node)) "
+            "WITHOUT ROWID"
+        )
+
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if (
+                cursor.execute(
+                    "SELECT 1 FROM meta WHERE key = 'ranks_indexed'"
+                ).fetchone()
+                is None
+            ):
+                self._index(cursor)
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def _index(self, cursor):
+        # type: (Any) -> None
+        """Rebuilds the `ranks` table from the users, in a transaction."""
+
+        nodes = {}  # type: dict
+        for guild_id, count, users in list(
+            cursor.execute(
+                "SELECT ?, cookie_count, COUNT(*) FROM users "
+                "WHERE cookie_count > 0 GROUP BY cookie_count",
+                (EVERYONE,),
+            )
+        ) + list(
+            cursor.execute(
+                "SELECT members.guild_id, users.cookie_count, COUNT(*) "
+                "FROM members JOIN users ON users.id = members.user_id "
+                "WHERE users.cookie_count > 0 "
+                "GROUP BY members.guild_id, users.cookie_count"
+            )
+        ):
+            for node in _path(count):
+                nodes[guild_id, node] = nodes.get((guild_id, node), 0) + users
+
+        cursor.execute("DELETE FROM ranks")
+        cursor.executemany(
+            "INSERT INTO ranks (guild_id, node, users) VALUES (?, ?, ?)",
+            [
+                (guild_id, node, users)
+                for (guild_id, node), users in nodes.items()
+            ],
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO meta (key, value) "
+            "VALUES ('ranks_indexed', '1')"
+        )
+
+    def _move(self, cursor, guild_id, old, new):
+        # type: (Any, int, int, int) -> None
+        """Moves a user from `old` cookies to `new` in a guild's ranks."""
+
+        deltas = {}  # type: dict
+        if old > 0:
+            for node in _path(old):
+                deltas[node] = deltas.get(node, 0) - 1
+        for node in _path(new):
+            deltas[node] = deltas.get(node, 0) + 1
+        cursor.executemany(
+            "INSERT INTO ranks (guild_id, node, users) VALUES (?, ?, ?) "
+            "ON CONFLICT(guild_id, node) DO UPDATE "
+            "SET users = users + excluded.users",
+            [
+                (guild_id, node, delta)
+                for node, delta in deltas.items()
+                if delta != 0
+            ],
+        )
+
+    def add_cookie(self, id, guild_id=None):
+        # type: (int, Any) -> int
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                "INSERT INTO users (id, cookie_count) VALUES (?, 1) "
+                "ON CONFLICT(id) DO UPDATE "
+                "SET cookie_count = cookie_count + 1",
+                (int(id),),
+            )
+            cursor.execute(
+                "SELECT cookie_count FROM users WHERE id = ?", (int(id),)
+            )
+            count = cursor.fetchone()[0]
+            self._move(cursor, EVERYONE, count - 1, count)
+            # the user moves up on every guild's leaderboard they're on
+            for (member_of,) in cursor.execute(
+                "SELECT guild_id FROM members WHERE user_id = ?", (int(id),)
+            ).fetchall():
+                self._move(cursor, member_of, count - 1, count)
+            if guild_id is not None:
+                cursor.execute(
+                    "INSERT OR IGNORE INTO members (guild_id, user_id) "
+                    "VALUES (?, ?)",
+                    (int(guild_id), int(id)),
+                )
+                if cursor.rowcount == 1:
+                    self._move(cursor, int(guild_id), 0, count)
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        return count
+
+    def get_count(self, id):
+        # type: (int) -> int
+        row = self.connection.execute(
+            "SELECT cookie_count FROM users WHERE id = ?", (int(id),)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def top(self, n, guild_id=None):
+        # type: (int, Any) -> list
+        """The `n` users with the most cookies, as (id, count)."""
+
+        if guild_id is None:
+            return self.connection.execute(
+                "SELECT id, cookie_count FROM users WHERE cookie_count > 0 "
+                "ORDER BY cookie_count DESC LIMIT ?",
+                (n,),
+            ).fetchall()
+        return self.connection.execute(
+            "SELECT users.id, users.cookie_count FROM members "
+            "JOIN users ON users.id = members.user_id "
+            "WHERE members.guild_id = ? AND users.cookie_count > 0 "
+            "ORDER BY users.cookie_count DESC LIMIT ?",
+            (int(guild_id), n),
+        ).fetchall()
+
+    def rank(self, id, guild_id=None):
+        # type: (int, Any) -> Any
+        """The user's (rank, count), or None if they have no cookies."""
+
+        count = self.get_count(id)
+        if count == 0:
+            return None
+        if (
+            guild_id is not None
+            and self.connection.execute(
+                "SELECT 1 FROM members WHERE guild_id = ? AND user_id = ?",
+                (int(guild_id), int(id)),
+            ).fetchone()
+            is None
+        ):
+            return None
+
+        # everyone (the root node) minus those with `count` or fewer
+        nodes = _prefix(count)
+        users = dict(
+            self.connection.execute(
+                "SELECT node, users FROM ranks WHERE guild_id = ? "
+                "AND node IN ({0})".format(", ".join("?" * (len(nodes) + 1))),
+                [EVERYONE if guild_id is None else int(guild_id), MAX_COUNT]
+                + nodes,
+            )
+        )
+        ahead = users.get(MAX_COUNT, 0) - sum(
+            users.get(node, 0) for node in nodes
+        )
+        return ahead + 1, count
+
+    def migrate(self, users):
+        # type: (dict) -> bool
+        """
+        Copies the `users` map from the old JSON config into the database.
+
+        This only ever runs once per database, returns if it did anything.
+        """
+
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            done = cursor.execute(
+                "SELECT value FROM meta WHERE key = 'json_migrated'"
+            ).fetchone()
+            if done is not None:
+                cursor.execute("COMMIT")
+                return False
+
+            for id, data in users.items():
+                cursor.execute(
+                    "INSERT INTO users (id, cookie_count) VALUES (?, ?) "
+                    "ON CONFLICT(id) DO UPDATE "
+                    "SET cookie_count = MAX(cookie_count, excluded.cookie_count)",
+                    (int(id), int(data.get("cookie_count", 0))),
+                )
+                for guild_id in data.get("guilds", ()):
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO members (guild_id, user_id) "
+                        "VALUES (?, ?)",
+                        (int(guild_id), int(id)),
+                    )
+            cursor.execute(
+                "INSERT INTO meta (key, value) VALUES ('json_migrated', '1')"
+            )
+            self._index(cursor)
+            cursor.execute("COMMIT")
+        except:
+            cursor.execute("ROLLBACK")
+            raise
+        return True
+
+    def close(self):
+        # type: () -> None
+        self.connection.close()
+
+
+class JournalStore:
     """
+    A cookie store that keeps every user in memory.
 
-    u = None
-    tmp = file_man.load_from_json()
-    for user in tmp["users"]:
-        if user == id:
-            u = user
+    Each change is appended to a journal file as one small JSON record
+    holding the user's new state, and `compact` periodically folds the
+    journal into a snapshot. Records are absolute values rather than
+    deltas, so replaying the journal over any snapshot is always safe.
+
+    The leaderboard is an in-memory index, built on load and updated by
+    every `add_cookie`.
+    """
 
-    if u is None:
-        tmp["users"][id] = {"cookie_count": 1}
-        file_man.write_to_file(dumps(tmp))
-        file_man.refresh()
-        return 1
+    def __init__(self, path, compact_interval=300):
+        # type: (str, float) -> None
+        self.path = path
+        self.compact_interval = compact_interval
+        self.snapshot_path = path + ".snapshot"
+        self.users = {}  # type: dict
+        self.lock = Lock()
+        self.dirty = False
+        self.existed = os.path.exists(path) or os.path.exists(
+            self.snapshot_path
+        )
 
-    tmp["users"][id]["cookie_count"] += 1
-    file_man.write_to_file(dumps(tmp))
-    file_man.refresh()
-    return file_man.load_from_json()["users"][id]["cookie_count"]
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                for id, data in load(f).items():
+                    self.users[int(id)] = data
+
+        if os.path.exists(path):
+            good = 0
+            with open(path, "rb") as records:
+                for line in records:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("unterminated record")
+                        record = loads(line)
+                    except ValueError:
+                        break
+                    self.users[record.pop("id")] = record
+                    good += len(line)
+            # drop a record torn by a crash, so new ones aren't glued onto it
+            os.truncate(path, good)
+
+        self.journal = open(path, "a")
+        self._index()
+
+    def _index(self):
+        # type: () -> None
+        self.leaderboard = Leaderboard()
+        for id, data in self.users.items():
+            self.leaderboard.record(
+                id, data["cookie_count"], data.get("guilds", ())
+            )
+
+    def add_cookie(self, id, guild_id=None):
+        # type: (int, Any) -> int
+        id = int(id)
+        with self.lock:
+            data = self.users.setdefault(id, {"cookie_count": 0})
+            data["cookie_count"] += 1
+            guilds = data.get("guilds", [])
+            if guild_id is not None and int(guild_id) not in guilds:
+                data["guilds"] = guilds = guilds + [int(guild_id)]
+            record = dict(data, id=id)
+            self.journal.write(dumps(record) + "\n")
+            self.journal.flush()
+            self.dirty = True
+            self.leaderboard.record(id, data["cookie_count"], guilds)
+        return record["cookie_count"]
+
+    def get_count(self, id):
+        # type: (int) -> int
+        return self.users.get(int(id), {"cookie_count": 0})["cookie_count"]
+
+    def top(self, n, guild_id=None):
+        # type: (int, Any) -> list
+        """The `n` users with the most cookies, as (id, count)."""
+
+        return self.leaderboard.top(
+            n, None if guild_id is None else int(guild_id)
+        )
+
+    def rank(self, id, guild_id=None):
+        # type: (int, Any) -> Any
+        """The user's (rank, count), or None if they have no cookies."""
+
+        return self.leaderboard.rank(
+            int(id), None if guild_id is None else int(guild_id)
+        )
+
+    def migrate(self, users):
+        # type: (dict) -> bool
+        """
+        Copies the `users` map from the old JSON config into the journal.
+
+        This only runs if the store did not exist yet, returns if it did
+        anything.
+        """
+
+        if self.existed or len(users) == 0:
+            return False
+
+        for id, data in users.items():
+            self.users[int(id)] = {
+                "cookie_count": data.get("cookie_count", 0)
+            }
+        self.existed = True
+        self._index()
+        self.compact()
+        return True
+
+    def compact(self):
+        # type: () -> None
+        """
+        Writes a fresh snapshot and drops the journal records it covers.
+
+        This is slow for big stores, so run it off the event loop.
+        """
+
+        with self.lock:
+            self.journal.flush()
+            position = self.journal.tell()
+            users = {id: dict(data) for id, data in self.users.items()}
+            self.dirty = False
+
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            dump(users, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+        with self.lock:
+            # keep whatever was appended while the snapshot was written
+            self.journal.flush()
+            with open(self.path, "r") as f:
+                f.seek(position)
+                tail = f.read()
+            with open(self.path + ".tmp", "w") as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal.close()
+            os.replace(self.path + ".tmp", self.path)
+            self.journal = open(self.path, "a")
+
+    def close(self):
+        # type: () -> None
+        if self.dirty:
+            self.compact()
+        self.journal.close()
+
+
+async def compact_periodically(store):
+    # type: (JournalStore) -> None
+    """Compacts a journal store in a worker thread every so often."""
+
+    while True:
+        await sleep(store.compact_interval)
+        if store.dirty:
+            await get_event_loop().run_in_executor(None, store.compact)
+
+
+def open_store(conf):
+    # type: (Any) -> Any
+    """
+    Opens the cookie store described by the `database` config section.
+
+    A plain string is treated as the path to a SQLite database.
+    """
+
+    if isinstance(conf, str):
+        conf = {"engine": "sqlite", "path": conf}
+
+    if conf.get("engine", "journal") == "sqlite":
+        return SqliteStore(conf.get("path", "cakebot.db"))
+    return JournalStore(
+        conf.get("path", "cakebot.journal"),
+        conf.get("compact_interval", 300),
+    )
+
+
+def _engine(file_man):
+    # type: (Any) -> Any
+    """Wraps a plain file manipulator in the legacy JSON engine."""
+
+    if hasattr(file_man, "add_cookie"):
+        return file_man
+    return JsonStore(file_man)
+
+
+def add_cookie(id, file_man, guild_id=None):
+    # type: (int, Any, Any) -> int
+    """
+    Gives a users a cookie count and returns the new number.
+
+    Giving it in a guild puts them on that guild's leaderboard.
+    """
+
+    return _engine(file_man).add_cookie(id, guild_id)
 
 
 def get_count(id, file_man):
     # type: (int, Any) -> int
 
-    return file_man.load_from_json()["users"].get(id, {"cookie_count": 0})[
-        "cookie_count"
-    ]
+    return _engine(file_man).get_count(id)
+
+
+def top(n, file_man, guild_id=None):
+    # type: (int, Any, Any) -> list
+    """The `n` users with the most cookies, in a guild or everywhere."""
+
+    return _engine(file_man).top(n, guild_id)
+
+
+def rank(id, file_man, guild_id=None):
+    # type: (int, Any, Any) -> Any
+    """A user's (rank, count), or None if they have no cookies."""
+
+    return _engine(file_man).rank(id, guild_id)
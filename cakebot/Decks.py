@@ -0,0 +1,214 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from array import array
+from collections import OrderedDict
+from importlib import import_module
+from random import getrandbits
+from threading import Lock
+from typing import Any
+
+from . import Content
+
+
+class Pool:
+    """Strings packed into one UTF-8 buffer, with an array of offsets."""
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, strings):
+        # type: (Any) -> None
+        encoded = [string.encode("utf-8") for string in strings]
+        self.data = b"".join(encoded)
+        self.offsets = array("I", [0])
+        for item in encoded:
+            self.offsets.append(self.offsets[-1] + len(item))
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        # type: (int) -> str
+        return self.data[
+            self.offsets[index] : self.offsets[index + 1]
+        ].decode("utf-8")
+
+
+class Deck:
+    """
+    A shuffled order of `size` cards, and how far through it we are.
+
+    The order isn't stored: a small Feistel network keyed by `seed` maps
+    each position to a card, so a deck is the same few numbers no matter
+    how big the pool is.
+    """
+
+    __slots__ = ("size", "seed", "position", "half", "mask")
+
+    def __init__(self, size):
+        # type: (int) -> None
+        self.size = size
+        self.seed = getrandbits(64)
+        self.position = 0
+        bits = max(2, (size - 1).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = (1 << self.half) - 1
+
+    def card(self, position):
+        # type: (int) -> int
+        """The card at a position, every card shows up exactly once."""
+
+        value = position
+        while True:
+            left = value >> self.half
+            right = value & self.mask
+            for step in range(4):
+                left, right = (
+                    right,
+                    left ^ (hash((self.seed, step, right)) & self.mask),
+                )
+            value = (left << self.half) | right
+            # walk the cycle until we land back inside the deck
+            if value < self.size:
+                return value
+
+    def draw(self):
+        # type: () -> int
+        card = self.card(self.position)
+        self.position += 1
+        return card
+
+
+class Decks:
+    """
+    One deck per (pool, guild), so nobody sees a repeat until the pool
+    runs out.
+
+    A deck is reshuffled when it runs out or the pool changes size, and
+    the least recently used ones are forgotten past `size`.
+    """
+
+    def __init__(self, size=10000):
+        # type: (int) -> None
+        self.size = size
+        self.decks = OrderedDict()  # type: OrderedDict
+
+    def draw(self, key, pool):
+        # type: (Any, Any) -> str
+        if len(pool) == 0:
+            raise IndexError("Can't draw from an empty pool.")
+
+        deck = self.decks.get(key)
+        if (
+            deck is None
+            or deck.size != len(pool)
+            or deck.position >= deck.size
+        ):
+            deck = self.decks[key] = Deck(len(pool))
+            if len(self.decks) > self.size:
+                self.decks.popitem(last=False)
+        else:
+            self.decks.move_to_end(key)
+        return pool[deck.draw()]
+
+
+def collect(sample, patience=5):
+    # type: (Any, int) -> Pool
+    """
+    Builds a pool from a function that returns a random item.
+
+    It keeps sampling until it goes `patience` times the number of items
+    seen so far without finding a new one.
+    """
+
+    seen = {}  # type: dict
+    misses = 0
+    while misses <= patience * len(seen) + 100:
+        item = sample()
+        if item in seen:
+            misses += 1
+        else:
+            seen[item] = None
+            misses = 0
+    return Pool(seen)
+
+
+def find_strings(imp):
+    # type: (Any) -> Any
+    """
+    The list of strings an object picks its random items from, or None.
+
+    It looks on the object, then its class, then the class's module.
+    """
+
+    for namespace in [
+        getattr(imp, "__dict__", {}),
+        vars(type(imp)),
+        vars(import_module(type(imp).__module__)),
+    ]:
+        for name, value in namespace.items():
+            if (
+                not name.startswith("__")
+                and isinstance(value, (list, tuple))
+                and len(value) > 0
+                and all(isinstance(item, str) for item in value)
+            ):
+                return value
+    return None
+
+
+decks = Decks()
+fact_pool = None  # type: Any
+fact_lock = Lock()
+
+
+def facts():
+    # type: () -> Pool
+    """
+    The fact dataset, loaded once.
+
+    The bot loads it in a worker thread at startup, so the first `+fact`
+    doesn't wait for it on the event loop.
+    """
+
+    global fact_pool
+    with fact_lock:
+        if fact_pool is None:
+            from factdata import FactImp
+
+            imp = FactImp()
+            strings = find_strings(imp)
+            # only sample if factdata doesn't keep its facts in a list
+            if strings is None:
+                fact_pool = collect(imp.fact)
+            else:
+                fact_pool = Pool(dict.fromkeys(strings))
+    return fact_pool
+
+
+def draw_fact(guild_id):
+    # type: (Any) -> str
+    return decks.draw(("facts", guild_id), facts())
+
+
+def draw_content(name, guild_id):
+    # type: (str, Any) -> str
+    """Draws a line from a content file, like a joke."""
+
+    return decks.draw((name, guild_id), Content.registry.get(name))
@@ -16,10 +16,22 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from typing import Any
+
 from discord import Embed
 
 from . import ColourUtil
 
+FOOTER = "Created with ❤ and 🍪 by the Cakebot Team | https://cakebot.club/"
+AUTHOR = {
+    "name": "Cakebot",
+    "url": "https://cakebot.club",
+    "icon_url": "https://raw.githubusercontent.com/cakebotpro/cakebot/master/content/cake.png",
+}
+
+# key -> the embed as a dict, see `static`
+_static = {}  # type: dict
+
 
 def prep(title, description):
     # type: (str, str) -> Embed
@@ -28,12 +40,24 @@ def prep(title, description):
     embed = Embed(
         title=title, description=description, color=ColourUtil.random()
     )
-    embed.set_footer(
-        text="Created with ❤ and 🍪 by the Cakebot Team | https://cakebot.club/"
-    )
-    embed.set_author(
-        name="Cakebot",
-        url="https://cakebot.club",
-        icon_url="https://raw.githubusercontent.com/cakebotpro/cakebot/master/content/cake.png",
-    )
+    embed.set_footer(text=FOOTER)
+    embed.set_author(**AUTHOR)
     return embed
+
+
+def static(key, build):
+    # type: (str, Any) -> Embed
+    """
+    Get an embed that never changes.
+
+    `build` is only called the first time a key is used, after that each
+    call gets a fresh copy of what it built.
+    """
+
+    data = _static.get(key)
+    if data is None:
+        data = _static[key] = build().to_dict()
+    if "fields" in data:
+        # so adding a field to the copy can't change the original
+        return Embed.from_dict(dict(data, fields=list(data["fields"])))
+    return Embed.from_dict(data)
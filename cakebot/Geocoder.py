@@ -0,0 +1,183 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from asyncio import get_event_loop
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader
+from typing import Any
+
+from .Content import ContentFile
+
+
+def default_source():
+    # type: () -> str
+    """The cities file that ships with `reverse_geocoder`."""
+
+    import reverse_geocoder
+
+    return os.path.join(
+        os.path.dirname(reverse_geocoder.__file__), reverse_geocoder.RG_FILE
+    )
+
+
+def on_sphere(coords):
+    # type: (Any) -> Any
+    """
+    Turns (lat, lon) pairs in degrees into points on the unit sphere.
+
+    The nearest point there is the nearest place on Earth, which it isn't
+    in raw degrees, near the poles or across the 180th meridian.
+    """
+
+    import numpy
+
+    radians = numpy.radians(numpy.asarray(coords, dtype=float))
+    lat = radians[..., 0]
+    lon = radians[..., 1]
+    return numpy.stack(
+        [
+            numpy.cos(lat) * numpy.cos(lon),
+            numpy.cos(lat) * numpy.sin(lon),
+            numpy.sin(lat),
+        ],
+        axis=-1,
+    )
+
+
+class Geocoder:
+    """
+    Turns coordinates into an "admin1, country code" location string.
+
+    The first start converts the `reverse_geocoder` cities CSV into a
+    compact index on disk: a NumPy array of coordinates and a text file
+    of labels, both memory-mapped afterwards, so every process on the host
+    shares one copy through the page cache. The KD-tree, over the
+    places' positions on the unit sphere, is built and queried in a
+    worker pool, and results are cached per grid cell.
+    """
+
+    def __init__(
+        self,
+        index_dir="geocoder-index",
+        source=None,
+        workers=2,
+        grid=0.25,
+        cache_size=4096,
+    ):
+        # type: (str, str, int, float, int) -> None
+        self.index_dir = index_dir
+        self.source = source
+        self.grid = grid
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # type: OrderedDict[tuple, str]
+        self.hits = 0
+        self.misses = 0
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="geocoder"
+        )
+        self.ready = None  # type: Any
+        self.tree = None  # type: Any
+        self.labels = None  # type: Any
+
+    def _build_index(self, coords_path, labels_path):
+        # type: (str, str) -> None
+        import numpy
+
+        coords = []
+        source = self.source or default_source()
+        with open(source, "r", encoding="utf-8") as src, open(
+            labels_path + ".tmp", "w", encoding="utf-8"
+        ) as labels:
+            for row in DictReader(src):
+                coords.append((float(row["lat"]), float(row["lon"])))
+                labels.write("{0}, {1}\n".format(row["admin1"], row["cc"]))
+
+        numpy.save(coords_path + ".tmp.npy", numpy.array(coords))
+        os.replace(coords_path + ".tmp.npy", coords_path)
+        os.replace(labels_path + ".tmp", labels_path)
+
+    def ensure_index(self):
+        # type: () -> tuple
+        """Builds the index if it isn't on disk yet, returns its paths."""
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        coords_path = os.path.join(self.index_dir, "coords.npy")
+        labels_path = os.path.join(self.index_dir, "labels.txt")
+        if not os.path.exists(coords_path):
+            self._build_index(coords_path, labels_path)
+        return coords_path, labels_path
+
+    def _load(self):
+        # type: () -> None
+        import numpy
+        from scipy.spatial import cKDTree
+
+        coords_path, labels_path = self.ensure_index()
+        self.labels = ContentFile(labels_path, mmap_threshold=0)
+        self.tree = cKDTree(on_sphere(numpy.load(coords_path, mmap_mode="r")))
+
+    def warm(self):
+        # type: () -> Any
+        """Starts loading the index in the background, if it isn't yet."""
+
+        if self.ready is None:
+            self.ready = get_event_loop().run_in_executor(
+                self.pool, self._load
+            )
+            self.ready.add_done_callback(self._loaded)
+        return self.ready
+
+    def _loaded(self, ready):
+        # type: (Any) -> None
+        # a failed load is tried again by the next lookup
+        if self.ready is ready and (
+            ready.cancelled() or ready.exception() is not None
+        ):
+            self.ready = None
+
+    def _query(self, lat, lon):
+        # type: (float, float) -> str
+        _, index = self.tree.query(on_sphere((lat, lon)), k=1)
+        return self.labels[int(index)].rstrip("\n")
+
+    async def lookup(self, lat, lon):
+        # type: (float, float) -> str
+        """Finds the nearest known place to some coordinates."""
+
+        cell = (round(float(lat) / self.grid), round(float(lon) / self.grid))
+        location = self.cache.get(cell)
+        if location is not None:
+            self.hits += 1
+            self.cache.move_to_end(cell)
+            return location
+
+        self.misses += 1
+        await self.warm()
+        location = await get_event_loop().run_in_executor(
+            self.pool, self._query, cell[0] * self.grid, cell[1] * self.grid
+        )
+        self.cache[cell] = location
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return location
+
+    def close(self):
+        # type: () -> None
+        self.pool.shutdown(wait=False)
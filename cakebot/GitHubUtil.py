@@ -16,11 +16,21 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from asyncio import Event, TimeoutError, get_event_loop, wait_for
+from collections import OrderedDict
 from random import randint
-from typing import Any
+from sqlite3 import connect
+from time import perf_counter, time
+from typing import TYPE_CHECKING, Any, Callable
 
-from discord import Message
-from github import Github
+from . import Metrics
+
+if TYPE_CHECKING:
+    # only for the type comments, PyGithub is slow to import
+    from discord import Message
+    from github import Github
+
+API_URL = "https://api.github.com/repos/"
 
 issue_template = """\
 ## Support Ticket
@@ -35,15 +45,264 @@ issue_template = """\
 """
 
 
-async def report(s, g, args, message):
-    # type: (Any, Github, list, Message) -> None
+class TicketQueue:
+    """
+    A queue of support tickets, kept in SQLite until GitHub has them.
+
+    `work` files them in the background, retrying with exponential
+    backoff, so `+report` never waits on GitHub. It's given a function
+    that makes the GitHub client, which is only called once there's a
+    ticket to file, in a worker thread. The same report from the
+    same user is only queued once per `dedupe_window` seconds.
+    """
+
+    def __init__(
+        self,
+        path,
+        repo="cakebotpro/cakebot",
+        label="ticket",
+        dedupe_window=600,
+        backoff=30,
+        max_backoff=3600,
+    ):
+        # type: (str, str, str, float, float, float) -> None
+        self.repo_name = repo
+        self.label_name = label
+        self.dedupe_window = dedupe_window
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.repo = None  # type: Any
+        self.label = None  # type: Any
+        self.wakeup = None  # type: Any
+
+        self.connection = connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tickets ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "author_id INTEGER NOT NULL, "
+            "author TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_try REAL NOT NULL, "
+            "filed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tickets_pending "
+            "ON tickets (filed, next_try)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS tickets_author "
+            "ON tickets (author_id, created)"
+        )
+
+    def put(self, author_id, author, body):
+        # type: (int, str, str) -> bool
+        """Queues a ticket, returns False if it's a duplicate."""
+
+        now = time()
+        duplicate = self.connection.execute(
+            "SELECT 1 FROM tickets "
+            "WHERE author_id = ? AND body = ? AND created > ?",
+            (author_id, body, now - self.dedupe_window),
+        ).fetchone()
+        if duplicate is not None:
+            return False
+
+        self.connection.execute(
+            "INSERT INTO tickets (author_id, author, body, created, next_try) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (author_id, author, body, now, now),
+        )
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return True
+
+    def pending(self):
+        # type: () -> int
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM tickets WHERE filed = 0"
+        ).fetchone()[0]
+
+    def _file(self, github, author, body):
+        # type: (Callable[[], Github], str, str) -> None
+        # this blocks, so it runs in a worker thread
+        if self.repo is None:
+            self.repo = github().get_repo(self.repo_name)
+        if self.label is None:
+            self.label = self.repo.get_label(self.label_name)
+
+        self.repo.create_issue(
+            title="Support ticket #" + str(randint(0, 100000)),
+            body=issue_template.format(author, body),
+            labels=[self.label],
+        )
+
+    async def drain_once(self, github):
+        # type: (Callable[[], Github]) -> bool
+        """Files the next ticket that is due, returns if there was one."""
+
+        now = time()
+        row = self.connection.execute(
+            "SELECT id, author, body, attempts FROM tickets "
+            "WHERE filed = 0 AND next_try <= ? ORDER BY next_try LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            return False
+
+        id, author, body, attempts = row
+        start = perf_counter()
+        try:
+            await get_event_loop().run_in_executor(
+                None, self._file, github, author, body
+            )
+        except Exception:
+            Metrics.upstream_seconds.observe(
+                perf_counter() - start, "api.github.com"
+            )
+            Metrics.upstream_errors_total.inc("api.github.com")
+            delay = min(self.backoff * 2**attempts, self.max_backoff)
+            self.connection.execute(
+                "UPDATE tickets SET attempts = ?, next_try = ? WHERE id = ?",
+                (attempts + 1, now + delay, id),
+            )
+            return True
+
+        Metrics.upstream_seconds.observe(
+            perf_counter() - start, "api.github.com"
+        )
+        self.connection.execute(
+            "UPDATE tickets SET filed = 1 WHERE id = ?", (id,)
+        )
+        # filed tickets are only kept around for deduplication
+        self.connection.execute(
+            "DELETE FROM tickets WHERE filed = 1 AND created < ?",
+            (now - self.dedupe_window,),
+        )
+        return True
+
+    async def work(self, github, interval=30):
+        # type: (Callable[[], Github], float) -> None
+        """Files queued tickets forever."""
+
+        self.wakeup = Event()
+        while True:
+            if await self.drain_once(github):
+                continue
+            self.wakeup.clear()
+            try:
+                await wait_for(self.wakeup.wait(), interval)
+            except TimeoutError:
+                pass
+
+    def close(self):
+        # type: () -> None
+        self.connection.close()
+
+
+async def report(s, queue, args, message):
+    # type: (Any, TicketQueue, list, Message) -> None
     """Reports an error to the GitHub page."""
 
-    repo = g.get_repo("cakebotpro/cakebot")
     f = " ".join(args)
-    repo.create_issue(
-        title="Support ticket #" + str(randint(0, 100000)),
-        body=issue_template.format(str(message.author), f),
-        labels=[repo.get_label("ticket")],
-    )
+    if not queue.put(message.author.id, str(message.author), f):
+        return await s(
+            ":white_check_mark: **We already got that one, thanks!**"
+        )
     return await s(":white_check_mark: **Our team has been notified.**")
+
+
+class RepoInfo:
+    """What we know about a GitHub repository."""
+
+    __slots__ = ("stars", "homepage", "etag", "fetched_at", "stale")
+
+    def __init__(self, data, etag):
+        # type: (dict, str) -> None
+        self.stars = data["stargazers_count"]
+        self.homepage = data["homepage"]
+        self.etag = etag
+        self.fetched_at = time()
+        self.stale = False
+
+
+class RepoCache:
+    """
+    Caches repository stars and homepages for `ttl` seconds.
+
+    Expired entries are revalidated with If-None-Match, and GitHub doesn't
+    count a 304 response against our quota. When fewer than `low_quota`
+    requests are left, expired entries are served as they are, marked
+    `stale`, until the quota resets.
+    """
+
+    def __init__(self, token=None, ttl=600, low_quota=50, size=1024):
+        # type: (str, float, int, int) -> None
+        self.token = token
+        self.ttl = ttl
+        self.low_quota = low_quota
+        self.size = size
+        self.entries = OrderedDict()  # type: OrderedDict
+        self.remaining = None  # type: Any
+        self.reset = 0.0
+
+    def quota_is_low(self):
+        # type: () -> bool
+        return (
+            self.remaining is not None
+            and self.remaining < self.low_quota
+            and time() < self.reset
+        )
+
+    async def get(self, http, name):
+        # type: (Any, str) -> RepoInfo
+        """Gets a repository's info, raises LookupError if it's not there."""
+
+        key = name.lower()
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            entry.stale = False
+            if time() - entry.fetched_at < self.ttl:
+                return entry
+            if self.quota_is_low():
+                entry.stale = True
+                return entry
+
+        headers = {"Accept": "application/vnd.github.v3+json"}
+        if self.token is not None:
+            headers["Authorization"] = "token " + self.token
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+
+        try:
+            resp = await http.get(API_URL + name, headers=headers)
+        except Exception:
+            if entry is None:
+                raise
+            entry.stale = True
+            return entry
+
+        if "X-RateLimit-Remaining" in resp.headers:
+            self.remaining = int(resp.headers["X-RateLimit-Remaining"])
+            self.reset = float(resp.headers.get("X-RateLimit-Reset", 0))
+
+        if resp.status == 304 and entry is not None:
+            entry.fetched_at = time()
+            return entry
+        if resp.status != 200:
+            if entry is not None and resp.status in {403, 429}:
+                # out of quota
+                entry.stale = True
+                return entry
+            raise LookupError(f"GitHub said {resp.status} for {name}")
+
+        entry = RepoInfo(resp.data, resp.headers.get("ETag"))
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
@@ -0,0 +1,502 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+from asyncio import ensure_future, sleep
+from sys import exit as _exit
+from time import perf_counter
+from typing import Any
+
+import discord
+from discord.utils import oauth_url
+
+from . import (
+    Content,
+    Database,
+    Decks,
+    EmbedUtil,
+    GitHubUtil,
+    LowMemory,
+    Outbox,
+    Reload,
+    TextCommandsUtil,
+    UserUtil,
+)
+from .Commands import Command
+
+# the commands defined below, in the order they're defined
+COMMANDS = []  # type: list
+
+# main, which owns the client, the stores and the caches
+bot = None  # type: Any
+
+STALE_NOTICE = " *(This might be a little out of date.)*"
+
+
+def command(name, **kwargs):
+    # type: (str, Any) -> Any
+    """Decorator that adds a handler to `COMMANDS`."""
+
+    def decorator(handler):
+        COMMANDS.append(Command(name, handler, **kwargs))
+        return handler
+
+    return decorator
+
+
+def register(commands, main):
+    # type: (Any, Any) -> None
+    """
+    Puts the commands in a Commands.Registry, replacing the ones it had.
+
+    The handlers find the client, stores and caches on `main`, so +reload
+    can re-import this module and register the new handlers without
+    touching any of them.
+    """
+
+    global bot
+    bot = main
+    commands.commands.clear()
+    for handler in COMMANDS:
+        commands.add(handler)
+
+
+async def common(ctx):
+    guild = ctx.message.guild
+    return await ctx.send(
+        TextCommandsUtil.handle_common_commands(
+            ctx.args, ctx.name, None if guild is None else guild.id
+        )
+    )
+
+
+for name in ["pi", "coinflip", "joke"]:
+    command(name)(common)
+for name in ["8", "clapify", "say"]:
+    command(name, needs_args=True)(common)
+
+
+@command("help")
+async def show_help(ctx):
+    return await ctx.send(
+        embed=EmbedUtil.static(
+            "help",
+            lambda: EmbedUtil.prep(
+                title="Help",
+                description="You can check out [this page of our website](https://cakebot.club/docs/commands/) for a full command list!",
+            ),
+        )
+    )
+
+
+@command("ping")
+async def ping(ctx):
+    if bot.board is None:
+        return await ctx.send(
+            f"🏓 - websocket responded in {bot.client.latency}"
+        )
+
+    lines = [f"🏓 - websocket responded in {bot.client.latency}"]
+    for number, shards, latency, guilds, age in bot.board.workers():
+        if age > bot.cluster_conf.get("interval", 5) * 3:
+            lines.append(f"Worker {number} (shards {shards}): not responding")
+        else:
+            lines.append(
+                f"Worker {number} (shards {shards}): {latency:.3f}s, {guilds} servers"
+            )
+    return await ctx.send("\n".join(lines))
+
+
+@command("invite")
+async def invite(ctx):
+    return await ctx.send(
+        embed=EmbedUtil.static(
+            "invite",
+            lambda: EmbedUtil.prep(
+                "Invite Cakebot",
+                f"[Click here to invite me!]({oauth_url(580573141898887199, permissions=discord.Permissions.all())})",
+            ),
+        )
+    )
+
+
+@command("info")
+async def info(ctx):
+    guild = ctx.message.guild
+    owner = await LowMemory.owner(guild)
+    return await ctx.send(
+        embed=EmbedUtil.prep(
+            "Server Info",
+            TextCommandsUtil.data_template.format(
+                guild.name,
+                str(owner),
+                guild.member_count,
+                guild.region,
+                guild.id,
+                guild.premium_subscription_count,
+                str(guild.is_icon_animated()),
+                str(guild.created_at),
+                str(guild.large),
+                str(guild.mfa_level == 1),
+            ),
+        )
+    )
+
+
+@command("report", needs_args=True, cost=5)
+async def report(ctx):
+    return await GitHubUtil.report(
+        ctx.send, bot.tickets, ctx.args, ctx.message
+    )
+
+
+@command("iss", cost=3)
+async def iss(ctx):
+    placeholder = bot.outbox.placeholder(ctx.message.channel)
+    imp = await bot.iss_cache.get(bot.http)
+    lat = imp.lat
+    lon = imp.lon
+    location = await bot.geocoder.lookup(lat, lon)
+
+    return await bot.outbox.replace(
+        placeholder,
+        embed=EmbedUtil.prep(
+            "International Space Station", "Where it is right now!"
+        )
+        .add_field(
+            name="Location above Earth", value=str(location), inline=False
+        )
+        .add_field(name="Latitude", value=str(lat), inline=False)
+        .add_field(name="Longitude", value=str(lon), inline=False)
+        .add_field(
+            name="Last Updated",
+            value=f"{imp.age():.0f} seconds ago",
+            inline=False,
+        ),
+    )
+
+
+@command("fact", blocking=True)
+async def fact(ctx):
+    guild = ctx.message.guild
+    return await ctx.send(
+        embed=EmbedUtil.prep(
+            "Random Fact",
+            Decks.draw_fact(None if guild is None else guild.id),
+        )
+    )
+
+
+@command("slots")
+async def slots(ctx):
+    from slots import result, row
+
+    slotz = result()
+    top = row()
+    btm = row()
+    form = "win" if slotz[0] == 1 else "lose"
+    return await ctx.send(
+        f"⠀{top[0]}{top[1]}{top[2]}\n"
+        # the line above contains unicode, DO NOT REMOVE
+        + f"**>** {slotz[1][0]}{slotz[1][1]}{slotz[1][2]} **<**\n"
+        + f"   {btm[0]}{btm[1]}{btm[2]}"
+        + f"\n**You {form}!**"
+    )
+
+
+@command("reboot", admin_only=True)
+async def reboot(ctx):
+    await ctx.send("Restarting. This may take up to 5 minutes.")
+    if bot.board is not None:
+        # the other workers see this and exit too
+        bot.board.request_reboot()
+    # make the bot crash, forcing our server to turn it back on
+    _exit(1)
+
+
+@command("reload", admin_only=True, blocking=True)
+async def reload(ctx):
+    global bot
+
+    # reloading this module starts it over without the bot
+    main = bot
+
+    start = perf_counter()
+    to_reload = Reload.modules()
+    try:
+        Reload.reload_modules(to_reload)
+        conf = main.config.load_from_json()
+    except Exception as e:
+        return await ctx.send(f":x: **Reload failed: {e}**")
+    finally:
+        # even if this module failed part way through, the live handlers
+        # share its namespace and still need the bot
+        bot = main
+
+    # the new version of this module has the new handlers
+    register(main.commands, main)
+    main.base_conf.clear()
+    main.base_conf.update(conf)
+    main.wordsapi_token = main.base_conf.get("tokens", {}).get("wordsapi")
+    # picks up a new token the next time it's needed
+    main.github_client = None
+    Content.registry.reload()
+    main.commands.admins = frozenset(UserUtil.admins())
+    await main.client.change_presence(
+        activity=discord.Game(name=main.base_conf["status"])
+    )
+    return await ctx.send(
+        f"Reloaded {len(to_reload)} modules, the config, content and admins "
+        + f"in {(perf_counter() - start) * 1000:.0f} ms."
+    )
+
+
+@command("stars", needs_args=True, cost=2)
+async def stars(ctx):
+    try:
+        info = await bot.repo_cache.get(bot.http, ctx.args[0])
+        return await ctx.send(
+            f"`{ctx.args[0]}` has *{info.stars}* stars."
+            + (STALE_NOTICE if info.stale else "")
+        )
+    except:
+        return await ctx.send(
+            "Failed to get count. Is the repository valid and public?"
+        )
+
+
+@command("homepage", needs_args=True, cost=2)
+async def homepage(ctx):
+    try:
+        info = await bot.repo_cache.get(bot.http, ctx.args[0])
+        url = info.homepage
+        if url is None or url == "":
+            url = "(error: homepage not specified by owner)"
+        return await ctx.send(
+            f"{ctx.args[0]}'s homepage is located at {url}"
+            + (STALE_NOTICE if info.stale else "")
+        )
+    except:
+        return await ctx.send(
+            "Failed to fetch homepage. Is the repository valid and public?"
+        )
+
+
+@command("boomer", blocking=True)
+async def boomer(ctx):
+    return await ctx.send(file=discord.File("content/boomer.jpeg"))
+
+
+@command("cookie", aliases=["cookies"], needs_args=True)
+async def cookie(ctx):
+    subcommand = ctx.args[0]
+    args = ctx.args[1:]
+    userId = TextCommandsUtil.get_mentioned_id(args)
+
+    if subcommand in ["balance", "bal"]:
+        count = 0
+        if userId == 0:
+            # assume user wants themself
+            count = Database.get_count(ctx.message.author.id, bot.store)
+        else:
+            count = Database.get_count(userId, bot.store)
+
+        return await ctx.send(
+            embed=EmbedUtil.prep(
+                title="Cookies",
+                description=f"User has {count} cookies.",
+            )
+        )
+
+    elif subcommand in ["give", "to"]:
+        if userId == 0:
+            return await ctx.send(
+                "I don't see who I should give the cookie to. Try mentioning them."
+            )
+
+        guild = ctx.message.guild
+        new_count = Database.add_cookie(
+            userId, bot.store, None if guild is None else guild.id
+        )
+
+        return await ctx.send(
+            f"Gave <@!{userId}> a cookie. They now have {new_count} cookies."
+        )
+
+    elif subcommand in ["top", "leaderboard"]:
+        guild = ctx.message.guild
+        guild_id = None
+        if guild is not None and "global" not in args:
+            guild_id = guild.id
+        return await ctx.send(
+            embed=cookie_leaderboard(ctx.message.author.id, guild_id)
+        )
+
+
+def cookie_leaderboard(user_id, guild_id):
+    # type: (int, Any) -> discord.Embed
+    top = bot.leaderboard_cache.get(
+        guild_id,
+        lambda: Database.top(bot.leaderboard_size, bot.store, guild_id),
+    )
+    lines = [
+        f"**{place}.** <@!{id}> - {count} cookies"
+        for place, (id, count) in enumerate(top, start=1)
+    ]
+    embed = EmbedUtil.prep(
+        "Cookie Leaderboard" + (" (Everywhere)" if guild_id is None else ""),
+        "\n".join(lines) or "Nobody has any cookies yet!",
+    )
+
+    rank = Database.rank(user_id, bot.store, guild_id)
+    if rank is not None:
+        embed.add_field(
+            name="You", value=f"#{rank[0]} with {rank[1]} cookies"
+        )
+    return embed
+
+
+@command("define", needs_args=True, cost=2)
+async def define(ctx):
+    if bot.wordsapi_token is None:
+        return await ctx.send(
+            "This command is disabled due to a configuration error on my host's end - didn't find a WordsAPI token in the config!"
+        )
+    return await ctx.send(
+        embed=await TextCommandsUtil.define(
+            ctx.args, bot.wordsapi_token, bot.http, bot.define_cache
+        )
+    )
+
+
+@command("stalls", admin_only=True)
+async def stalls(ctx):
+    if not bot.watchdog_enabled:
+        return await ctx.send("The watchdog is turned off in the config.")
+
+    lines = [
+        f"{count:>5}x `{command}` at {location}"
+        for (command, location), count in bot.watchdog.top(10)
+    ]
+    if len(lines) == 0:
+        return await ctx.send("The event loop hasn't been blocked yet.")
+    return await ctx.send("\n".join(lines)[:1900])
+
+
+@command("start-profiler", admin_only=True)
+async def start_profiler(ctx):
+    try:
+        clock = ctx.args[0] if len(ctx.args) > 0 else "cpu"
+        duration = float(ctx.args[1]) if len(ctx.args) > 1 else 60
+        duration = bot.profiler.start(clock, duration)
+    except (RuntimeError, ValueError) as e:
+        return await ctx.send(f":x: **{e}**")
+
+    ensure_future(
+        finish_profiling(ctx.message.channel, bot.profiler.session, duration)
+    )
+    return await ctx.send(
+        f"Started a {duration:.0f} second {clock} profile. "
+        + "Run stop-profiler to finish early."
+    )
+
+
+async def finish_profiling(channel, session, duration):
+    await sleep(duration)
+    if bot.profiler.running and bot.profiler.session == session:
+        await bot.outbox.send(
+            channel,
+            saved_profile_message(bot.profiler.stop()),
+            priority=Outbox.BACKGROUND,
+        )
+
+
+def saved_profile_message(paths):
+    # type: (list) -> str
+    return "Saved profiler results to " + ", ".join(
+        f"`{path}`" for path in paths
+    )
+
+
+@command("stop-profiler", admin_only=True)
+async def stop_profiler(ctx):
+    if not bot.profiler.running:
+        return await ctx.send("The profiler isn't running.")
+    return await ctx.send(saved_profile_message(bot.profiler.stop()))
+
+
+@command("profile-top", admin_only=True)
+async def profile_top(ctx):
+    try:
+        top = int(ctx.args[0]) if len(ctx.args) > 0 else 10
+    except ValueError:
+        return await ctx.send(":x: **That isn't a number.**")
+
+    command = ctx.args[1].lower() if len(ctx.args) > 1 else None
+    summary = bot.profiler.summary(top, command)
+    # stay under Discord's message length limit
+    return await ctx.send("```\n" + summary[:1900] + "\n```")
+
+
+@command("heap-snapshot", admin_only=True, blocking=True)
+async def heap_snapshot(ctx):
+    try:
+        top = int(ctx.args[0]) if len(ctx.args) > 0 else 10
+    except ValueError:
+        return await ctx.send(":x: **That isn't a number.**")
+
+    if not bot.heap_profiler.tracing:
+        duration = bot.heap_profiler.start()
+        ensure_future(stop_heap_profiler(bot.heap_profiler.session, duration))
+        path = await bot.heap_profiler.snapshot()
+        return await ctx.send(
+            f"Started tracing allocations for up to {duration / 60:.0f} "
+            + f"minutes, the baseline is in `{path}`. "
+            + "Run heap-snapshot again later to see what was allocated."
+        )
+
+    path = await bot.heap_profiler.snapshot()
+    summary = await bot.heap_profiler.summary(top)
+    return await ctx.send(f"Saved `{path}`\n```\n" + summary[:1800] + "\n```")
+
+
+async def stop_heap_profiler(session, duration):
+    await sleep(duration)
+    if bot.heap_profiler.tracing and bot.heap_profiler.session == session:
+        bot.heap_profiler.stop()
+
+
+@command("heap-diff", admin_only=True, blocking=True)
+async def heap_diff(ctx):
+    try:
+        top = int(ctx.args[0]) if len(ctx.args) > 0 else 10
+        # which kept snapshot to compare with, the oldest by default
+        against = int(ctx.args[1]) if len(ctx.args) > 1 else 0
+        path, diff = await bot.heap_profiler.diff(top, against)
+    except (RuntimeError, ValueError) as e:
+        return await ctx.send(f":x: **{e}**")
+
+    return await ctx.send(f"Saved `{path}`\n```\n" + diff[:1800] + "\n```")
+
+
+@command("heap-stop", admin_only=True)
+async def heap_stop(ctx):
+    if not bot.heap_profiler.tracing:
+        return await ctx.send("Allocations aren't being traced.")
+    bot.heap_profiler.stop()
+    return await ctx.send("Stopped tracing allocations.")
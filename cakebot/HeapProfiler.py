@@ -0,0 +1,197 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import tracemalloc
+from asyncio import get_event_loop
+from time import strftime
+from typing import Any
+
+# allocations made by tracemalloc itself and the import system are noise
+IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def size(count):
+    # type: (float) -> str
+    """A number of bytes, in the biggest unit that fits."""
+
+    for unit in ("B", "KiB", "MiB"):
+        if abs(count) < 1024:
+            return "{0:.1f} {1}".format(count, unit)
+        count /= 1024
+    return "{0:.1f} GiB".format(count)
+
+
+def where(traceback):
+    # type: (Any) -> str
+    frame = traceback[0]
+    return "{0}:{1}".format(frame.filename, frame.lineno)
+
+
+class HeapProfiler:
+    """
+    Takes tracemalloc snapshots, to find what's using up memory.
+
+    Tracing slows down every allocation, so it only runs from the first
+    snapshot until it's stopped, or for `max_duration` seconds, keeping
+    `frames` frames of each traceback. Only the last `keep` snapshots stay
+    in memory, every one is saved to disk.
+    """
+
+    def __init__(
+        self, directory="heap-snapshots", frames=1, keep=3, max_duration=3600
+    ):
+        # type: (str, int, int, float) -> None
+        self.directory = directory
+        self.frames = frames
+        self.keep = keep
+        self.max_duration = max_duration
+        self.snapshots = []  # type: list
+        self.taken = 0
+        # bumped every start, so a stale timer can't stop a newer session
+        self.session = 0
+
+    @property
+    def tracing(self):
+        # type: () -> bool
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        # type: () -> float
+        """Starts tracing, returns how long it will run for."""
+
+        if self.tracing:
+            raise RuntimeError("Allocations are already being traced.")
+
+        self.snapshots = []
+        tracemalloc.start(self.frames)
+        self.session += 1
+        return self.max_duration
+
+    def stop(self):
+        # type: () -> None
+        tracemalloc.stop()
+        self.snapshots = []
+
+    async def snapshot(self):
+        # type: () -> str
+        """Takes a snapshot and saves it, returns the file written."""
+
+        if not self.tracing:
+            raise RuntimeError("Allocations aren't being traced.")
+
+        # only copying the traces happens on the event loop
+        raw = tracemalloc.take_snapshot()
+        self.taken += 1
+        path = os.path.join(
+            self.directory,
+            "{0}-{1}.snapshot".format(strftime("%Y%m%d-%H%M%S"), self.taken),
+        )
+        snapshot = await get_event_loop().run_in_executor(
+            None, save, raw, path
+        )
+        self.snapshots.append((path, snapshot))
+        del self.snapshots[: -self.keep]
+        return path
+
+    async def summary(self, top=10):
+        # type: (int) -> str
+        """The lines that allocated the most in the latest snapshot."""
+
+        if len(self.snapshots) == 0:
+            return "No snapshots yet."
+        return await get_event_loop().run_in_executor(
+            None, summarize, self.snapshots[-1][1], top
+        )
+
+    async def diff(self, top=10, against=0):
+        # type: (int, int) -> tuple
+        """
+        Compares the latest snapshot with an earlier one, by line.
+
+        Saves the whole diff next to the snapshot, and returns the file and
+        the `top` lines that grew or shrank the most.
+        """
+
+        if len(self.snapshots) < 2:
+            raise RuntimeError("Take at least two snapshots first.")
+        # -1 is the latest snapshot itself
+        if (
+            not -len(self.snapshots) <= against < len(self.snapshots) - 1
+            or against == -1
+        ):
+            raise ValueError("There's no snapshot with that number.")
+
+        path, latest = self.snapshots[-1]
+        return await get_event_loop().run_in_executor(
+            None, compare, latest, self.snapshots[against][1], path, top
+        )
+
+
+# these are slow on a big heap, so they run in worker threads
+
+
+def save(raw, path):
+    # type: (Any, str) -> Any
+    """Filters out the noise from a snapshot, and dumps it to `path`."""
+
+    snapshot = raw.filter_traces(IGNORED)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    snapshot.dump(path)
+    return snapshot
+
+
+def summarize(snapshot, top):
+    # type: (Any, int) -> str
+    stats = snapshot.statistics("lineno")
+    lines = [
+        "{0:>10} {1:>7} {2}".format(
+            size(stat.size), stat.count, where(stat.traceback)
+        )
+        for stat in stats[:top]
+    ]
+    lines.append(
+        "{0:>10} total".format(size(sum(stat.size for stat in stats)))
+    )
+    return "\n".join(lines)
+
+
+def compare(latest, earlier, path, top):
+    # type: (Any, Any, str, int) -> tuple
+    stats = latest.compare_to(earlier, "lineno")
+    lines = [
+        "{0:>11} {1:>+7} {2}".format(
+            ("+" if stat.size_diff >= 0 else "-") + size(abs(stat.size_diff)),
+            stat.count_diff,
+            where(stat.traceback),
+        )
+        for stat in stats
+        if stat.size_diff != 0 or stat.count_diff != 0
+    ]
+
+    diff_path = os.path.splitext(path)[0] + ".diff.txt"
+    with open(diff_path, "w") as diff_file:
+        diff_file.write("\n".join(lines) + "\n")
+    if len(lines) == 0:
+        return diff_path, "Nothing changed."
+    return diff_path, "\n".join(lines[:top])
@@ -0,0 +1,139 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from asyncio import TimeoutError, sleep
+from time import perf_counter
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from . import Metrics
+
+# statuses that are worth trying again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class Response:
+    """The parts of an HTTP response we care about."""
+
+    __slots__ = ("status", "headers", "data")
+
+    def __init__(self, status, headers, data):
+        # type: (int, Any, Any) -> None
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+
+class HttpClient:
+    """
+    One pooled HTTP session, shared by every command that calls an API.
+
+    Connections are kept alive between requests. `rewrites` maps URL
+    prefixes to other ones, which lets tests point the bot at local stub
+    servers.
+    """
+
+    def __init__(
+        self,
+        limit=100,
+        limit_per_host=10,
+        timeout=10,
+        retries=2,
+        backoff=0.5,
+        rewrites=None,
+    ):
+        # type: (int, int, float, int, float, dict) -> None
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rewrites = rewrites or {}
+        self.session = None  # type: Optional[ClientSession]
+
+    def _session(self):
+        # type: () -> ClientSession
+        # created lazily, aiohttp wants a running event loop for this
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=30,
+                ),
+                timeout=ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    def _rewrite(self, url):
+        # type: (str) -> str
+        for prefix, replacement in self.rewrites.items():
+            if url.startswith(prefix):
+                return replacement + url[len(prefix) :]
+        return url
+
+    async def request(self, method, url, headers=None):
+        # type: (str, str, dict) -> Response
+        """
+        Sends a request, retrying with exponential backoff on failure.
+
+        The body is decoded as JSON when the server says it is JSON.
+        """
+
+        host = urlsplit(url).hostname
+        url = self._rewrite(url)
+        attempt = 0
+        while True:
+            start = perf_counter()
+            try:
+                async with self._session().request(
+                    method, url, headers=headers
+                ) as resp:
+                    if (
+                        resp.status in RETRY_STATUSES
+                        and attempt < self.retries
+                    ):
+                        raise ClientError(f"HTTP {resp.status} from {url}")
+
+                    data = None
+                    if resp.content_type == "application/json":
+                        data = await resp.json()
+                    Metrics.upstream_seconds.observe(
+                        perf_counter() - start, host
+                    )
+                    if resp.status >= 400:
+                        Metrics.upstream_errors_total.inc(host)
+                    return Response(resp.status, resp.headers, data)
+            except (ClientError, TimeoutError):
+                Metrics.upstream_seconds.observe(perf_counter() - start, host)
+                Metrics.upstream_errors_total.inc(host)
+                if attempt >= self.retries:
+                    raise
+            await sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def get(self, url, headers=None):
+        # type: (str, dict) -> Response
+        return await self.request("GET", url, headers=headers)
+
+    async def close(self):
+        # type: () -> None
+        if self.session is not None:
+            await self.session.close()
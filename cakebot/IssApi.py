@@ -16,15 +16,67 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from requests import get
+from asyncio import ensure_future, shield
+from time import time
+from typing import Any, Optional
+
+API_URL = "http://api.open-notify.org/iss-now.json"
 
 
 class IssLocater:
-    """A class that fetches the data from the API to find where the ISS is."""
+    """A class that holds where the API says the ISS is."""
 
-    def __init__(self):
+    def __init__(self, obj):
+        # type: (dict) -> None
         """Creates a new instance of the class."""
 
-        obj = get("http://api.open-notify.org/iss-now.json").json()
         self.lat = obj["iss_position"]["latitude"]
         self.lon = obj["iss_position"]["longitude"]
+        self.fetched_at = time()
+
+    def age(self):
+        # type: () -> float
+        """How many seconds ago this position was fetched."""
+
+        return time() - self.fetched_at
+
+
+async def locate(http):
+    # type: (Any) -> IssLocater
+    """Fetches the data from the API to find where the ISS is."""
+
+    return IssLocater((await http.get(API_URL)).data)
+
+
+class PositionCache:
+    """
+    Remembers where the ISS is for `ttl` seconds.
+
+    Callers that arrive while a fetch is already running wait for that
+    fetch instead of starting their own, so a burst of `+iss` commands
+    only makes one upstream request.
+    """
+
+    def __init__(self, ttl=5):
+        # type: (float) -> None
+        self.ttl = ttl
+        self.position = None  # type: Optional[IssLocater]
+        self.inflight = None  # type: Any
+
+    async def get(self, http):
+        # type: (Any) -> IssLocater
+        if self.position is not None and self.position.age() < self.ttl:
+            return self.position
+
+        if self.inflight is None:
+            self.inflight = ensure_future(self._fetch(http))
+        # one impatient caller being cancelled shouldn't cancel the others
+        return await shield(self.inflight)
+
+    async def _fetch(self, http):
+        # type: (Any) -> IssLocater
+        try:
+            self.position = await locate(http)
+            return self.position
+        finally:
+            self.inflight = None
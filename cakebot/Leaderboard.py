@@ -0,0 +1,194 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Any
+
+
+class CountIndex:
+    """
+    Users ranked by cookie count, kept up to date one change at a time.
+
+    A Fenwick tree counts how many users have each cookie count, so the
+    number of users ahead of someone, or the count at a given position,
+    takes O(log max count). Users with the same count sit in a bucket in
+    the order they reached it, which is also how ties are broken.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        self.size = 64
+        self.tree = [0] * (self.size + 1)
+        # count -> {user: None}, a dict to keep the order users arrived in
+        self.buckets = {}  # type: dict
+        self.counts = {}  # type: dict
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.counts)
+
+    def _add(self, count, delta):
+        # type: (int, int) -> None
+        while count <= self.size:
+            self.tree[count] += delta
+            count += count & -count
+
+    def _prefix(self, count):
+        # type: (int) -> int
+        """How many users have `count` cookies or fewer."""
+
+        total = 0
+        count = min(count, self.size)
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def _grow(self, count):
+        # type: (int) -> None
+        while self.size < count:
+            self.size *= 2
+        self.tree = [0] * (self.size + 1)
+        for bucket_count, bucket in self.buckets.items():
+            self.tree[bucket_count] = len(bucket)
+        for index in range(1, self.size + 1):
+            parent = index + (index & -index)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[index]
+
+    def _kth(self, k):
+        # type: (int) -> int
+        """The count of the `k`th user, counting up from the fewest."""
+
+        position = 0
+        step = self.size
+        while step > 0:
+            if (
+                position + step <= self.size
+                and self.tree[position + step] < k
+            ):
+                position += step
+                k -= self.tree[position]
+            step //= 2
+        return position + 1
+
+    def set(self, user, count):
+        # type: (int, int) -> None
+        old = self.counts.get(user, 0)
+        if old == count:
+            return
+
+        if old > 0:
+            bucket = self.buckets[old]
+            del bucket[user]
+            if len(bucket) == 0:
+                del self.buckets[old]
+            self._add(old, -1)
+
+        if count > 0:
+            self.counts[user] = count
+            self.buckets.setdefault(count, {})[user] = None
+            if count > self.size:
+                self._grow(count)
+            else:
+                self._add(count, 1)
+        else:
+            del self.counts[user]
+
+    def rank(self, user):
+        # type: (int) -> Any
+        """The user's (rank, count), or None if they have no cookies."""
+
+        count = self.counts.get(user)
+        if count is None:
+            return None
+        return len(self.counts) - self._prefix(count) + 1, count
+
+    def top(self, n):
+        # type: (int) -> list
+        """The `n` users with the most cookies, as (user, count)."""
+
+        result = []  # type: list
+        total = len(self.counts)
+        while len(result) < min(n, total):
+            count = self._kth(total - len(result))
+            for user in self.buckets[count]:
+                result.append((user, count))
+                if len(result) == n:
+                    break
+        return result
+
+
+class Leaderboard:
+    """A global index, plus one for every guild cookies were given in."""
+
+    def __init__(self):
+        # type: () -> None
+        self.everyone = CountIndex()
+        self.guilds = {}  # type: dict
+
+    def record(self, user, count, guilds=()):
+        # type: (int, int, Any) -> None
+        self.everyone.set(user, count)
+        for guild in guilds:
+            index = self.guilds.get(guild)
+            if index is None:
+                index = self.guilds[guild] = CountIndex()
+            index.set(user, count)
+
+    def _index(self, guild):
+        # type: (Any) -> Any
+        if guild is None:
+            return self.everyone
+        return self.guilds.get(guild)
+
+    def top(self, n, guild=None):
+        # type: (int, Any) -> list
+        index = self._index(guild)
+        return [] if index is None else index.top(n)
+
+    def rank(self, user, guild=None):
+        # type: (int, Any) -> Any
+        index = self._index(guild)
+        return None if index is None else index.rank(user)
+
+
+class TopCache:
+    """Remembers leaderboards for `ttl` seconds, for the busy guilds."""
+
+    def __init__(self, ttl=30, size=256):
+        # type: (float, int) -> None
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()  # type: OrderedDict
+
+    def get(self, key, compute):
+        # type: (Any, Any) -> Any
+        entry = self.entries.get(key)
+        now = monotonic()
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        value = compute()
+        self.entries[key] = (now + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
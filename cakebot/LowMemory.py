@@ -0,0 +1,87 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Any
+
+from discord import Intents, MemberCacheFlags
+
+# the gateway events our commands actually use
+INTENTS = ("guilds", "guild_messages", "dm_messages")
+
+# the intent discord.py needs for each member cache flag
+MEMBER_CACHE_INTENTS = {
+    "online": "presences",
+    "voice": "voice_states",
+    "joined": "members",
+}
+
+
+def client_options(low_memory=False, max_messages=None, member_cache=None):
+    # type: (bool, Any, Any) -> dict
+    """
+    The client's keyword arguments for the memory settings in the config.
+
+    In low memory mode, the bot only asks for the intents in `INTENTS`,
+    doesn't cache members or messages, and doesn't chunk guilds at
+    startup. `max_messages` (0 for no cache) and `member_cache` (a list of
+    member cache flags) override either mode. Each flag in `member_cache`
+    also turns on the intent it needs, which for "online" and "joined" is
+    a privileged one.
+    """
+
+    options = {}  # type: dict
+    if low_memory:
+        intents = Intents.none()
+        for name in INTENTS:
+            setattr(intents, name, True)
+        options["intents"] = intents
+        options["member_cache_flags"] = MemberCacheFlags.none()
+        options["chunk_guilds_at_startup"] = False
+        options["max_messages"] = None
+
+    if max_messages is not None:
+        # discord.py treats 0 as the default size, None turns it off
+        options["max_messages"] = max_messages or None
+    if member_cache is not None:
+        flags = MemberCacheFlags.none()
+        intents = options.get("intents", Intents.default())
+        for name in member_cache:
+            if name not in MEMBER_CACHE_INTENTS:
+                raise ValueError(
+                    "Unknown member cache flag {0}, expected one of {1}".format(
+                        name, ", ".join(MEMBER_CACHE_INTENTS)
+                    )
+                )
+            setattr(flags, name, True)
+            setattr(intents, MEMBER_CACHE_INTENTS[name], True)
+        if flags.voice and flags.online and not flags.joined:
+            raise ValueError(
+                'The "voice" and "online" member caches need "joined" too'
+            )
+        options["intents"] = intents
+        options["member_cache_flags"] = flags
+    return options
+
+
+async def owner(guild):
+    # type: (Any) -> Any
+    """The guild's owner, fetched if they aren't in the member cache."""
+
+    if guild.owner is not None:
+        return guild.owner
+    return await guild.fetch_member(guild.owner_id)
@@ -0,0 +1,269 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from asyncio import get_event_loop, sleep
+from bisect import bisect_left
+from typing import Any
+
+# in seconds, fine enough for anything from a dict lookup to a slow API
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value):
+    # type: (Any) -> str
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _labels(names, values, extra=""):
+    # type: (tuple, tuple, str) -> str
+    pairs = [
+        '{0}="{1}"'.format(name, _escape(value))
+        for name, value in zip(names, values)
+    ]
+    if extra != "":
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """A number that only goes up, per set of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        # type: (str, str, tuple) -> None
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # type: dict
+
+    def inc(self, *labels, amount=1):
+        # type: (Any, float) -> None
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        # type: () -> list
+        return [
+            "{0}{1} {2}".format(self.name, _labels(self.labels, key), value)
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    """A number that can go up and down, per set of label values."""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        # type: (float, Any) -> None
+        self.values[labels] = value
+
+
+class Histogram:
+    """
+    Counts observations into buckets, per set of label values.
+
+    Only the bucket an observation lands in is incremented, the
+    cumulative counts Prometheus wants are added up when rendering.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        # type: (str, str, tuple, tuple) -> None
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.values = {}  # type: dict
+
+    def observe(self, value, *labels):
+        # type: (float, Any) -> None
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        # type: () -> list
+        lines = []
+        for key, series in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(
+                    "{0}_bucket{1} {2}".format(
+                        self.name,
+                        _labels(self.labels, key, 'le="{0}"'.format(bound)),
+                        total,
+                    )
+                )
+            lines.append(
+                "{0}_sum{1} {2}".format(
+                    self.name, _labels(self.labels, key), series[-1]
+                )
+            )
+            lines.append(
+                "{0}_count{1} {2}".format(
+                    self.name, _labels(self.labels, key), total
+                )
+            )
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric, and renders them in Prometheus' text format."""
+
+    def __init__(self):
+        # type: () -> None
+        self.metrics = []  # type: list
+        # called before rendering, to refresh gauges that are pulled
+        self.collectors = []  # type: list
+
+    def add(self, metric):
+        # type: (Any) -> Any
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # type: () -> str
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+commands_total = registry.add(
+    Counter(
+        "cakebot_commands_total",
+        "Commands run, by command and outcome.",
+        ("command", "outcome"),
+    )
+)
+command_seconds = registry.add(
+    Histogram(
+        "cakebot_command_seconds",
+        "How long commands took to handle.",
+        ("command",),
+    )
+)
+upstream_seconds = registry.add(
+    Histogram(
+        "cakebot_upstream_seconds",
+        "How long calls to upstream APIs took.",
+        ("host",),
+    )
+)
+upstream_errors_total = registry.add(
+    Counter(
+        "cakebot_upstream_errors_total",
+        "Failed calls to upstream APIs.",
+        ("host",),
+    )
+)
+shard_latency_seconds = registry.add(
+    Gauge(
+        "cakebot_shard_latency_seconds",
+        "Gateway heartbeat latency, by shard.",
+        ("shard",),
+    )
+)
+loop_lag_seconds = registry.add(
+    Histogram(
+        "cakebot_event_loop_lag_seconds",
+        "How late the event loop was to wake up a sleeping task.",
+    )
+)
+
+loop_stalls_total = registry.add(
+    Counter(
+        "cakebot_event_loop_stalls_total",
+        "Times the event loop was blocked, by command and location.",
+        ("command", "location"),
+    )
+)
+outbox_messages_total = registry.add(
+    Counter(
+        "cakebot_outbox_messages_total",
+        "What the outbox did with replies: sent, merged or placeholders.",
+        ("outcome",),
+    )
+)
+
+
+async def watch_loop_lag(interval=0.5):
+    # type: (float) -> None
+    """Measures how late the event loop runs a task that asked to sleep."""
+
+    loop = get_event_loop()
+    while True:
+        start = loop.time()
+        await sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - start - interval))
+
+
+async def serve(host="127.0.0.1", port=9100):
+    # type: (str, int) -> Any
+    """Serves the metrics over HTTP at /metrics, returns the runner."""
+
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(
+            body=registry.render().encode("utf-8"),
+            headers={
+                "Content-Type": "text/plain; version=0.0.4; charset=utf-8"
+            },
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
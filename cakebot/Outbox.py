@@ -0,0 +1,235 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from asyncio import ensure_future, get_event_loop
+from heapq import heappop, heappush
+from itertools import count
+from typing import Any
+
+from . import Metrics
+
+# lower goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+QUEUED = 0
+SENDING = 1
+DROPPED = 2
+
+
+class Outgoing:
+    """A message waiting in a channel's queue."""
+
+    __slots__ = (
+        "content",
+        "kwargs",
+        "future",
+        "mergeable",
+        "origin",
+        "state",
+    )
+
+    def __init__(self, content, kwargs, mergeable, origin=None):
+        # type: (Any, dict, bool, Any) -> None
+        self.content = content
+        self.kwargs = kwargs
+        self.future = get_event_loop().create_future()
+        # plain text that can share a message with other plain text
+        self.mergeable = mergeable
+        # what it replies to, only replies to the same thing are joined
+        self.origin = origin
+        self.state = QUEUED
+
+
+class Placeholder:
+    """A "working on it" message that might never need to be sent."""
+
+    __slots__ = ("channel", "content", "handle", "outgoing")
+
+    def __init__(self, channel, content):
+        # type: (Any, str) -> None
+        self.channel = channel
+        self.content = content
+        self.handle = None  # type: Any
+        self.outgoing = None  # type: Any
+
+
+class Outbox:
+    """
+    Sends messages through one queue per channel.
+
+    Each channel gets a worker that sends one message at a time,
+    interactive replies before background posts. Text replies to the
+    same message that pile up while a send is in flight are joined into
+    a single message, as long as it stays under Discord's length limit.
+    """
+
+    def __init__(self, max_length=2000, placeholder_delay=1.0):
+        # type: (int, float) -> None
+        self.max_length = max_length
+        self.placeholder_delay = placeholder_delay
+        # channel -> heap of (priority, order, Outgoing)
+        self.queues = {}  # type: dict
+        self.order = count()
+
+    def _enqueue(self, channel, outgoing, priority):
+        # type: (Any, Outgoing, int) -> Outgoing
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = []
+            ensure_future(self._work(channel, queue))
+        heappush(queue, (priority, next(self.order), outgoing))
+        return outgoing
+
+    async def send(
+        self,
+        channel,
+        content=None,
+        priority=INTERACTIVE,
+        origin=None,
+        **kwargs
+    ):
+        # type: (Any, Any, int, Any, Any) -> Any
+        """
+        Queues a message, and returns it once it's been sent.
+
+        `origin` is the ID of the message being replied to. Replies
+        without one are never joined with anything.
+        """
+
+        mergeable = (
+            origin is not None
+            and isinstance(content, str)
+            and len(kwargs) == 0
+            and len(content) < self.max_length
+        )
+        outgoing = Outgoing(content, kwargs, mergeable, origin)
+        return await self._enqueue(channel, outgoing, priority).future
+
+    def _take(self, queue):
+        # type: (list) -> list
+        """Pops the next message, plus any text that can join it."""
+
+        priority, _, first = heappop(queue)
+        batch = [first]
+        if not first.mergeable:
+            return batch
+
+        length = len(first.content)
+        while len(queue) > 0:
+            next_priority, _, outgoing = queue[0]
+            if outgoing.state == DROPPED:
+                heappop(queue)
+                continue
+            if (
+                next_priority != priority
+                or not outgoing.mergeable
+                or outgoing.origin != first.origin
+                or length + 1 + len(outgoing.content) > self.max_length
+            ):
+                break
+            heappop(queue)
+            batch.append(outgoing)
+            length += 1 + len(outgoing.content)
+        return batch
+
+    async def _work(self, channel, queue):
+        # type: (Any, list) -> None
+        while len(queue) > 0:
+            batch = [
+                outgoing
+                for outgoing in self._take(queue)
+                if outgoing.state != DROPPED
+            ]
+            if len(batch) == 0:
+                continue
+            for outgoing in batch:
+                outgoing.state = SENDING
+
+            if len(batch) > 1:
+                Metrics.outbox_messages_total.inc("merged", amount=len(batch))
+                content = "\n".join(outgoing.content for outgoing in batch)
+            else:
+                content = batch[0].content
+
+            try:
+                message = await channel.send(content, **batch[0].kwargs)
+            except Exception as e:
+                for outgoing in batch:
+                    if not outgoing.future.done():
+                        outgoing.future.set_exception(e)
+            else:
+                Metrics.outbox_messages_total.inc("sent")
+                for outgoing in batch:
+                    if not outgoing.future.done():
+                        outgoing.future.set_result(message)
+        # nothing left, the next send to this channel starts a new worker
+        del self.queues[channel]
+
+    def placeholder(self, channel, content="Calculating..."):
+        # type: (Any, str) -> Placeholder
+        """
+        Shows a placeholder if the real reply takes a while.
+
+        It's only sent after `placeholder_delay` seconds, so fast replies
+        never send one at all.
+        """
+
+        placeholder = Placeholder(channel, content)
+        placeholder.handle = get_event_loop().call_later(
+            self.placeholder_delay, self._show, placeholder
+        )
+        return placeholder
+
+    def _show(self, placeholder):
+        # type: (Placeholder) -> None
+        placeholder.handle = None
+        placeholder.outgoing = self._enqueue(
+            placeholder.channel,
+            Outgoing(placeholder.content, {}, False),
+            INTERACTIVE,
+        )
+
+    async def replace(self, placeholder, content=None, **kwargs):
+        # type: (Placeholder, Any, Any) -> Any
+        """
+        Swaps a placeholder for the real reply.
+
+        A placeholder that hasn't gone out yet is dropped, and one that
+        has is edited, so it never takes a send and a delete.
+        """
+
+        if placeholder.handle is not None:
+            placeholder.handle.cancel()
+            placeholder.handle = None
+        outgoing = placeholder.outgoing
+        if outgoing is None or outgoing.state == QUEUED:
+            if outgoing is not None:
+                outgoing.state = DROPPED
+                outgoing.future.cancel()
+            Metrics.outbox_messages_total.inc("placeholder_dropped")
+            return await self.send(placeholder.channel, content, **kwargs)
+
+        try:
+            message = await outgoing.future
+        except Exception:
+            # the placeholder never made it, so send the reply instead
+            return await self.send(placeholder.channel, content, **kwargs)
+        Metrics.outbox_messages_total.inc("placeholder_edited")
+        await message.edit(content=content, **kwargs)
+        return message
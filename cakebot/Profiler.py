@@ -0,0 +1,130 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from contextvars import ContextVar
+from time import strftime
+from typing import Any
+
+# the command the running coroutine is handling, set by the dispatcher
+current_command = ContextVar("current_command", default="")  # type: Any
+
+
+class Profiler:
+    """
+    Runs one time-bounded yappi session at a time.
+
+    Every function call is tagged with the command that caused it, so the
+    stats can be split up by command when the session is saved.
+    """
+
+    def __init__(self, directory="profiles", max_duration=300):
+        # type: (str, float) -> None
+        self.directory = directory
+        self.max_duration = max_duration
+        self.running = False
+        self.clock = "cpu"
+        self.tags = {}  # type: dict
+        # bumped every start, so a stale timer can't stop a newer session
+        self.session = 0
+
+    def _tag(self):
+        # type: () -> int
+        name = current_command.get()
+        if name == "":
+            return 0
+        tag = self.tags.get(name)
+        if tag is None:
+            tag = self.tags[name] = len(self.tags) + 1
+        return tag
+
+    def start(self, clock="cpu", duration=60):
+        # type: (str, float) -> float
+        """Starts a session, returns how long it will really run for."""
+
+        import yappi
+
+        if self.running:
+            raise RuntimeError("A profiling session is already running.")
+        if clock not in {"cpu", "wall"}:
+            raise ValueError("The clock has to be either cpu or wall.")
+
+        self.tags = {}
+        self.clock = clock
+        yappi.clear_stats()
+        yappi.set_clock_type(clock)
+        yappi.set_tag_callback(self._tag)
+        yappi.start()
+        self.running = True
+        self.session += 1
+        return min(max(duration, 1), self.max_duration)
+
+    def stop(self):
+        # type: () -> list
+        """Stops the session and saves it, returns the files written."""
+
+        import yappi
+
+        yappi.stop()
+        yappi.set_tag_callback(None)
+        self.running = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(
+            self.directory, strftime("%Y%m%d-%H%M%S") + "-" + self.clock
+        )
+        stats = yappi.get_func_stats()
+        paths = [base + ".pstats", base + ".callgrind"]
+        stats.save(paths[0], type="pstat")
+        stats.save(paths[1], type="callgrind")
+
+        for name, tag in self.tags.items():
+            path = "{0}-{1}.pstats".format(base, name)
+            yappi.get_func_stats(filter={"tag": tag}).save(path, type="pstat")
+            paths.append(path)
+        return paths
+
+    def summary(self, top=10, command=None):
+        # type: (int, str) -> str
+        """The functions with the most total time in the last session."""
+
+        import yappi
+
+        if command is not None:
+            if command not in self.tags:
+                return "That command didn't run during the last session."
+            stats = yappi.get_func_stats(filter={"tag": self.tags[command]})
+        else:
+            stats = yappi.get_func_stats()
+
+        lines = []
+        for index, stat in enumerate(stats.sort("ttot", "desc")):
+            if index >= top:
+                break
+            lines.append(
+                "{0:>9.4f}s {1:>7} {2} ({3}:{4})".format(
+                    stat.ttot,
+                    stat.ncall,
+                    stat.name,
+                    os.path.basename(stat.module),
+                    stat.lineno,
+                )
+            )
+        if len(lines) == 0:
+            return "No profiling data yet."
+        return "\n".join(lines)
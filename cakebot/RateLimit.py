@@ -0,0 +1,139 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from time import monotonic
+from typing import Any
+
+# what `RateLimiter.check` can say
+ALLOW = "allow"
+NOTIFY = "notify"
+DROP = "drop"
+
+
+class Bucket:
+    """One token bucket."""
+
+    __slots__ = ("tokens", "updated", "notified")
+
+    def __init__(self, tokens, now):
+        # type: (float, float) -> None
+        self.tokens = tokens
+        self.updated = now
+        self.notified = float("-inf")
+
+
+class Buckets:
+    """
+    Token buckets for one kind of key, like users or guilds.
+
+    Each bucket holds up to `burst` tokens and gets `rate` back a second.
+    A bucket that has been idle long enough to refill completely is the
+    same as a new one, so `sweep` throws those away.
+    """
+
+    def __init__(self, rate, burst):
+        # type: (float, float) -> None
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # type: dict
+
+    def get(self, key, now):
+        # type: (Any, float) -> Bucket
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+            )
+            bucket.updated = now
+        return bucket
+
+    def sweep(self, now):
+        # type: (float) -> None
+        full_after = self.burst / self.rate
+        for key in [
+            key
+            for key, bucket in self.buckets.items()
+            if now - bucket.updated >= full_after
+        ]:
+            del self.buckets[key]
+
+
+class RateLimiter:
+    """
+    Per-user, per-guild and global token buckets.
+
+    A command goes through only if every bucket it touches has enough
+    tokens for its cost. A cost bigger than a bucket's burst could never
+    be paid, so that bucket only has to be full. A user who gets throttled is told once per
+    `notice_interval` seconds, everything else is dropped quietly.
+    """
+
+    def __init__(
+        self,
+        user=None,
+        guild=None,
+        everyone=None,
+        costs=None,
+        notice_interval=30,
+        sweep_interval=60,
+    ):
+        # type: (dict, dict, dict, dict, float, float) -> None
+        # each is a dict with the bucket's rate (per second) and burst
+        self.users = Buckets(**(user or {"rate": 1, "burst": 5}))
+        self.guilds = Buckets(**(guild or {"rate": 5, "burst": 20}))
+        self.everyone = Buckets(**(everyone or {"rate": 40, "burst": 100}))
+        # overrides the cost commands were registered with
+        self.costs = costs or {}
+        self.notice_interval = notice_interval
+        self.sweep_interval = sweep_interval
+        self.swept = monotonic()
+
+    def check(self, user_id, guild_id, name, cost, now=None):
+        # type: (int, Any, str, float, float) -> str
+        """Says if a command can run, and takes its tokens if it can."""
+
+        if now is None:
+            now = monotonic()
+        if now - self.swept >= self.sweep_interval:
+            self.swept = now
+            for buckets in (self.users, self.guilds):
+                buckets.sweep(now)
+
+        cost = self.costs.get(name, cost)
+        user = self.users.get(user_id, now)
+        # (bucket, what it costs there)
+        touched = [
+            (user, min(cost, self.users.burst)),
+            (self.everyone.get(None, now), min(cost, self.everyone.burst)),
+        ]
+        if guild_id is not None:
+            touched.append(
+                (self.guilds.get(guild_id, now), min(cost, self.guilds.burst))
+            )
+
+        if all(bucket.tokens >= price for bucket, price in touched):
+            for bucket, price in touched:
+                bucket.tokens -= price
+            return ALLOW
+
+        if now - user.notified >= self.notice_interval:
+            user.notified = now
+            return NOTIFY
+        return DROP
@@ -0,0 +1,57 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from importlib import import_module, reload
+from typing import Any
+
+# modules that only hold code, so reloading them loses nothing. They're
+# reloaded in this order, so each one sees the new version of the ones
+# it imports, and the command handlers come last. Modules that own state
+# the bot is using (metrics, decks, content, the command registry) are
+# left alone. Objects made before a reload, like the ISS, repo and ticket
+# caches, keep the classes they were made with until the bot restarts.
+MODULES = (
+    "ColourUtil",
+    "EmbedUtil",
+    "UserUtil",
+    "Preconditions",
+    "TextCommandsUtil",
+    "IssApi",
+    "GitHubUtil",
+    "Handlers",
+)
+
+
+def modules(package="cakebot", names=MODULES):
+    # type: (str, Any) -> list
+    return [import_module(package + "." + name) for name in names]
+
+
+def reload_modules(to_reload):
+    # type: (list) -> None
+    """
+    Re-imports modules in place, so code using them gets the new version.
+
+    Everything is compiled first, so a syntax error stops the reload
+    before any module has changed.
+    """
+
+    for module in to_reload:
+        module.__spec__.loader.get_code(module.__name__)
+    for module in to_reload:
+        reload(module)
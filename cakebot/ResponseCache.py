@@ -0,0 +1,130 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from asyncio import get_event_loop
+from collections import OrderedDict
+from json import dumps, loads
+from sqlite3 import connect
+from threading import Lock
+from time import time
+from typing import Any
+
+
+class ResponseCache:
+    """
+    A cache of API responses, kept in an LRU in memory and in SQLite.
+
+    Responses live for `ttl` seconds (forever if it's None), negative
+    ones (for things the API doesn't know about) for `negative_ttl`.
+    SQLite is only used from worker threads, never the event loop.
+    """
+
+    def __init__(self, path, size=512, ttl=None, negative_ttl=3600):
+        # type: (str, int, float, float) -> None
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = OrderedDict()  # type: OrderedDict
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+        self.connection = connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires REAL)"
+        )
+
+    def _remember(self, key, payload, expires):
+        # type: (str, Any, Any) -> None
+        self.memory[key] = (payload, expires)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def _read(self, key):
+        # type: (str) -> Any
+        with self.lock:
+            return self.connection.execute(
+                "SELECT payload, expires FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _write(self, key, payload, expires):
+        # type: (str, str, Any) -> None
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, payload, expires) "
+                "VALUES (?, ?, ?)",
+                (key, payload, expires),
+            )
+
+    async def get(self, key):
+        # type: (str) -> Any
+        """Gets a cached response, or None if there isn't a fresh one."""
+
+        now = time()
+        entry = self.memory.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > now):
+            self.memory_hits += 1
+            self.memory.move_to_end(key)
+            return entry[0]
+
+        row = await get_event_loop().run_in_executor(None, self._read, key)
+        now = time()
+        if row is not None and (row[1] is None or row[1] > now):
+            self.disk_hits += 1
+            payload = loads(row[0])
+            self._remember(key, payload, row[1])
+            return payload
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, payload, negative=False):
+        # type: (str, Any, bool) -> None
+        """Caches a response, `negative` ones expire sooner."""
+
+        ttl = self.negative_ttl if negative else self.ttl
+        expires = None if ttl is None else time() + ttl
+        self._remember(key, payload, expires)
+        await get_event_loop().run_in_executor(
+            None, self._write, key, dumps(payload), expires
+        )
+
+    def stats(self):
+        # type: () -> dict
+        """Hit and miss counts since startup."""
+
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": 0
+            if lookups == 0
+            else (self.memory_hits + self.disk_hits) / lookups,
+        }
+
+    def close(self):
+        # type: () -> None
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,465 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from asyncio import Lock, sleep, wait_for
+from json import dumps, loads
+from sqlite3 import connect
+from time import perf_counter, time
+from typing import Any
+
+from click import secho
+from discord import AutoShardedClient, ClientUser
+from discord.gateway import DiscordWebSocket
+from discord.shard import Shard
+
+
+class SessionStore:
+    """
+    Each shard's gateway session, and the guilds it had, in SQLite.
+
+    The guilds are saved at the same time as the sequence number, so after
+    a RESUME, Discord replays exactly the events the saved guilds missed.
+    The newest message the shard handled is saved with them, to tell the
+    replayed messages we already answered from the ones we missed.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.connection = connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "shard INTEGER PRIMARY KEY, session TEXT NOT NULL, "
+            "sequence INTEGER, user TEXT NOT NULL, saved REAL NOT NULL, "
+            "handled INTEGER)"
+        )
+        columns = [
+            row[1]
+            for row in self.connection.execute("PRAGMA table_info(sessions)")
+        ]
+        if "handled" not in columns:
+            self.connection.execute(
+                "ALTER TABLE sessions ADD COLUMN handled INTEGER"
+            )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS guilds ("
+            "guild INTEGER PRIMARY KEY, shard INTEGER NOT NULL, "
+            "data TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS guilds_by_shard ON guilds (shard)"
+        )
+
+    def save(self, sessions, guilds=(), removed=(), replace=()):
+        # type: (Any, Any, Any, Any) -> None
+        """
+        Saves `sessions`, a (shard, session, sequence, handled, user) for
+        each shard, and `guilds`, (shard, payload) pairs, all at once.
+
+        The guilds with IDs in `removed` are forgotten, and so is every
+        other guild of the shards in `replace`.
+        """
+
+        saved = time()
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "DELETE FROM guilds WHERE shard = ?",
+                [(shard_id,) for shard_id in replace],
+            )
+            self.connection.executemany(
+                "DELETE FROM guilds WHERE guild = ?",
+                [(guild_id,) for guild_id in removed],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO guilds VALUES (?, ?, ?)",
+                [
+                    (guild["id"], shard_id, dumps(guild))
+                    for shard_id, guild in guilds
+                ],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        shard_id,
+                        session_id,
+                        sequence,
+                        dumps(user),
+                        saved,
+                        handled,
+                    )
+                    for shard_id, session_id, sequence, handled, user in sessions
+                ],
+            )
+
+    def load(self, shard_id, max_age):
+        # type: (int, float) -> Any
+        """
+        The shard's (session, sequence, handled, user, guilds), or None if
+        there isn't a session saved in the last `max_age` seconds.
+        """
+
+        row = self.connection.execute(
+            "SELECT session, sequence, handled, user FROM sessions "
+            "WHERE shard = ? AND saved >= ?",
+            (shard_id, time() - max_age),
+        ).fetchone()
+        if row is None:
+            return None
+
+        guilds = [
+            loads(data)
+            for data, in self.connection.execute(
+                "SELECT data FROM guilds WHERE shard = ?", (shard_id,)
+            )
+        ]
+        return row[0], row[1], row[2], loads(row[3]), guilds
+
+    def forget(self, shard_id):
+        # type: (int) -> None
+        self.connection.execute(
+            "DELETE FROM sessions WHERE shard = ?", (shard_id,)
+        )
+
+    def close(self):
+        # type: () -> None
+        self.connection.close()
+
+
+def guild_payload(guild):
+    # type: (Any) -> dict
+    """
+    What we need of a guild to run commands in it after a RESUME.
+
+    That's its details, text channels and default role. Members aren't
+    kept, commands fetch them when they need them.
+    """
+
+    permissions = guild.default_role.permissions.value
+    return {
+        "id": guild.id,
+        "name": guild.name,
+        "icon": guild.icon,
+        "region": str(guild.region),
+        "owner_id": guild.owner_id,
+        "member_count": guild.member_count,
+        "large": guild.large,
+        "mfa_level": guild.mfa_level,
+        "premium_subscription_count": guild.premium_subscription_count,
+        "roles": [
+            {
+                "id": guild.id,
+                "name": "@everyone",
+                "position": 0,
+                "permissions": permissions,
+                "permissions_new": str(permissions),
+            }
+        ],
+        "channels": [
+            {
+                "id": channel.id,
+                "type": 0,
+                "name": channel.name,
+                "position": channel.position,
+                "parent_id": channel.category_id,
+                "nsfw": channel.nsfw,
+                "permission_overwrites": [],
+            }
+            for channel in guild.text_channels
+        ],
+    }
+
+
+class ReadyTimes:
+    """How long each shard took to get ready, and whether it resumed."""
+
+    def __init__(self):
+        # type: () -> None
+        self.started = {}  # type: dict
+        self.resuming = set()  # type: set
+        self.times = {}  # type: dict
+
+    def launched(self, shard_id, resuming):
+        # type: (int, bool) -> None
+        self.started.setdefault(shard_id, perf_counter())
+        if resuming:
+            self.resuming.add(shard_id)
+
+    def ready(self, shard_id, how):
+        # type: (int, str) -> bool
+        """Records a shard getting ready, returns if it's the first time."""
+
+        if shard_id in self.times or shard_id not in self.started:
+            return False
+        if how == "identify" and shard_id in self.resuming:
+            how = "identify (resume failed)"
+        self.times[shard_id] = (perf_counter() - self.started[shard_id], how)
+        return True
+
+    def render(self):
+        # type: () -> str
+        return "\n".join(
+            "{0:<24} {1:>10.1f} ms  {2}".format(
+                "shard {0} ready".format(shard_id), seconds * 1000, how
+            )
+            for shard_id, (seconds, how) in sorted(self.times.items())
+        )
+
+
+# events after which a guild's saved payload is out of date
+GUILD_CHANGES = frozenset(
+    [
+        "guild_join",
+        "guild_available",
+        "guild_update",
+        "guild_role_update",
+        "guild_channel_create",
+        "guild_channel_update",
+        "guild_channel_delete",
+        "member_join",
+        "member_remove",
+    ]
+)
+
+
+class ResumingClient(AutoShardedClient):
+    """
+    A client that saves its shards' sessions, to RESUME them after a
+    restart instead of sending IDENTIFY.
+
+    It's off until `sessions` is set to a SessionStore. A shard whose
+    saved session is older than `max_age`, or that Discord won't resume,
+    identifies like normal. A shard's guilds are all saved with its first
+    save, after that only the ones that changed are.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # type: (Any, Any) -> None
+        super().__init__(*args, **kwargs)
+        self.sessions = None  # type: Any
+        self.max_age = 90.0
+        self.ready_times = ReadyTimes()
+        # the newest message each shard handled, saved with its session
+        self.handled = {}  # type: dict
+        # the newest message each shard handled before we restarted
+        self.answered = {}  # type: dict
+        # the guilds restored for each shard, until it resumes or not
+        self.restored = {}  # type: dict
+        # the session each shard's guilds were all saved with
+        self.saved_shards = {}  # type: dict
+        self.changed_guilds = set()  # type: set
+        self.removed_guilds = set()  # type: set
+        self.save_lock = Lock()
+
+    def _shards(self):
+        # type: () -> dict
+        return self._AutoShardedClient__shards  # type: ignore
+
+    async def launch_shard(self, gateway, shard_id, *, initial=False):
+        saved = None
+        if self.sessions is not None:
+            saved = self.sessions.load(shard_id, self.max_age)
+
+        options = {}  # type: dict
+        if saved is not None:
+            session_id, sequence, handled, user, guilds = saved
+            if handled is not None:
+                self.handled[shard_id] = self.answered[shard_id] = handled
+            state = self._connection
+            if state.user is None:
+                state.user = ClientUser(state=state, data=user)
+            self.restored[shard_id] = [
+                state._add_guild_from_data(data) for data in guilds
+            ]
+            options = {"session": session_id, "sequence": sequence}
+        self.ready_times.launched(shard_id, saved is not None)
+
+        try:
+            ws = await wait_for(
+                DiscordWebSocket.from_client(
+                    self,
+                    initial=initial,
+                    gateway=gateway,
+                    shard_id=shard_id,
+                    resume=saved is not None,
+                    **options,
+                ),
+                timeout=180.0,
+            )
+        except Exception as e:
+            secho(
+                "Couldn't connect shard {0} ({1}), retrying...".format(
+                    shard_id, e
+                ),
+                fg="yellow",
+            )
+            await sleep(5.0)
+            return await self.launch_shard(gateway, shard_id)
+
+        # keep reading the shard while others connect
+        shard = self._shards()[shard_id] = Shard(
+            ws, self, self._AutoShardedClient__queue.put_nowait  # type: ignore
+        )
+        shard.launch()
+
+    def dispatch(self, event, *args, **kwargs):
+        if self.sessions is not None and len(args) > 0:
+            if event == "guild_remove":
+                self.changed_guilds.discard(args[0].id)
+                self.removed_guilds.add(args[0].id)
+            elif event in GUILD_CHANGES:
+                # the guild itself, or the channel, role or member's guild
+                changed = getattr(args[-1], "guild", args[-1])
+                self.removed_guilds.discard(changed.id)
+                self.changed_guilds.add(changed.id)
+        super().dispatch(event, *args, **kwargs)
+
+    async def on_shard_connect(self, shard_id):
+        # READY means the RESUME failed. It replaces the guilds the shard
+        # still has, so the ones it doesn't replace were left while we
+        # were down, and the AutoShardedClient never clears them
+        state = self._connection
+        for guild in self.restored.pop(shard_id, ()):
+            if state._get_guild(guild.id) is guild:
+                state._remove_guild(guild)
+
+        # discord.py only sends shard_ready for shards that have guilds
+        if not any(guild.shard_id == shard_id for guild in self.guilds):
+            self.ready_times.ready(shard_id, "identify")
+
+    async def on_shard_ready(self, shard_id):
+        self.ready_times.ready(shard_id, "identify")
+
+    async def on_shard_resumed(self, shard_id):
+        self.restored.pop(shard_id, None)
+        if not self.ready_times.ready(shard_id, "resume"):
+            return
+        # Discord only sends READY after IDENTIFY, so if every shard
+        # resumed, nothing else will tell the bot it's ready
+        shard_ids = self.shard_ids or range(self.shard_count)
+        if all(
+            shard in self.ready_times.times for shard in shard_ids
+        ) and all(
+            how == "resume" for _, how in self.ready_times.times.values()
+        ):
+            # sets what is_ready and wait_until_ready wait on
+            self._connection.call_handlers("ready")
+            self.dispatch("ready")
+
+    def replayed(self, message):
+        # type: (Any) -> bool
+        """
+        If a message is one Discord replayed after a RESUME that we
+        answered before restarting. Otherwise, it's remembered as handled.
+        """
+
+        # direct messages come in on the first shard
+        shard_id = 0 if message.guild is None else message.guild.shard_id
+        if message.id <= self.answered.get(shard_id, 0):
+            return True
+        if message.id > self.handled.get(shard_id, 0):
+            self.handled[shard_id] = message.id
+        return False
+
+    def snapshot(self):
+        # type: () -> tuple
+        """
+        What to save, taken all at once so the guilds match the sequence
+        numbers. Only a shard with a new session has all its guilds in it.
+        """
+
+        sessions = []
+        if self.user is not None:
+            user = self.user._to_minimal_user_json()
+            sessions = [
+                (
+                    shard_id,
+                    shard.ws.session_id,
+                    shard.ws.sequence,
+                    self.handled.get(shard_id),
+                    user,
+                )
+                for shard_id, shard in self._shards().items()
+                if shard.ws.session_id is not None
+            ]
+
+        replace = set(
+            shard_id
+            for shard_id, session_id, _, _, _ in sessions
+            if self.saved_shards.get(shard_id) != session_id
+        )
+        changed = [
+            guild
+            for guild in map(self.get_guild, self.changed_guilds)
+            if guild is not None and guild.shard_id not in replace
+        ]
+        if len(replace) > 0:
+            changed += [
+                guild for guild in self.guilds if guild.shard_id in replace
+            ]
+        guilds = [(guild.shard_id, guild_payload(guild)) for guild in changed]
+        removed = list(self.removed_guilds)
+
+        self.changed_guilds.clear()
+        self.removed_guilds.clear()
+        for shard_id, session_id, _, _, _ in sessions:
+            self.saved_shards[shard_id] = session_id
+        return sessions, guilds, removed, list(replace)
+
+    async def save_sessions(self):
+        # type: () -> None
+        """Saves the sessions, writing to SQLite off the event loop."""
+
+        async with self.save_lock:
+            saving = self.snapshot()
+            try:
+                await self.loop.run_in_executor(
+                    None, self.sessions.save, *saving
+                )
+            except Exception:
+                # save everything again next time
+                self.saved_shards.clear()
+                self.removed_guilds.update(saving[2])
+                raise
+
+    async def close(self):
+        if self.sessions is not None and not self.is_closed():
+            shards = list(self._shards().values())
+            # stop reading events, so nothing happens after the save
+            for shard in shards:
+                shard._cancel_task()
+            await self.save_sessions()
+            # closing with 1000 would end the sessions for good
+            for shard in shards:
+                await shard.ws.close(code=4000)
+        await super().close()
+
+
+async def save_periodically(client, interval=30):
+    # type: (ResumingClient, float) -> None
+    """Saves the sessions every `interval` seconds, in case we crash."""
+
+    while True:
+        await sleep(interval)
+        try:
+            await client.save_sessions()
+        except Exception as e:
+            secho("Couldn't save the sessions ({0})".format(e), fg="yellow")
@@ -0,0 +1,98 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from contextlib import contextmanager
+from shutil import copyfile
+from time import perf_counter
+from typing import Any
+
+# the files that make up a store, besides its main one
+COMPANIONS = (".snapshot", "-wal")
+
+
+class Timeline:
+    """Records how long each phase of starting up took."""
+
+    def __init__(self):
+        # type: () -> None
+        self.last = perf_counter()
+        self.phases = []  # type: list
+
+    def mark(self, name):
+        # type: (str) -> None
+        """Ends a phase that started when the last one ended."""
+
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def add(self, name, seconds):
+        # type: (str, float) -> None
+        """Adds a phase that was timed somewhere else."""
+
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        # type: (str) -> Any
+        """Times the code in a `with` block as one phase."""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.last = perf_counter()
+            self.phases.append((name, self.last - start))
+
+    def has(self, name):
+        # type: (str) -> bool
+        return any(phase == name for phase, _ in self.phases)
+
+    def render(self):
+        # type: () -> str
+        lines = [
+            "{0:<24} {1:>10.1f} ms".format(name, seconds * 1000)
+            for name, seconds in self.phases
+        ]
+        lines.append(
+            "{0:<24} {1:>10.1f} ms".format(
+                "total", sum(seconds for _, seconds in self.phases) * 1000
+            )
+        )
+        return "\n".join(lines)
+
+
+def copy_stores(paths, directory):
+    # type: (list, str) -> list
+    """
+    Copies stores into `directory`, so they can be opened, and repaired or
+    migrated, without touching the ones a running bot is using. Returns
+    the paths of the copies.
+    """
+
+    copies = []
+    for number, path in enumerate(paths):
+        copy = os.path.join(
+            directory, "{0}-{1}".format(number, os.path.basename(path))
+        )
+        for suffix in ("",) + COMPANIONS:
+            if os.path.exists(path + suffix):
+                copyfile(path + suffix, copy + suffix)
+        copies.append(copy)
+    return copies
@@ -17,20 +17,23 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from random import choice
+from typing import Any
+from urllib.parse import quote
 
-from requests import get
+from cakebot import Decks, EmbedUtil
 
-from cakebot import EmbedUtil
+WORDSAPI_URL = "https://wordsapiv1.p.rapidapi.com/words/"
 
 
-def common(name):
-    # type: (str) -> str
-    """Load a content file and pick a random line from it (used a lot)."""
+def common(name, guild_id=None):
+    # type: (str, Any) -> str
+    """
+    Pick a line from a content file (used a lot).
 
-    fileobj = open("content/" + name + ".txt", mode="r")
-    lines = fileobj.readlines()
-    fileobj.close()
-    return choice(lines)
+    Each guild goes through its own shuffled deck of the lines.
+    """
+
+    return Decks.draw_content(name, guild_id)
 
 
 def noop():
@@ -57,28 +60,58 @@ def get_mentioned_id(args):
     return 0
 
 
-def define(args, token):
-    # type: (list, str) -> EmbedUtil.Embed
-    """Defines a word."""
+async def lookup_word(word, token, http, cache=None):
+    # type: (str, str, Any, Any) -> dict
+    """Gets the WordsAPI data for a word, from the cache when we can."""
+
+    key = word.strip().lower()
+    if cache is not None:
+        payload = await cache.get(key)
+        if payload is not None:
+            return payload
 
-    word = args[0]
     headers = {
         "x-rapidapi-host": "wordsapiv1.p.rapidapi.com",
         "x-rapidapi-key": token,
     }
-    definition = get(
-        "https://wordsapiv1.p.rapidapi.com/words/" + word, headers=headers
-    )
-    resp = definition.json()
+    resp = await http.get(WORDSAPI_URL + quote(key), headers=headers)
+    payload = resp.data if isinstance(resp.data, dict) else {}
+
+    # only cache real answers, not outages
+    if cache is not None and resp.status in {200, 404}:
+        await cache.put(key, payload, negative="results" not in payload)
+    return payload
+
+
+async def define(args, token, http, cache=None):
+    # type: (list, str, Any, Any) -> EmbedUtil.Embed
+    """Defines a word."""
+
+    word = args[0]
+    resp = await lookup_word(word, token, http, cache)
 
     e = EmbedUtil.prep(
         title=word.capitalize(), description="Data for this word:"
     )
+    return parse_define_json(e, resp)
+
+
+def parse_define_json(embed, json):
+    # type: (EmbedUtil.Embed, dict) -> EmbedUtil.Embed
+    """Fills in the `define` embed from the WordsAPI JSON."""
+
+    e = embed
+    if "results" not in json:
+        e.add_field(
+            name="Error", value="I don't think I know this word!", inline=True
+        )
+        return e
+
     try:
         e.add_field(
             name="Syllables",
             value=", ".join(
-                resp.get("syllables", {"list": ["unknown"]})["list"]
+                json.get("syllables", {"list": ["unknown"]})["list"]
             ),
             inline=True,
         )
@@ -87,17 +120,7 @@ def define(args, token):
             name="Error", value="I don't think I know this word!", inline=True
         )
 
-    e = parse_define_json(e, resp)
-    return e
-
-
-def parse_define_json(embed, json):
-    # type: (EmbedUtil.Embed, dict) -> EmbedUtil.Embed
-    """Parses the `results` of the `define` JSON."""
-
     definitions = json["results"]
-    e = embed
-
     for index, obj in enumerate(definitions[:8]):  # up to first 8 definitions
         e.add_field(
             name="Definition " + str(index + 1),
@@ -122,8 +145,8 @@ data_template = """\
 """
 
 
-def handle_common_commands(args, cmd):
-    # type: (list, str) -> str
+def handle_common_commands(args, cmd, guild_id=None):
+    # type: (list, str, Any) -> str
     """Handles certain simple commands."""
 
     if cmd == "pi":
@@ -133,7 +156,7 @@ def handle_common_commands(args, cmd):
         return choice(["**Heads**.", "**Tails**."])
 
     elif cmd == "8":
-        return common("8ball")
+        return common("8ball", guild_id)
 
     elif cmd == "clapify":
         return " :clap: ".join(args)
@@ -142,6 +165,6 @@ def handle_common_commands(args, cmd):
         return " ".join(args)
 
     elif cmd == "joke":
-        return common("jokes")
+        return common("jokes", guild_id)
 
     return ""
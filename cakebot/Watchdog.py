@@ -0,0 +1,135 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+from asyncio import sleep
+from threading import Lock, Thread, get_ident
+from time import monotonic
+from time import sleep as thread_sleep
+from traceback import format_stack
+from typing import Any
+
+from click import secho
+
+from . import Metrics
+from .Commands import Context
+
+
+class Watchdog:
+    """
+    Watches the event loop from another thread.
+
+    A task on the loop updates a timestamp every `interval` seconds. If
+    the timestamp gets older than `threshold`, something is blocking the
+    loop, so the watchdog grabs the loop thread's stack, works out which
+    command was running from it, and counts the stall against that
+    command and the line it was stuck on.
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1):
+        # type: (float, float) -> None
+        self.threshold = threshold
+        self.interval = interval
+        self.beat = monotonic()
+        self.loop_thread = None  # type: Any
+        self.running = False
+        # (command, location) -> number of stalls, written by the watching
+        # thread and read on the loop, so only touched under the lock
+        self.stalls = {}  # type: dict
+        self.lock = Lock()
+
+    async def heartbeat(self):
+        # type: () -> None
+        """Runs on the event loop, and starts the watching thread."""
+
+        self.loop_thread = get_ident()
+        self.beat = monotonic()
+        self.running = True
+        Thread(target=self._watch, name="watchdog", daemon=True).start()
+        try:
+            while True:
+                self.beat = monotonic()
+                await sleep(self.interval)
+        finally:
+            self.running = False
+
+    def _watch(self):
+        # type: () -> None
+        reported = 0.0
+        while self.running:
+            thread_sleep(self.interval)
+            beat = self.beat
+            stalled = monotonic() - beat
+            # only report each stall once
+            if stalled > self.threshold and beat != reported:
+                reported = beat
+                self._report(stalled)
+
+    def _report(self, stalled):
+        # type: (float) -> None
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return
+
+        stack = format_stack(frame)
+        location = "{0}:{1} in {2}".format(
+            os.path.basename(frame.f_code.co_filename),
+            frame.f_lineno,
+            frame.f_code.co_name,
+        )
+        ctx = find_context(frame)
+        command = "(none)" if ctx is None else ctx.command.name
+
+        key = (command, location)
+        with self.lock:
+            self.stalls[key] = self.stalls.get(key, 0) + 1
+        Metrics.loop_stalls_total.inc(command, location)
+
+        detail = ""
+        if ctx is not None:
+            detail = " from message {0} by {1}: {2!r}".format(
+                ctx.message.id, ctx.message.author.id, ctx.message.content
+            )
+        secho(
+            "Event loop blocked for {0:.2f}s by `{1}`{2}\n{3}".format(
+                stalled, command, detail, "".join(stack[-8:])
+            ),
+            fg="yellow",
+            err=True,
+        )
+
+    def top(self, n=10):
+        # type: (int) -> list
+        """The places that stalled the loop the most."""
+
+        with self.lock:
+            stalls = list(self.stalls.items())
+        return sorted(stalls, key=lambda item: -item[1])[:n]
+
+
+def find_context(frame):
+    # type: (Any) -> Any
+    """Finds the command context in a stack, if a command is running."""
+
+    while frame is not None:
+        ctx = frame.f_locals.get("ctx")
+        if isinstance(ctx, Context):
+            return ctx
+        frame = frame.f_back
+    return None
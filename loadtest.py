@@ -0,0 +1,436 @@
+"""
+Cakebot - A cake themed Discord bot
+Copyright (C) 2019-current year  Reece Dunham
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import os
+import socket
+from datetime import datetime
+from random import Random
+from sys import exit as _exit
+from tempfile import TemporaryDirectory
+from typing import Any
+
+from click import command, option, secho
+
+DEFAULT_MIX = (
+    "ping=4,help=1,coinflip=2,joke=2,fact=1,iss=2,define=2,"
+    + "stars=1,cookie=2,info=1"
+)
+
+WORDS = ("cake", "pie", "cookie", "muffin", "scone", "qwxz")
+
+REPOS = ("cakebotpro/cakebot", "python/cpython", "aio-libs/aiohttp")
+
+# what to send for each command, given a random generator and the author
+MESSAGES = {
+    "ping": lambda rng, user: "ping",
+    "help": lambda rng, user: "help",
+    "invite": lambda rng, user: "invite",
+    "info": lambda rng, user: "info",
+    "pi": lambda rng, user: "pi",
+    "coinflip": lambda rng, user: "coinflip",
+    "joke": lambda rng, user: "joke",
+    "fact": lambda rng, user: "fact",
+    "8": lambda rng, user: "8 will this be fast",
+    "say": lambda rng, user: "say hello there",
+    "clapify": lambda rng, user: "clapify make it fast",
+    "iss": lambda rng, user: "iss",
+    "define": lambda rng, user: "define " + rng.choice(WORDS),
+    "stars": lambda rng, user: "stars " + rng.choice(REPOS),
+    "homepage": lambda rng, user: "homepage " + rng.choice(REPOS),
+    "report": lambda rng, user: "report load test " + str(rng.random()),
+    "cookie": lambda rng, user: rng.choice(
+        ["cookie bal", "cookie give <@!{0}>".format(user + 1)]
+    ),
+}
+
+
+class Author:
+    """A fake user."""
+
+    bot = False
+
+    def __init__(self, id):
+        # type: (int) -> None
+        self.id = id
+        self.mention = "<@!{0}>".format(id)
+
+    def __str__(self):
+        return "loadtest#{0}".format(self.id % 10000)
+
+
+class Guild:
+    """A fake server, with just what the commands look at."""
+
+    region = "us-east"
+    premium_subscription_count = 0
+    mfa_level = 0
+    large = False
+    created_at = datetime(2019, 1, 1)
+    shard_id = 0
+
+    def __init__(self, id, member_count):
+        # type: (int, int) -> None
+        self.id = id
+        self.name = "Load Test {0}".format(id)
+        self.owner = Author(id)
+        self.member_count = member_count
+        self.members = [None] * member_count
+
+    def is_icon_animated(self):
+        return False
+
+
+class Sent:
+    """A message the bot sent."""
+
+    def __init__(self, content, kwargs):
+        # type: (Any, dict) -> None
+        self.content = content
+        self.kwargs = kwargs
+
+    async def edit(self, **kwargs):
+        self.kwargs.update(kwargs)
+
+    async def delete(self):
+        pass
+
+
+class Channel:
+    """A fake channel, which takes `latency` seconds to send a message."""
+
+    def __init__(self, id, guild, latency):
+        # type: (int, Guild, float) -> None
+        self.id = id
+        self.guild = guild
+        self.latency = latency
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return Sent(content, kwargs)
+
+
+class Message:
+    """A fake message from a user."""
+
+    def __init__(self, id, content, channel, author):
+        # type: (int, str, Channel, Author) -> None
+        self.id = id
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+
+
+async def start_stubs(latency, rng):
+    # type: (float, Random) -> Any
+    """Starts stand-ins for open-notify, WordsAPI and GitHub."""
+
+    from aiohttp import web
+
+    async def iss(request):
+        await asyncio.sleep(latency)
+        return web.json_response(
+            {
+                "message": "success",
+                "timestamp": 0,
+                "iss_position": {
+                    "latitude": str(rng.uniform(-51.6, 51.6)),
+                    "longitude": str(rng.uniform(-180, 180)),
+                },
+            }
+        )
+
+    async def words(request):
+        await asyncio.sleep(latency)
+        word = request.match_info["word"]
+        if word == "qwxz":
+            return web.json_response(
+                {"success": False, "message": "word not found"}, status=404
+            )
+        return web.json_response(
+            {
+                "word": word,
+                "results": [
+                    {
+                        "definition": "a sweet baked food",
+                        "partOfSpeech": "noun",
+                    }
+                ],
+                "syllables": {"count": 1, "list": [word]},
+            }
+        )
+
+    async def repo(request):
+        await asyncio.sleep(latency)
+        if request.headers.get("If-None-Match") == '"loadtest"':
+            return web.Response(status=304)
+        return web.json_response(
+            {"stargazers_count": 1234, "homepage": "https://cakebot.club"},
+            headers={
+                "ETag": '"loadtest"',
+                "X-RateLimit-Remaining": "5000",
+                "X-RateLimit-Reset": "0",
+            },
+        )
+
+    app = web.Application()
+    app.router.add_get("/iss-now.json", iss)
+    app.router.add_get("/words/{word}", words)
+    app.router.add_get("/repos/{owner}/{name}", repo)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    return runner, "http://127.0.0.1:{0}".format(sock.getsockname()[1])
+
+
+def parse_mix(mix):
+    # type: (str) -> list
+    """Turns `ping=4,iss=1` into a list of (command, weight)."""
+
+    weights = []
+    for part in mix.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in MESSAGES:
+            raise ValueError(
+                "Don't know how to load test `{0}`, pick from: {1}".format(
+                    name, ", ".join(sorted(MESSAGES))
+                )
+            )
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+def percentile(values, fraction):
+    # type: (list, float) -> float
+    """The value `fraction` of the way through some sorted values."""
+
+    if len(values) == 0:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def replay(
+    main, weights, rate, duration, users, guilds, send_latency, rng
+):
+    # type: (Any, list, float, float, int, int, float, Random) -> Any
+    """
+    Feeds messages into `on_message` at `rate` a second.
+
+    Messages are sent on a fixed schedule no matter how far behind the
+    bot is, and latency is measured from when a message was due, so a
+    backed up bot shows up as latency instead of a lower send rate.
+    """
+
+    names = [name for name, _ in weights]
+    chances = [weight for _, weight in weights]
+    servers = [Guild(1000 + i, rng.randint(2, 5000)) for i in range(guilds)]
+    channels = [
+        Channel(2000000 + i, servers[i % guilds], send_latency)
+        for i in range(guilds * 2)
+    ]
+    latencies = {name: [] for name in names}  # type: dict
+    errors = {name: 0 for name in names}
+
+    async def handle(name, message, due):
+        try:
+            await main.on_message(message)
+        except Exception:
+            errors[name] += 1
+        else:
+            latencies[name].append(loop.time() - due)
+
+    loop = asyncio.get_event_loop()
+    tasks = []
+    start = loop.time()
+    for i in range(int(rate * duration)):
+        due = start + i / rate
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        name = rng.choices(names, chances)[0]
+        user = 200000 + rng.randrange(users)
+        message = Message(
+            i,
+            main.BOT_PREFIX + MESSAGES[name](rng, user),
+            rng.choice(channels),
+            Author(user),
+        )
+        tasks.append(asyncio.ensure_future(handle(name, message, due)))
+    await asyncio.gather(*tasks)
+    return latencies, errors, loop.time() - start
+
+
+async def load_test(
+    mix, rate, duration, users, guilds, upstream_latency, send_latency, seed
+):
+    # type: (str, float, float, int, int, float, float, int) -> Any
+    os.environ["TEST_ENV"] = "yes"
+    import main
+    from cakebot import (
+        Content,
+        Database,
+        GitHubUtil,
+        IssApi,
+        ResponseCache,
+        TextCommandsUtil,
+    )
+
+    rng = Random(seed)
+    weights = parse_mix(mix)
+    runner, base = await start_stubs(upstream_latency, rng)
+
+    with TemporaryDirectory() as tmp:
+        main.store = Database.open_store(
+            {"path": os.path.join(tmp, "cakebot.journal")}
+        )
+        main.tickets = GitHubUtil.TicketQueue(os.path.join(tmp, "tickets.db"))
+        main.define_cache = ResponseCache.ResponseCache(
+            os.path.join(tmp, "define-cache.db")
+        )
+        main.wordsapi_token = "load-test"
+        main.http.rewrites = {
+            IssApi.API_URL: base + "/iss-now.json",
+            TextCommandsUtil.WORDSAPI_URL: base + "/words/",
+            GitHubUtil.API_URL: base + "/repos/",
+        }
+        Content.registry.load_all()
+        await main.geocoder.warm()
+
+        try:
+            return await replay(
+                main,
+                weights,
+                rate,
+                duration,
+                users,
+                guilds,
+                send_latency,
+                rng,
+            )
+        finally:
+            main.store.close()
+            main.tickets.close()
+            main.define_cache.close()
+            main.geocoder.close()
+            await main.http.close()
+            await runner.cleanup()
+
+
+@command()
+@option("--mix", default=DEFAULT_MIX, help="Commands and their weights.")
+@option("--rate", type=float, default=200, help="Messages per second.")
+@option("--duration", type=float, default=10, help="Seconds to run for.")
+@option("--users", type=int, default=1000, help="Distinct fake users.")
+@option("--guilds", type=int, default=50, help="Distinct fake servers.")
+@option(
+    "--upstream-latency",
+    type=float,
+    default=0.05,
+    help="Seconds the stub APIs take to answer.",
+)
+@option(
+    "--send-latency",
+    type=float,
+    default=0.02,
+    help="Seconds Discord takes to accept a message.",
+)
+@option("--seed", type=int, default=0, help="Seed for the message stream.")
+@option(
+    "--max-p99",
+    type=float,
+    default=None,
+    help="Fail if any command's p99 is above this many milliseconds.",
+)
+def cli(
+    mix,
+    rate,
+    duration,
+    users,
+    guilds,
+    upstream_latency,
+    send_latency,
+    seed,
+    max_p99,
+):
+    """Replays fake traffic into on_message, fully offline."""
+
+    latencies, errors, elapsed = asyncio.run(
+        load_test(
+            mix,
+            rate,
+            duration,
+            users,
+            guilds,
+            upstream_latency,
+            send_latency,
+            seed,
+        )
+    )
+
+    secho(
+        "{0:<12} {1:>7} {2:>7} {3:>9} {4:>9} {5:>9}".format(
+            "command", "count", "errors", "p50 ms", "p95 ms", "p99 ms"
+        ),
+        bold=True,
+    )
+    everything = []
+    slow = []
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        everything.extend(values)
+        p99 = percentile(values, 0.99) * 1000
+        if max_p99 is not None and p99 > max_p99:
+            slow.append(name)
+        secho(
+            "{0:<12} {1:>7} {2:>7} {3:>9.2f} {4:>9.2f} {5:>9.2f}".format(
+                name,
+                len(values),
+                errors[name],
+                percentile(values, 0.5) * 1000,
+                percentile(values, 0.95) * 1000,
+                p99,
+            ),
+            fg="red" if name in slow or errors[name] > 0 else "green",
+        )
+
+    everything.sort()
+    secho(
+        "\n{0} messages in {1:.2f}s, {2:.1f}/s (asked for {3:.1f}/s), "
+        "p50 {4:.2f}ms, p99 {5:.2f}ms".format(
+            len(everything),
+            elapsed,
+            len(everything) / elapsed,
+            rate,
+            percentile(everything, 0.5) * 1000,
+            percentile(everything, 0.99) * 1000,
+        ),
+        bold=True,
+    )
+
+    if len(slow) > 0 or sum(errors.values()) > 0:
+        _exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -16,26 +16,43 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from os import getenv
-from sys import exit as _exit
+from asyncio import run as asyncio_run
+from importlib import import_module
+from os import environ, getenv
+from os.path import abspath, dirname
+from subprocess import check_output
+from tempfile import TemporaryDirectory
+from sys import executable, modules
+from typing import Any
 
 import discord
-import yappi
 from click import group, option, secho, version_option
-from discord.utils import oauth_url
-from factdata import FactImp
 from filehandlers import AbstractFile, FileManipulator
-from github import Github
-from slots import result, row
 
 from cakebot import (
+    Cluster,
+    Commands,
+    Content,
     Database,
-    EmbedUtil,
+    Decks,
+    Geocoder,
     GitHubUtil,
+    Handlers,
+    HeapProfiler,
+    HttpClient,
     IssApi,
-    Preconditions,
+    LowMemory,
+    Leaderboard,
+    Metrics,
+    Outbox,
+    Profiler,
+    RateLimit,
+    ResponseCache,
+    Sessions,
+    Startup,
     TextCommandsUtil,
     UserUtil,
+    Watchdog,
 )
 
 config = FileManipulator(AbstractFile("config.json"))
@@ -48,238 +65,173 @@ if getenv("TEST_ENV") != "yes":
         TextCommandsUtil.noop()
 
 
-g = Github(base_conf.get("tokens", {}).get("github"))
-wordsapi_token = base_conf.get("tokens", {}).get("wordsapi", None)
+# only imported when a command needs them, to keep starting up fast
+LAZY_IMPORTS = ("factdata", "slots", "github", "yappi")
 
-client = discord.AutoShardedClient()
+github_client = None  # type: Any
 
 
-@client.event
-async def on_ready():
-    await client.change_presence(
-        activity=discord.Game(name=base_conf["status"])
-    )
-    secho(
-        "\nReady to roll, I'll see you on Discord: @" + str(client.user),
-        fg="green",
-    )
+def github():
+    # type: () -> Any
+    """The GitHub client, created the first time it's needed."""
 
+    global github_client
+    if github_client is None:
+        from github import Github
 
-@client.event
-async def on_message(message):
-    BOT_PREFIX = "+"
+        github_client = Github(base_conf.get("tokens", {}).get("github"))
+    return github_client
 
-    if getenv("PRODUCTION") is None:
-        BOT_PREFIX = "-"
 
-    if not message.content.startswith(BOT_PREFIX):
-        return
+wordsapi_token = base_conf.get("tokens", {}).get("wordsapi", None)
 
-    # Split input
-    args = message.content[len(BOT_PREFIX) :].split()
+store = None  # type: Any
+
+# set when this process is one worker of a cluster
+worker = None  # type: Any
+board = None  # type: Any
+cluster_conf = base_conf.get("cluster", {})
+
+http = HttpClient.HttpClient(**base_conf.get("http", {}))
+iss_cache = IssApi.PositionCache(**base_conf.get("iss", {}))
+geocoder = Geocoder.Geocoder(**base_conf.get("geocoder", {}))
+define_cache = None  # type: Any
+tickets = None  # type: Any
+profiler = Profiler.Profiler(**base_conf.get("profiler", {}))
+heap_profiler = HeapProfiler.HeapProfiler(
+    **base_conf.get("heap_profiler", {})
+)
+watchdog_conf = dict(base_conf.get("watchdog", {}))
+watchdog_enabled = watchdog_conf.pop("enabled", False)
+watchdog = Watchdog.Watchdog(**watchdog_conf)
+leaderboard_conf = base_conf.get("leaderboard", {})
+leaderboard_size = leaderboard_conf.get("size", 10)
+leaderboard_cache = Leaderboard.TopCache(leaderboard_conf.get("ttl", 30))
+outbox = Outbox.Outbox(**base_conf.get("outbox", {}))
+rate_limit_conf = dict(base_conf.get("rate_limit", {}))
+limiter = (
+    RateLimit.RateLimiter(**rate_limit_conf)
+    if rate_limit_conf.pop("enabled", False)
+    else None
+)
+repo_cache = GitHubUtil.RepoCache(
+    base_conf.get("tokens", {}).get("github"),
+    **base_conf.get("github_cache", {}),
+)
 
-    if len(args) == 0:
-        return
 
-    cmd = args[0].lower()
-
-    # the arg array ex. ["hello", "world"]
-    args = args[1:]
-
-    s = message.channel.send
-
-    if (
-        cmd
-        in {
-            "8",
-            "report",
-            "define",
-            "stars",
-            "homepage",
-            "clapify",
-            "cookie",
-            "say",
-        }
-        and Preconditions.args_are_valid(args)
-    ):
-        return await s(
-            embed=EmbedUtil.prep(
-                "That command expected an argument (or arguments), but you didn't give it any!",
-                "[Read the docs?](https://cakebot.club/docs/commands/)",
-            )
-        )
+class Cakebot(Sessions.ResumingClient):
+    """Our client, which cleans up after itself when it shuts down."""
 
-    tcu_result = TextCommandsUtil.handle_common_commands(args, cmd)
-    if tcu_result != "":
-        return await s(tcu_result)
+    async def close(self):
+        await http.close()
+        geocoder.close()
+        await super().close()
 
-    if cmd == "help":
-        return await s(
-            embed=EmbedUtil.prep(
-                title="Help",
-                description="You can check out [this page of our website](https://cakebot.club/docs/commands/) for a full command list!",
-            )
-        )
 
-    elif cmd == "ping":
-        return await s(f"🏓 - websocket responded in {client.latency}")
+client = Cakebot(**LowMemory.client_options(**base_conf.get("memory", {})))
 
-    elif cmd == "invite":
-        return await s(
-            embed=EmbedUtil.prep(
-                "Invite Cakebot",
-                f"[Click here to invite me!]({oauth_url(580573141898887199, permissions=discord.Permissions.all())})",
-            )
-        )
+background_tasks = []  # type: list
 
-    elif cmd == "info":
-        return await s(
-            embed=EmbedUtil.prep(
-                "Server Info",
-                TextCommandsUtil.data_template.format(
-                    message.guild.name,
-                    str(message.guild.owner),
-                    len(message.guild.members),
-                    message.guild.region,
-                    message.guild.id,
-                    message.guild.premium_subscription_count,
-                    str(message.guild.is_icon_animated()),
-                    str(message.guild.created_at),
-                    str(message.guild.large),
-                    str(message.guild.mfa_level == 1),
-                ),
-            )
-        )
+startup = Startup.Timeline()
+# set by startup-report, which only wants to time connecting
+report_only = False
 
-    elif cmd == "report":
-        return await GitHubUtil.report(s, g, args, message)
 
-    elif cmd == "iss":
-        m = await s("Calculating...")
-        imp = IssApi.IssLocater()
-        lat = imp.lat
-        lon = imp.lon
-        from reverse_geocoder import search
+def start_background_tasks():
+    # type: () -> None
+    """Starts our long-running jobs, only once per process."""
 
-        geodata = search((lat, lon))
-        location = "{0}, {1}".format(geodata[0]["admin1"], geodata[0]["cc"])
+    if len(background_tasks) > 0:
+        return
 
-        await m.delete()
-        return await s(
-            embed=EmbedUtil.prep(
-                "International Space Station", "Where it is right now!"
+    background_tasks.append(geocoder.warm())
+    background_tasks.append(client.loop.run_in_executor(None, Decks.facts))
+    # in a cluster, only the first worker files tickets
+    if worker is None or worker == 0:
+        background_tasks.append(client.loop.create_task(tickets.work(github)))
+
+    if board is not None:
+        background_tasks.append(
+            client.loop.create_task(
+                Cluster.publish_status(
+                    board, worker, client, cluster_conf.get("interval", 5)
+                )
             )
-            .add_field(
-                name="Location above Earth", value=str(location), inline=False
+        )
+
+    if client.sessions is not None:
+        background_tasks.append(
+            client.loop.create_task(
+                Sessions.save_periodically(
+                    client, base_conf.get("sessions", {}).get("interval", 30)
+                )
             )
-            .add_field(name="Latitude", value=str(lat), inline=False)
-            .add_field(name="Longitude", value=str(lon), inline=False)
         )
 
-    elif cmd == "fact":
-        return await s(embed=EmbedUtil.prep("Random Fact", FactImp().fact()))
-
-    elif cmd == "slots":
-        slotz = result()
-        top = row()
-        btm = row()
-        form = "win" if slotz[0] == 1 else "lose"
-        return await s(
-            f"⠀{top[0]}{top[1]}{top[2]}\n"
-            # the line above contains unicode, DO NOT REMOVE
-            + f"**>** {slotz[1][0]}{slotz[1][1]}{slotz[1][2]} **<**\n"
-            + f"   {btm[0]}{btm[1]}{btm[2]}"
-            + f"\n**You {form}!**"
+    if isinstance(store, Database.JournalStore):
+        background_tasks.append(
+            client.loop.create_task(Database.compact_periodically(store))
         )
 
-    elif cmd == "reboot":
-        if message.author.id in UserUtil.admins():
-            await s("Restarting. This may take up to 5 minutes.")
-            # make the bot crash, forcing our server to turn it back on
-            _exit(1)
-        else:
-            return await s(":x: **You are not authorized to run this!**")
+    if watchdog_enabled:
+        background_tasks.append(client.loop.create_task(watchdog.heartbeat()))
 
-    elif cmd == "stars":
-        try:
-            return await s(
-                f"`{args[0]}` has *{g.get_repo(args[0]).stargazers_count}* stars."
-            )
-        except:
-            return await s(
-                "Failed to get count. Is the repository valid and public?"
+    metrics_conf = base_conf.get("metrics", {})
+    if metrics_conf.get("enabled", False):
+        Metrics.registry.collectors.append(collect_shard_latencies)
+        background_tasks.append(
+            client.loop.create_task(Metrics.watch_loop_lag())
+        )
+        background_tasks.append(
+            client.loop.create_task(
+                Metrics.serve(
+                    metrics_conf.get("host", "127.0.0.1"),
+                    # every worker in a cluster gets its own port
+                    metrics_conf.get("port", 9100) + (worker or 0),
+                )
             )
+        )
 
-    elif cmd == "homepage":
-        try:
-            url = g.get_repo(args[0]).homepage
-            if url is None:
-                url = "(error: homepage not specified by owner)"
-            return await s(f"{args[0]}'s homepage is located at {url}")
-        except:
-            return await s(
-                "Failed to fetch homepage. Is the repository valid and public?"
-            )
 
-    elif cmd == "boomer":
-        return await s(file=discord.File("content/boomer.jpeg"))
-
-    elif cmd == "cookie" or cmd == "cookies":
-        subcommand = args[0]
-        args = args[1:]
-        userId = TextCommandsUtil.get_mentioned_id(args)
-
-        if subcommand in ["balance", "bal"]:
-            count = 0
-            if userId == 0:
-                # assume user wants themself
-                count = Database.get_count(message.author.id, config)
-            else:
-                count = Database.get_count(userId, config)
-
-            return await s(
-                embed=EmbedUtil.prep(
-                    title="Cookies",
-                    description=f"User has {count} cookies.",
-                )
-            )
+def collect_shard_latencies():
+    # type: () -> None
+    for shard_id, latency in client.latencies:
+        Metrics.shard_latency_seconds.set(latency, shard_id)
 
-        elif subcommand in ["give", "to"]:
-            if userId == 0:
-                return await s(
-                    "I don't see who I should give the cookie to. Try mentioning them."
-                )
 
-            new_count = Database.add_cookie(userId, config)
+@client.event
+async def on_ready():
+    if not startup.has("gateway connect"):
+        startup.mark("gateway connect")
+        if report_only:
+            return await client.close()
+        secho(startup.render(), fg="white")
+        secho(client.ready_times.render(), fg="white")
+
+    start_background_tasks()
+    await client.change_presence(
+        activity=discord.Game(name=base_conf["status"])
+    )
+    secho(
+        "\nReady to roll, I'll see you on Discord: @" + str(client.user),
+        fg="green",
+    )
+
 
-            return await s(
-                f"Gave <@!{userId}> a cookie. They now have {new_count} cookies."
-            )
+BOT_PREFIX = "+" if getenv("PRODUCTION") is not None else "-"
 
-    elif cmd == "define":
-        if wordsapi_token is None:
-            return await s(
-                "This command is disabled due to a configuration error on my host's end - didn't find a WordsAPI token in the config!"
-            )
-        return await s(embed=TextCommandsUtil.define(args, wordsapi_token))
+commands = Commands.Registry(BOT_PREFIX, UserUtil.admins(), limiter, outbox)
+# the handlers live in cakebot.Handlers, so +reload can swap them out
+Handlers.register(commands, modules[__name__])
 
-    elif cmd == "start-profiler":
-        if message.author.id in UserUtil.admins():
-            await s(
-                "Started the profiler. Once you are done, run stop-profiler."
-            )
-            yappi.set_clock_type("wall")
-            yappi.start()
-        else:
-            return await s(":x: **You are not authorized to run this!**")
 
-    elif cmd == "stop-profiler":
-        if message.author.id in UserUtil.admins():
-            await s("Saved profiler results to `profile.txt`.")
-            yappi.stop()
-            yappi.get_func_stats().print_all(open("profile.txt", "w"))
-        else:
-            return await s(":x: **You are not authorized to run this!**")
+@client.event
+async def on_message(message):
+    # after a RESUME, Discord can replay messages we already answered
+    if client.replayed(message):
+        return
+    return await commands.dispatch(message)
 
 
 @group()
@@ -296,14 +248,60 @@ def cli():
     help="Discord token for the bot to use, defaults to the one from the config.json",
     default="",
 )
-def run(discord_token):
+@option(
+    "--worker",
+    "worker_number",
+    type=int,
+    default=None,
+    help="Run as this worker of a cluster, set by the cluster command.",
+)
+@option(
+    "--shard-ids",
+    type=str,
+    default=None,
+    help="Comma separated shard IDs this process should run.",
+)
+@option(
+    "--shard-count",
+    type=int,
+    default=None,
+    help="The total number of shards, needed with --shard-ids.",
+)
+def run(discord_token, worker_number=None, shard_ids=None, shard_count=None):
     """Runs the bot."""
 
+    global store, define_cache, tickets, worker, board
+
     secho("\nStarting Cakebot...\n", fg="blue", bold=True)
 
+    database_conf = base_conf.get("database", {})
+    if shard_ids is not None:
+        # read by AutoShardedClient when it launches its shards
+        client.shard_ids = [int(shard) for shard in shard_ids.split(",")]
+        client.shard_count = shard_count
+    if worker_number is not None:
+        worker = worker_number
+        board = Cluster.StatusBoard(
+            cluster_conf.get("status_path", "cluster.db")
+        )
+        database_conf = Cluster.shared_store(
+            database_conf, cluster_conf.get("database", "cakebot.db")
+        )
+
+    with startup.phase("cache warmup"):
+        open_stores(*store_confs(database_conf))
+
+    # only the bot itself resumes, startup-report would take its sessions
+    sessions_conf = base_conf.get("sessions", {})
+    if sessions_conf.get("enabled", False):
+        client.sessions = Sessions.SessionStore(
+            sessions_conf.get("path", "sessions.db")
+        )
+        client.max_age = sessions_conf.get("max_age", 90)
+
     secho("Using discord.py v" + discord.__version__, color="gray")
 
-    if g is None:
+    if base_conf.get("tokens", {}).get("github") is None:
         secho(
             "GitHub credentials not found, disabling functionality.",
             fg="white",
@@ -314,10 +312,198 @@ def run(discord_token):
             fg="white",
         )
 
+    startup.mark("setup")
+    client.run(discord_token or base_conf["tokens"]["discord"])
+
+    close_stores()
+
+
+def store_confs(database_conf):
+    # type: (Any) -> list
+    """The cookie store, tickets and define cache configs, with defaults."""
+
+    if isinstance(database_conf, str):
+        database_conf = {"engine": "sqlite", "path": database_conf}
+    engine = database_conf.get("engine", "journal")
+    return [
+        dict(
+            {
+                "engine": engine,
+                "path": "cakebot.db"
+                if engine == "sqlite"
+                else "cakebot.journal",
+            },
+            **database_conf,
+        ),
+        dict({"path": "tickets.db"}, **base_conf.get("tickets", {})),
+        dict(
+            {"path": "define-cache.db"}, **base_conf.get("define_cache", {})
+        ),
+    ]
+
+
+def open_stores(database_conf, tickets_conf, define_conf):
+    # type: (dict, dict, dict) -> None
+    """Opens the cookie store and the caches, and loads the content."""
+
+    global store, define_cache, tickets
+
+    store = Database.open_store(database_conf)
+    if store.migrate(base_conf.get("users", {})):
+        secho(
+            "Migrated users from config.json, you can remove them from it now.",
+            fg="white",
+        )
+
+    Content.registry.load_all()
+    tickets = GitHubUtil.TicketQueue(**tickets_conf)
+    define_cache = ResponseCache.ResponseCache(**define_conf)
+
+
+def close_stores():
+    # type: () -> None
+    store.close()
+    define_cache.close()
+    tickets.close()
+    if board is not None:
+        board.close()
+    if client.sessions is not None:
+        client.sessions.close()
+
+
+@cli.command("startup-report")
+@option(
+    "--connect/--no-connect",
+    default=False,
+    help="Also time connecting to the gateway. This logs in another session "
+    + "with the token, so don't use a running bot's.",
+)
+@option(
+    "--discord-token",
+    type=str,
+    help="Discord token for the bot to use, defaults to the one from the config.json",
+    default="",
+)
+def startup_report(connect, discord_token):
+    """Prints how long each phase of starting up takes."""
+
+    global startup, report_only
+
+    startup = Startup.Timeline()
+
+    # in a fresh interpreter, like after a reboot, without reading the config
+    seconds = check_output(
+        [
+            executable,
+            "-c",
+            "from time import perf_counter; start = perf_counter(); "
+            + "import main; print(perf_counter() - start)",
+        ],
+        cwd=dirname(abspath(__file__)),
+        env=dict(environ, TEST_ENV="yes"),
+    )
+    startup.add("imports", float(seconds))
+
+    with startup.phase("config load"):
+        config.load_from_json()
+    for name in LAZY_IMPORTS:
+        with startup.phase("first use of " + name):
+            import_module(name)
+    confs = store_confs(base_conf.get("database", {}))
+    with TemporaryDirectory() as tmp:
+        # a running bot might be writing to the real ones
+        copies = Startup.copy_stores([conf["path"] for conf in confs], tmp)
+        with startup.phase("cache warmup"):
+            open_stores(
+                *[dict(conf, path=copy) for conf, copy in zip(confs, copies)]
+            )
+
+        async def warm_geocoder():
+            await geocoder.warm()
+
+        with startup.phase("geocoder index"):
+            asyncio_run(warm_geocoder())
+
+        try:
+            if connect:
+                report_only = True
+                startup.mark("setup")
+                client.run(discord_token or base_conf["tokens"]["discord"])
+        finally:
+            close_stores()
+            geocoder.close()
+
+    secho(startup.render(), fg="green")
+    if connect:
+        secho(client.ready_times.render(), fg="green")
+
+
+@cli.command()
+@option(
+    "--workers",
+    type=int,
+    default=None,
+    help="How many worker processes to run, defaults to the config's.",
+)
+@option(
+    "--shard-count",
+    type=int,
+    default=None,
+    help="The total number of shards, defaults to what Discord recommends.",
+)
+@option(
+    "--discord-token",
+    type=str,
+    help="Discord token for the bot to use, defaults to the one from the config.json",
+    default="",
+)
+def cluster(workers, shard_count, discord_token):
+    """Runs the bot as several worker processes, each with some shards."""
+
+    token = discord_token or base_conf["tokens"]["discord"]
+    workers = workers or cluster_conf.get("workers", 2)
+    shard_count = shard_count or cluster_conf.get("shard_count")
+
+    if shard_count is None:
+
+        async def ask():
+            gateway = HttpClient.HttpClient()
+            try:
+                return await Cluster.recommended_shards(gateway, token)
+            finally:
+                await gateway.close()
+
+        shard_count = asyncio_run(ask())
+
+    database_path = cluster_conf.get("database", "cakebot.db")
+    if Cluster.copy_journal(base_conf.get("database", {}), database_path):
+        secho(
+            f"Copied the cookie journal into {database_path} for the workers.",
+            fg="white",
+        )
+    # build the geocoder index once, instead of in every worker at once
+    geocoder.ensure_index()
+
+    status = Cluster.StatusBoard(
+        cluster_conf.get("status_path", "cluster.db")
+    )
+    status.reset()
+    status.close()
+
+    secho(
+        f"\nStarting a cluster of {workers} workers for {shard_count} shards...\n",
+        fg="blue",
+        bold=True,
+    )
+    command = [executable, abspath(__file__), "run"]
     if discord_token != "":
-        client.run(discord_token)
-    else:
-        client.run(base_conf["tokens"]["discord"])
+        command += ["--discord-token", discord_token]
+    Cluster.Supervisor(
+        command,
+        shard_count,
+        workers,
+        **cluster_conf.get("supervisor", {}),
+    ).run()
 
 
 if __name__ == "__main__":
@@ -17,10 +17,29 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 
+import asyncio
 import os
+import socket
 import unittest
 
 
+async def serve(routes):
+    """Starts a local stub server, returns its runner and base URL."""
+
+    from aiohttp import web
+
+    app = web.Application()
+    for path, handler in routes:
+        app.router.add_get(path, handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    return runner, "http://127.0.0.1:{0}".format(sock.getsockname()[1])
+
+
 class Tests(unittest.TestCase):
     def setUp(self):
         os.environ["TEST_ENV"] = "yes"
@@ -43,6 +62,34 @@ class Tests(unittest.TestCase):
         self.assertIsInstance(TextCommandsUtil.common("jokes"), str)
         self.assertIsNone(TextCommandsUtil.noop())
 
+    def test_content_registry(self):
+        """Test cakebot.Content"""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.Content import ContentRegistry
+
+        with TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "small.txt"), "w") as f:
+                f.write("a\nb\n")
+            with open(os.path.join(tmp, "big.txt"), "w") as f:
+                f.write("one\ntwo\nthree")
+
+            registry = ContentRegistry(tmp, mmap_threshold=10)
+            registry.load_all()
+            self.assertEqual(len(registry.get("small")), 2)
+            self.assertIsNotNone(registry.get("big").mapped)
+            self.assertEqual(registry.get("big")[1], "two\n")
+            self.assertEqual(registry.get("big")[2], "three")
+            self.assertIn(registry.pick("small"), ["a\n", "b\n"])
+
+            registry.check_interval = 0
+            with open(os.path.join(tmp, "small.txt"), "w") as f:
+                f.write("c\n")
+            os.utime(os.path.join(tmp, "small.txt"), (0, 0))
+            self.assertEqual(registry.pick("small"), "c\n")
+            registry.get("big").close()
+
     def test_get_mentioned_id(self):
         """Test cakebot.TextCommandsUtil.get_mentioned_id"""
 
@@ -69,6 +116,28 @@ class Tests(unittest.TestCase):
             EmbedUtil.prep(title="a", description="b"), EmbedUtil.Embed
         )
 
+    def test_static_embeds(self):
+        """Test cakebot.EmbedUtil.static"""
+
+        from cakebot import EmbedUtil
+
+        built = []
+
+        def build():
+            built.append(None)
+            return EmbedUtil.prep("Static", "Built once").add_field(
+                name="a", value="b"
+            )
+
+        first = EmbedUtil.static("test", build)
+        first.add_field(name="c", value="d")
+        second = EmbedUtil.static("test", build)
+
+        self.assertEqual(len(built), 1)
+        self.assertEqual(second.title, "Static")
+        self.assertEqual(len(second.fields), 1)
+        self.assertEqual(second.footer.text, EmbedUtil.FOOTER)
+
     def test_pi_command(self):
         """Test `+pi`."""
 
@@ -137,15 +206,1393 @@ class Tests(unittest.TestCase):
 
         self.assertIsInstance(handle_common_commands([], "joke"), str)
 
+    def test_sqlite_store(self):
+        """Test cakebot.Database.SqliteStore"""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot import Database
+
+        with TemporaryDirectory() as tmp:
+            store = Database.SqliteStore(os.path.join(tmp, "cakebot.db"))
+            self.assertTrue(store.migrate({"123456789": {"cookie_count": 4}}))
+            self.assertFalse(
+                store.migrate({"123456789": {"cookie_count": 9}})
+            )
+            self.assertEqual(Database.get_count(123456789, store), 4)
+            self.assertEqual(Database.add_cookie(123456789, store), 5)
+            self.assertEqual(Database.add_cookie(987654321, store), 1)
+            self.assertEqual(Database.get_count(111111111, store), 0)
+            store.close()
+
+    def test_journal_store(self):
+        """Test cakebot.Database.JournalStore"""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot import Database
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cakebot.journal")
+            store = Database.JournalStore(path)
+            self.assertTrue(store.migrate({"123456789": {"cookie_count": 4}}))
+            self.assertEqual(Database.add_cookie(123456789, store), 5)
+            self.assertEqual(Database.add_cookie(987654321, store), 1)
+            store.journal.close()
+
+            # simulate a crash in the middle of a write
+            with open(path, "a") as f:
+                f.write('{"cookie_count": 9')
+
+            store = Database.JournalStore(path)
+            self.assertFalse(
+                store.migrate({"123456789": {"cookie_count": 4}})
+            )
+            self.assertEqual(Database.get_count(123456789, store), 5)
+            self.assertEqual(Database.add_cookie(987654321, store), 2)
+            store.compact()
+            self.assertEqual(os.path.getsize(path), 0)
+            store.close()
+
+            store = Database.JournalStore(path)
+            self.assertEqual(Database.get_count(987654321, store), 2)
+            store.close()
+
+    def test_http_client_retries(self):
+        """Test cakebot.HttpClient retrying a failing upstream."""
+
+        from aiohttp import web
+
+        from cakebot.HttpClient import HttpClient
+
+        calls = []
+
+        async def flaky(request):
+            calls.append(request.path)
+            if len(calls) == 1:
+                return web.Response(status=503)
+            return web.json_response({"ok": True})
+
+        async def scenario():
+            runner, base = await serve([("/flaky", flaky)])
+            http = HttpClient(backoff=0, rewrites={"http://upstream": base})
+            try:
+                return await http.get("http://upstream/flaky")
+            finally:
+                await http.close()
+                await runner.cleanup()
+
+        resp = asyncio.run(scenario())
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.data, {"ok": True})
+        self.assertEqual(len(calls), 2)
+
     def test_iss_api(self):
         """Test the ISS API."""
 
-        from cakebot.IssApi import IssLocater
+        from aiohttp import web
+
+        from cakebot.HttpClient import HttpClient
+        from cakebot.IssApi import locate
+
+        async def iss_now(request):
+            return web.json_response(
+                {
+                    "message": "success",
+                    "iss_position": {"latitude": "1.5", "longitude": "-2.5"},
+                }
+            )
 
-        locater = IssLocater()
+        async def scenario():
+            runner, base = await serve([("/iss-now.json", iss_now)])
+            http = HttpClient(rewrites={"http://api.open-notify.org": base})
+            try:
+                return await locate(http)
+            finally:
+                await http.close()
+                await runner.cleanup()
+
+        locater = asyncio.run(scenario())
         self.assertIsInstance(locater.lat, str)
         self.assertIsInstance(locater.lon, str)
 
+    def test_iss_position_cache(self):
+        """Test cakebot.IssApi.PositionCache coalescing a burst."""
+
+        from aiohttp import web
+
+        from cakebot.HttpClient import HttpClient
+        from cakebot.IssApi import PositionCache
+
+        calls = []
+
+        async def iss_now(request):
+            calls.append(request.path)
+            await asyncio.sleep(0.05)
+            return web.json_response(
+                {"iss_position": {"latitude": "1.5", "longitude": "-2.5"}}
+            )
+
+        async def scenario():
+            runner, base = await serve([("/iss-now.json", iss_now)])
+            http = HttpClient(rewrites={"http://api.open-notify.org": base})
+            cache = PositionCache(ttl=60)
+            try:
+                burst = await asyncio.gather(
+                    *[cache.get(http) for _ in range(50)]
+                )
+                later = await cache.get(http)
+                return burst, later
+            finally:
+                await http.close()
+                await runner.cleanup()
+
+        burst, later = asyncio.run(scenario())
+        self.assertEqual(len(calls), 1)
+        self.assertIs(burst[0], later)
+        self.assertLess(later.age(), 60)
+
+    def test_geocoder(self):
+        """Test cakebot.Geocoder"""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.Geocoder import Geocoder
+
+        with TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "cities.csv")
+            with open(source, "w") as f:
+                f.write("lat,lon,name,admin1,admin2,cc\n")
+                f.write("51.5,-0.1,London,England,,GB\n")
+                f.write("40.7,-74.0,New York,New York,,US\n")
+                f.write("-17.0,179.9,Labasa,Northern,,FJ\n")
+                f.write("-17.0,-170.0,Pago Pago,Eastern,,AS\n")
+
+            async def scenario():
+                geocoder = Geocoder(
+                    index_dir=os.path.join(tmp, "index"), source=source
+                )
+                try:
+                    first = await geocoder.lookup("51.4", "-0.2")
+                    again = await geocoder.lookup("51.45", "-0.15")
+                    other = await geocoder.lookup(41.0, -73.0)
+                    # just across the 180th meridian from Labasa
+                    across = await geocoder.lookup(-17.0, -179.9)
+                    return first, again, other, across, geocoder.hits
+                finally:
+                    geocoder.close()
+
+            first, again, other, across, hits = asyncio.run(scenario())
+            self.assertEqual(first, "England, GB")
+            self.assertEqual(again, "England, GB")
+            self.assertEqual(other, "New York, US")
+            self.assertEqual(across, "Northern, FJ")
+            self.assertEqual(hits, 1)
+
+            async def retry():
+                geocoder = Geocoder(
+                    index_dir=os.path.join(tmp, "retry"),
+                    source=os.path.join(tmp, "later.csv"),
+                )
+                try:
+                    with self.assertRaises(FileNotFoundError):
+                        await geocoder.lookup(51.5, -0.1)
+                    os.replace(source, os.path.join(tmp, "later.csv"))
+                    return await geocoder.lookup(51.5, -0.1)
+                finally:
+                    geocoder.close()
+
+            # a failed load isn't remembered
+            self.assertEqual(asyncio.run(retry()), "England, GB")
+
+    def test_define_cache(self):
+        """Test `+define` going through cakebot.ResponseCache."""
+
+        from tempfile import TemporaryDirectory
+
+        from aiohttp import web
+
+        from cakebot.HttpClient import HttpClient
+        from cakebot.ResponseCache import ResponseCache
+        from cakebot.TextCommandsUtil import define
+
+        calls = []
+
+        async def words(request):
+            calls.append(request.match_info["word"])
+            if request.match_info["word"] != "cake":
+                return web.json_response(
+                    {"success": False, "message": "word not found"},
+                    status=404,
+                )
+            return web.json_response(
+                {
+                    "word": "cake",
+                    "results": [{"definition": "a baked dessert"}],
+                    "syllables": {"count": 1, "list": ["cake"]},
+                }
+            )
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "define-cache.db")
+
+            async def scenario():
+                runner, base = await serve([("/words/{word}", words)])
+                http = HttpClient(
+                    rewrites={"https://wordsapiv1.p.rapidapi.com": base}
+                )
+                cache = ResponseCache(path, negative_ttl=0)
+                try:
+                    embeds = [
+                        await define([word], "token", http, cache)
+                        for word in ["Cake", "cake", "qwxz", "qwxz"]
+                    ]
+                    return embeds, cache.stats()
+                finally:
+                    cache.close()
+                    await http.close()
+                    await runner.cleanup()
+
+            embeds, stats = asyncio.run(scenario())
+            # the unknown word expires right away, so it's fetched twice
+            self.assertEqual(calls, ["cake", "qwxz", "qwxz"])
+            self.assertEqual(stats["memory_hits"], 1)
+            self.assertEqual(embeds[1].fields[1].value, "a baked dessert")
+            self.assertEqual(embeds[3].fields[0].name, "Error")
+
+            cache = ResponseCache(path)
+            self.assertIsNotNone(asyncio.run(cache.get("cake")))
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+            cache.close()
+
+    def test_repo_cache(self):
+        """Test cakebot.GitHubUtil.RepoCache revalidating with ETags."""
+
+        from aiohttp import web
+
+        from cakebot.GitHubUtil import RepoCache
+        from cakebot.HttpClient import HttpClient
+
+        calls = []
+
+        async def repo(request):
+            calls.append(request.headers.get("If-None-Match"))
+            headers = {
+                "ETag": '"v1"',
+                "X-RateLimit-Remaining": str(60 - len(calls) * 10),
+                "X-RateLimit-Reset": "9999999999",
+            }
+            if request.headers.get("If-None-Match") == '"v1"':
+                return web.Response(status=304, headers=headers)
+            return web.json_response(
+                {"stargazers_count": 42, "homepage": "https://cakebot.club"},
+                headers=headers,
+            )
+
+        async def scenario():
+            runner, base = await serve([("/repos/{owner}/{name}", repo)])
+            http = HttpClient(rewrites={"https://api.github.com": base})
+            cache = RepoCache(ttl=0, low_quota=45)
+            try:
+                first = await cache.get(http, "cakebotpro/cakebot")
+                second = await cache.get(http, "cakebotpro/cakebot")
+                stale = await cache.get(http, "cakebotpro/cakebot")
+                return first, second, stale
+            finally:
+                await http.close()
+                await runner.cleanup()
+
+        first, second, stale = asyncio.run(scenario())
+        self.assertEqual(calls, [None, '"v1"'])
+        self.assertEqual(second.stars, 42)
+        self.assertTrue(stale.stale)
+
+    def test_ticket_queue(self):
+        """Test cakebot.GitHubUtil.TicketQueue"""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.GitHubUtil import TicketQueue
+
+        issues = []
+
+        class FakeRepo:
+            def get_label(self, name):
+                return name
+
+            def create_issue(self, title, body, labels):
+                if len(issues) == 0:
+                    issues.append(None)
+                    raise IOError("GitHub is down")
+                issues.append(labels)
+
+        class FakeGithub:
+            def __init__(self):
+                self.lookups = 0
+
+            def get_repo(self, name):
+                self.lookups += 1
+                return FakeRepo()
+
+        clients = []
+
+        def github():
+            clients.append(FakeGithub())
+            return clients[-1]
+
+        with TemporaryDirectory() as tmp:
+            queue = TicketQueue(os.path.join(tmp, "tickets.db"), backoff=0)
+
+            async def scenario():
+                while await queue.drain_once(github):
+                    pass
+
+            # the client isn't made until there's a ticket to file
+            asyncio.run(scenario())
+            self.assertEqual(clients, [])
+
+            self.assertTrue(queue.put(123456789, "someone#0001", "help"))
+            self.assertFalse(queue.put(123456789, "someone#0001", "help"))
+            self.assertTrue(queue.put(123456789, "someone#0001", "more"))
+
+            asyncio.run(scenario())
+            self.assertEqual(queue.pending(), 0)
+            self.assertEqual(issues, [None, ["ticket"], ["ticket"]])
+            self.assertEqual(len(clients), 1)
+            self.assertEqual(clients[0].lookups, 1)
+            queue.close()
+
+    def test_command_registry(self):
+        """Test cakebot.Commands.Registry"""
+
+        from cakebot.Commands import Registry
+
+        sent = []
+
+        class Channel:
+            async def send(self, content=None, **kwargs):
+                sent.append(content)
+
+        class Message:
+            def __init__(self, content, author_id=1):
+                self.content = content
+                self.channel = Channel()
+                self.author = type("Author", (), {"id": author_id})()
+
+        registry = Registry("+", [2])
+
+        @registry.command("cookie", aliases=["cookies"], needs_args=True)
+        async def cookie(ctx):
+            return await ctx.send(ctx.name + ":" + ",".join(ctx.args))
+
+        @registry.command("reboot", admin_only=True)
+        async def reboot(ctx):
+            return await ctx.send("rebooting")
+
+        async def scenario():
+            for content, author_id in [
+                ("+COOKIES bal", 1),
+                ("+cookie", 1),
+                ("+reboot", 1),
+                ("+reboot", 2),
+                ("+unknown", 1),
+                ("cookie bal", 1),
+                ("+", 1),
+            ]:
+                await registry.dispatch(Message(content, author_id))
+
+        asyncio.run(scenario())
+        self.assertIs(
+            registry.commands["cookie"], registry.commands["cookies"]
+        )
+        self.assertEqual(
+            sent,
+            [
+                "cookies:bal",
+                None,  # the "expected an argument" embed
+                ":x: **You are not authorized to run this!**",
+                "rebooting",
+            ],
+        )
+
+    def test_metrics(self):
+        """Test cakebot.Metrics"""
+
+        from aiohttp import ClientSession
+
+        from cakebot import Metrics
+
+        registry = Metrics.MetricsRegistry()
+        seconds = registry.add(
+            Metrics.Histogram("t_seconds", "Test.", ("command",), (0.1, 1))
+        )
+        total = registry.add(Metrics.Counter("t_total", "Test.", ("host",)))
+        seconds.observe(0.05, "iss")
+        seconds.observe(0.1, "iss")
+        seconds.observe(5, "iss")
+        total.inc('a "quoted" host')
+
+        text = registry.render()
+        self.assertIn('t_seconds_bucket{command="iss",le="0.1"} 2', text)
+        self.assertIn('t_seconds_bucket{command="iss",le="+Inf"} 3', text)
+        self.assertIn('t_seconds_count{command="iss"} 3', text)
+        self.assertIn('t_total{host="a \\"quoted\\" host"} 1', text)
+
+        async def scenario():
+            runner = await Metrics.serve("127.0.0.1", 0)
+            port = runner.addresses[0][1]
+            try:
+                async with ClientSession() as session:
+                    async with session.get(
+                        f"http://127.0.0.1:{port}/metrics"
+                    ) as resp:
+                        return await resp.text()
+            finally:
+                await runner.cleanup()
+
+        self.assertIn(
+            "# TYPE cakebot_command_seconds histogram",
+            asyncio.run(scenario()),
+        )
+
+    def test_profiler(self):
+        """Test cakebot.Profiler attributing time to commands."""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.Profiler import Profiler, current_command
+
+        def busy_cake_work():
+            return sum(range(20000))
+
+        async def handle(name):
+            current_command.set(name)
+            busy_cake_work()
+
+        with TemporaryDirectory() as tmp:
+            profiler = Profiler(tmp, max_duration=5)
+            self.assertEqual(profiler.start("cpu", 60), 5)
+            with self.assertRaises(RuntimeError):
+                profiler.start("cpu", 60)
+
+            async def scenario():
+                await asyncio.gather(handle("iss"), handle("define"))
+
+            asyncio.run(scenario())
+            paths = profiler.stop()
+
+            self.assertFalse(profiler.running)
+            self.assertEqual(len(paths), 4)
+            for path in paths:
+                self.assertTrue(os.path.exists(path))
+            self.assertIn("busy_cake_work", profiler.summary(50, "iss"))
+
+    def test_watchdog(self):
+        """Test cakebot.Watchdog blaming the command that blocked."""
+
+        import time
+
+        from cakebot.Commands import Registry
+        from cakebot.Watchdog import Watchdog
+
+        class Channel:
+            async def send(self, content=None, **kwargs):
+                pass
+
+        class Message:
+            id = 1
+            content = "+slow"
+            channel = Channel()
+            author = type("Author", (), {"id": 1})()
+
+        registry = Registry("+", [])
+
+        @registry.command("slow")
+        async def slow(ctx):
+            time.sleep(0.4)
+
+        watchdog = Watchdog(threshold=0.1, interval=0.02)
+
+        async def scenario():
+            heartbeat = asyncio.ensure_future(watchdog.heartbeat())
+            await asyncio.sleep(0.05)
+            await registry.dispatch(Message())
+            heartbeat.cancel()
+
+        asyncio.run(scenario())
+        (command, location), count = watchdog.top(1)[0]
+        self.assertEqual(command, "slow")
+        self.assertIn("in slow", location)
+        self.assertEqual(count, 1)
+
+    def test_rate_limit(self):
+        """Test cakebot.RateLimit"""
+
+        from cakebot import RateLimit
+        from cakebot.Commands import Registry
+
+        limiter = RateLimit.RateLimiter(
+            user={"rate": 1, "burst": 3},
+            guild={"rate": 1, "burst": 4},
+            costs={"iss": 3},
+            notice_interval=10,
+        )
+        limiter.swept = 0
+
+        check = limiter.check
+        self.assertEqual(check(1, 7, "ping", 1, now=0), RateLimit.ALLOW)
+        self.assertEqual(check(1, 7, "iss", 1, now=0), RateLimit.NOTIFY)
+        self.assertEqual(check(1, 7, "iss", 1, now=0.5), RateLimit.DROP)
+        self.assertEqual(check(2, 7, "iss", 1, now=0.5), RateLimit.ALLOW)
+        # user 1 could pay, but the guild is out of tokens now
+        self.assertEqual(check(1, 7, "ping", 1, now=0.5), RateLimit.DROP)
+        self.assertEqual(check(3, 7, "iss", 1, now=1), RateLimit.NOTIFY)
+        # DMs only use the user and global buckets
+        self.assertEqual(check(3, None, "iss", 1, now=1), RateLimit.ALLOW)
+
+        # idle, refilled buckets are thrown away
+        self.assertEqual(len(limiter.users.buckets), 3)
+        check(4, None, "ping", 1, now=100)
+        self.assertEqual(list(limiter.users.buckets), [4])
+        self.assertEqual(len(limiter.guilds.buckets), 0)
+
+        # more than a user's burst only needs their bucket to be full
+        self.assertEqual(check(5, 8, "big", 4, now=100), RateLimit.ALLOW)
+        self.assertEqual(limiter.users.buckets[5].tokens, 0)
+        self.assertEqual(limiter.guilds.buckets[8].tokens, 0)
+        self.assertEqual(check(5, 9, "big", 4, now=101), RateLimit.NOTIFY)
+
+        sent = []
+
+        class Channel:
+            async def send(self, content=None, **kwargs):
+                sent.append(content)
+
+        class Message:
+            content = "+ping"
+            channel = Channel()
+            guild = None
+            author = type("Author", (), {"id": 1})()
+
+        registry = Registry("+", [], RateLimit.RateLimiter())
+
+        @registry.command("ping")
+        async def ping(ctx):
+            return await ctx.send("pong")
+
+        async def scenario():
+            for _ in range(10):
+                await registry.dispatch(Message())
+
+        asyncio.run(scenario())
+        self.assertEqual(sent[:5], ["pong"] * 5)
+        self.assertEqual(len(sent), 6)
+        self.assertIn("Slow down", sent[5])
+
+    def test_outbox(self):
+        """Test cakebot.Outbox"""
+
+        from cakebot import Outbox
+
+        sent = []
+        edits = []
+
+        class Message:
+            def __init__(self, content):
+                self.content = content
+
+            async def edit(self, content=None, **kwargs):
+                edits.append((self.content, kwargs))
+
+        class Channel:
+            broken = False
+
+            async def send(self, content=None, **kwargs):
+                await asyncio.sleep(0)
+                if self.broken and content == "Calculating...":
+                    raise RuntimeError("can't send that")
+                sent.append((content, kwargs))
+                return Message(content)
+
+        channel = Channel()
+        outbox = Outbox.Outbox(max_length=10, placeholder_delay=0.05)
+
+        async def scenario():
+            await asyncio.gather(
+                outbox.send(channel, "done", priority=Outbox.BACKGROUND),
+                outbox.send(channel, "a", origin=1),
+                outbox.send(channel, "b", origin=1),
+                # a reply to another message isn't glued on
+                outbox.send(channel, "d", origin=2),
+                outbox.send(channel, embed="e"),
+                outbox.send(channel, "c", origin=2),
+                outbox.send(channel, "0123456789", origin=2),
+                outbox.send(channel, "f"),
+                outbox.send(channel, "g"),
+            )
+            self.assertEqual(outbox.queues, {})
+
+            # fast enough that the placeholder never goes out
+            placeholder = outbox.placeholder(channel)
+            await outbox.replace(placeholder, embed="fast")
+
+            placeholder = outbox.placeholder(channel)
+            await asyncio.sleep(0.1)
+            await outbox.replace(placeholder, embed="slow")
+
+            # the placeholder failed, so the reply is sent instead
+            channel.broken = True
+            placeholder = outbox.placeholder(channel)
+            await asyncio.sleep(0.1)
+            await outbox.replace(placeholder, embed="retried")
+
+        asyncio.run(scenario())
+        self.assertEqual(
+            sent,
+            [
+                ("a\nb", {}),
+                ("d", {}),
+                (None, {"embed": "e"}),
+                ("c", {}),
+                ("0123456789", {}),
+                ("f", {}),
+                ("g", {}),
+                ("done", {}),
+                (None, {"embed": "fast"}),
+                ("Calculating...", {}),
+                (None, {"embed": "retried"}),
+            ],
+        )
+        self.assertEqual(edits, [("Calculating...", {"embed": "slow"})])
+
+    def test_loadtest_helpers(self):
+        """Test the load test's mix parsing and percentiles."""
+
+        from loadtest import parse_mix, percentile
+
+        self.assertEqual(
+            parse_mix("ping=4, iss=0.5,define"),
+            [("ping", 4.0), ("iss", 0.5), ("define", 1.0)],
+        )
+        with self.assertRaises(ValueError):
+            parse_mix("ping=1,nope=2")
+
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+        self.assertNotEqual(percentile([], 0.5), percentile([], 0.5))
+
+    def test_cluster(self):
+        """Test cakebot.Cluster"""
+
+        import sys
+        import time
+        from tempfile import TemporaryDirectory
+
+        from cakebot import Cluster
+        from cakebot.Database import JournalStore, SqliteStore
+
+        self.assertEqual(
+            Cluster.shard_ranges(10, 3),
+            [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]],
+        )
+        self.assertEqual(Cluster.shard_ranges(2, 4), [[0], [1]])
+
+        with TemporaryDirectory() as tmp:
+            journal_path = os.path.join(tmp, "cakebot.journal")
+            sqlite_path = os.path.join(tmp, "cakebot.db")
+            conf = {"engine": "journal", "path": journal_path}
+
+            journal = JournalStore(journal_path)
+            journal.add_cookie(411505437003743243)
+            journal.close()
+            self.assertTrue(Cluster.copy_journal(conf, sqlite_path))
+            self.assertFalse(Cluster.copy_journal(conf, sqlite_path))
+            self.assertEqual(
+                Cluster.shared_store(conf, sqlite_path),
+                {"engine": "sqlite", "path": sqlite_path},
+            )
+            store = SqliteStore(sqlite_path)
+            self.assertEqual(store.get_count(411505437003743243), 1)
+            store.close()
+
+            board = Cluster.StatusBoard(os.path.join(tmp, "cluster.db"))
+            before = time.time() - 1
+            board.report(1, [4, 5, 6], 0.05, 12)
+            board.report(0, [0, 1, 2, 3], 0.04, 30)
+            self.assertEqual(
+                [row[:4] for row in board.workers()],
+                [(0, "0-3", 0.04, 30), (1, "4-6", 0.05, 12)],
+            )
+            self.assertFalse(board.reboot_requested(before))
+            board.request_reboot()
+            self.assertTrue(board.reboot_requested(before))
+            self.assertFalse(board.reboot_requested(time.time() + 1))
+            board.close()
+
+        supervisor = Cluster.Supervisor(
+            [sys.executable, "-c", "import sys; sys.exit(3)"],
+            4,
+            2,
+            backoff=0,
+        )
+        supervisor.check()
+        first = [process.pid for process in supervisor.processes]
+        for process in supervisor.processes:
+            process.wait()
+        # both crashed, so they're restarted on the next check after that
+        supervisor.check()
+        self.assertEqual(supervisor.processes, [None, None])
+        self.assertEqual(supervisor.failures, [1, 1])
+        supervisor.check()
+        self.assertNotEqual(
+            [process.pid for process in supervisor.processes], first
+        )
+        supervisor.stop()
+
+    def test_leaderboard(self):
+        """Test cakebot.Leaderboard and the stores' leaderboards."""
+
+        from random import Random
+        from tempfile import TemporaryDirectory
+
+        from cakebot.Database import JournalStore, SqliteStore
+        from cakebot.Leaderboard import CountIndex, TopCache
+
+        rng = Random(1)
+        index = CountIndex()
+        counts = {}
+        for _ in range(3000):
+            user = rng.randrange(50)
+            counts[user] = max(
+                0, counts.get(user, 0) + rng.choice([1, 1, 2, -1])
+            )
+            index.set(user, counts[user])
+
+        ranked = sorted(
+            (count for count in counts.values() if count > 0), reverse=True
+        )
+        self.assertGreater(index.size, 64)
+        self.assertEqual([count for _, count in index.top(20)], ranked[:20])
+        for user, count in counts.items():
+            if count == 0:
+                self.assertIsNone(index.rank(user))
+            else:
+                self.assertEqual(
+                    index.rank(user), (ranked.index(count) + 1, count)
+                )
+
+        with TemporaryDirectory() as tmp:
+            journal_path = os.path.join(tmp, "cakebot.journal")
+            sqlite_path = os.path.join(tmp, "cakebot.db")
+            for store in [
+                JournalStore(journal_path),
+                SqliteStore(sqlite_path),
+            ]:
+                for user, guild in [(1, 10), (1, 10), (2, 10), (2, 20)]:
+                    store.add_cookie(user, guild)
+                store.add_cookie(2)
+                store.add_cookie(3)
+
+                self.assertEqual(store.top(2), [(2, 3), (1, 2)])
+                self.assertEqual(store.rank(3), (3, 1))
+                self.assertEqual(store.rank(2, 20), (1, 3))
+                self.assertEqual(store.top(5, 20), [(2, 3)])
+                self.assertIsNone(store.rank(1, 20))
+                self.assertIsNone(store.rank(4))
+                store.close()
+
+            # the journal's guilds survive a restart
+            store = JournalStore(journal_path)
+            self.assertEqual(store.top(5, 10), [(2, 3), (1, 2)])
+            store.close()
+
+            # SQLite's ranks agree with counting, also for a database made
+            # before it kept them
+            store = SqliteStore(os.path.join(tmp, "ranks.db"))
+            counts = {}
+            guilds = {}  # type: dict
+            for _ in range(500):
+                user = rng.randrange(40)
+                guild = rng.choice([None, 10, 20])
+                counts[user] = store.add_cookie(user, guild)
+                if guild is not None:
+                    guilds.setdefault(guild, set()).add(user)
+            for rebuilt in [False, True]:
+                for guild in [None, 10, 20]:
+                    members = counts if guild is None else guilds[guild]
+                    for user in counts:
+                        if user not in members:
+                            self.assertIsNone(store.rank(user, guild))
+                            continue
+                        ahead = sum(
+                            1
+                            for other in members
+                            if counts[other] > counts[user]
+                        )
+                        self.assertEqual(
+                            store.rank(user, guild),
+                            (ahead + 1, counts[user]),
+                        )
+                if not rebuilt:
+                    store.connection.execute("DROP TABLE ranks")
+                    store.connection.execute(
+                        "DELETE FROM meta WHERE key = 'ranks_indexed'"
+                    )
+                store.close()
+                store = SqliteStore(os.path.join(tmp, "ranks.db"))
+            store.close()
+
+        calls = []
+        cache = TopCache(ttl=60)
+        for _ in range(3):
+            cache.get(10, lambda: calls.append(None))
+        self.assertEqual(len(calls), 1)
+
+    def test_startup_timeline(self):
+        """Test cakebot.Startup"""
+
+        import time
+
+        from cakebot.Startup import Timeline
+
+        timeline = Timeline()
+        with timeline.phase("cache warmup"):
+            time.sleep(0.05)
+        time.sleep(0.01)
+        timeline.mark("gateway connect")
+        timeline.add("imports", 0.5)
+
+        names = [name for name, _ in timeline.phases]
+        self.assertEqual(
+            names, ["cache warmup", "gateway connect", "imports"]
+        )
+        self.assertGreaterEqual(timeline.phases[0][1], 0.05)
+        # marking starts where the last phase ended
+        self.assertLess(timeline.phases[1][1], 0.05)
+        self.assertTrue(timeline.has("imports"))
+        self.assertIn("total", timeline.render().splitlines()[-1])
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.Database import JournalStore
+        from cakebot.Startup import copy_stores
+
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cakebot.journal")
+            with open(path, "w") as f:
+                f.write('{"id": 1, "cookie_count": 2}\n{"id": 2, "cook')
+            os.makedirs(os.path.join(tmp, "copies"))
+            copies = copy_stores(
+                [path, os.path.join(tmp, "missing.db")],
+                os.path.join(tmp, "copies"),
+            )
+            store = JournalStore(copies[0])
+            self.assertEqual(store.get_count(1), 2)
+            store.close()
+            # opening the copy repaired it, not the real journal
+            self.assertTrue(open(path).read().endswith("cook"))
+            self.assertFalse(os.path.exists(copies[1]))
+
+    def test_decks(self):
+        """Test cakebot.Decks"""
+
+        from cakebot import Decks, TextCommandsUtil
+
+        pool = Decks.Pool(["cake", "pie", "crème brûlée", ""])
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool[2], "crème brûlée")
+        self.assertEqual(pool[3], "")
+
+        for size in (1, 2, 3, 7, 100):
+            deck = Decks.Deck(size)
+            self.assertEqual(
+                sorted(deck.draw() for _ in range(size)), list(range(size))
+            )
+
+        decks = Decks.Decks(size=2)
+        pool = Decks.Pool([str(i) for i in range(10)])
+        # no repeats until the deck runs out, then a fresh shuffle
+        first = [decks.draw("a", pool) for _ in range(10)]
+        self.assertEqual(sorted(first), sorted(pool[i] for i in range(10)))
+        second = [decks.draw("a", pool) for _ in range(10)]
+        self.assertEqual(sorted(second), sorted(first))
+        # every guild has its own deck, and old ones are forgotten
+        decks.draw("b", pool)
+        decks.draw("c", pool)
+        self.assertEqual(list(decks.decks), ["b", "c"])
+        with self.assertRaises(IndexError):
+            decks.draw("d", Decks.Pool([]))
+
+        items = iter(["x", "y", "x", "z"] + ["y"] * 200)
+        collected = Decks.collect(lambda: next(items))
+        self.assertEqual([collected[i] for i in range(3)], ["x", "y", "z"])
+
+        class Facts:
+            kind = "facts"
+
+            def __init__(self):
+                self.facts = ["cake is good", "pie is fine"]
+
+        self.assertEqual(
+            Decks.find_strings(Facts()), ["cake is good", "pie is fine"]
+        )
+        self.assertIsNone(Decks.find_strings(Decks.Deck(3)))
+
+        jokes = {TextCommandsUtil.common("jokes", 1) for _ in range(5)}
+        self.assertEqual(len(jokes), 5)
+
+    def test_low_memory(self):
+        """Test cakebot.LowMemory"""
+
+        import discord
+
+        from cakebot import LowMemory
+
+        self.assertEqual(LowMemory.client_options(), {})
+        options = LowMemory.client_options(low_memory=True)
+        self.assertFalse(options["intents"].members)
+        self.assertFalse(options["intents"].presences)
+        self.assertTrue(options["intents"].guild_messages)
+        self.assertEqual(options["member_cache_flags"].value, 0)
+        self.assertIsNone(options["max_messages"])
+        self.assertFalse(options["chunk_guilds_at_startup"])
+
+        options = LowMemory.client_options(
+            low_memory=True, max_messages=50, member_cache=["voice"]
+        )
+        self.assertEqual(options["max_messages"], 50)
+        self.assertTrue(options["member_cache_flags"].voice)
+        self.assertTrue(options["intents"].voice_states)
+        self.assertFalse(options["intents"].members)
+        self.assertTrue(
+            LowMemory.client_options(member_cache=["joined"])[
+                "intents"
+            ].members
+        )
+        with self.assertRaises(ValueError):
+            LowMemory.client_options(member_cache=["everyone"])
+        with self.assertRaises(ValueError):
+            LowMemory.client_options(member_cache=["voice", "online"])
+
+        async def client(**kwargs):
+            return discord.AutoShardedClient(
+                **LowMemory.client_options(**kwargs)
+            )
+
+        # discord.py checks the flags have their intents when it's created
+        for kwargs in [
+            {"low_memory": True},
+            {"low_memory": True, "member_cache": ["voice"]},
+            {"member_cache": ["online", "voice", "joined"]},
+        ]:
+            asyncio.run(client(**kwargs))
+        self.assertIsNone(
+            LowMemory.client_options(max_messages=0)["max_messages"]
+        )
+
+        class Guild:
+            owner = None
+            owner_id = 42
+
+            async def fetch_member(self, member_id):
+                return "member " + str(member_id)
+
+        guild = Guild()
+        self.assertEqual(asyncio.run(LowMemory.owner(guild)), "member 42")
+        guild.owner = "cached"
+        self.assertEqual(asyncio.run(LowMemory.owner(guild)), "cached")
+
+    def test_heap_profiler(self):
+        """Test cakebot.HeapProfiler finding what grew."""
+
+        from tempfile import TemporaryDirectory
+
+        from cakebot.HeapProfiler import HeapProfiler
+
+        with TemporaryDirectory() as tmp:
+            profiler = HeapProfiler(tmp, keep=2)
+            with self.assertRaises(RuntimeError):
+                asyncio.run(profiler.snapshot())
+            profiler.start()
+            try:
+                with self.assertRaises(RuntimeError):
+                    profiler.start()
+                asyncio.run(profiler.snapshot())
+                with self.assertRaises(RuntimeError):
+                    asyncio.run(profiler.diff())
+
+                leak = [bytearray(1024) for _ in range(1000)]
+                path = asyncio.run(profiler.snapshot())
+                self.assertTrue(os.path.exists(path))
+                self.assertIn("tests.py", asyncio.run(profiler.summary(3)))
+
+                diff_path, diff = asyncio.run(profiler.diff(3))
+                self.assertTrue(os.path.exists(diff_path))
+                self.assertIn("tests.py", diff.splitlines()[0])
+                self.assertIn("+1.0 MiB", diff.splitlines()[0])
+                with self.assertRaises(ValueError):
+                    asyncio.run(profiler.diff(3, 5))
+                # -1 is the latest snapshot, it can't be compared with itself
+                with self.assertRaises(ValueError):
+                    asyncio.run(profiler.diff(3, -1))
+
+                asyncio.run(profiler.snapshot())
+                self.assertEqual(len(profiler.snapshots), 2)
+                self.assertEqual(len(os.listdir(tmp)), 4)
+            finally:
+                profiler.stop()
+            self.assertFalse(profiler.tracing)
+            del leak
+
+    def test_reload(self):
+        """Test cakebot.Reload swapping in new code."""
+
+        import sys
+        import time
+        from tempfile import TemporaryDirectory
+
+        from cakebot import Reload
+        from cakebot.Content import ContentRegistry
+
+        with TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, "cakes"))
+            open(os.path.join(tmp, "cakes", "__init__.py"), "w").close()
+            path = os.path.join(tmp, "cakes", "flavour.py")
+            with open(path, "w") as f:
+                f.write("def flavour():\n    return 'vanilla'\n")
+            sys.path.insert(0, tmp)
+            try:
+                from cakes import flavour
+
+                to_reload = Reload.modules("cakes", ["flavour"])
+                self.assertEqual(to_reload, [flavour])
+
+                # make sure the new file doesn't look cached
+                time.sleep(0.01)
+                with open(path, "w") as f:
+                    f.write("def flavour():\n    return 'chocolate'\n")
+                os.utime(path, (time.time() + 5, time.time() + 5))
+                Reload.reload_modules(to_reload)
+                self.assertEqual(flavour.flavour(), "chocolate")
+
+                with open(path, "w") as f:
+                    f.write("def flavour(:\n")
+                os.utime(path, (time.time() + 10, time.time() + 10))
+                with self.assertRaises(SyntaxError):
+                    Reload.reload_modules(to_reload)
+                self.assertEqual(flavour.flavour(), "chocolate")
+            finally:
+                sys.path.remove(tmp)
+                sys.modules.pop("cakes.flavour", None)
+                sys.modules.pop("cakes", None)
+
+            with open(os.path.join(tmp, "small.txt"), "w") as f:
+                f.write("a\n")
+            registry = ContentRegistry(tmp, check_interval=3600)
+            registry.load_all()
+            with open(os.path.join(tmp, "small.txt"), "w") as f:
+                f.write("b\n")
+            self.assertEqual(registry.pick("small"), "a\n")
+            registry.reload()
+            self.assertEqual(registry.pick("small"), "b\n")
+
+        self.assertEqual(
+            [module.__name__ for module in Reload.modules()],
+            ["cakebot." + name for name in Reload.MODULES],
+        )
+
+        from cakebot import Handlers
+        from cakebot.Commands import Registry
+
+        class Main:
+            pass
+
+        main = Main()
+        registry = Registry("+", [])
+        registry.command("gone")(None)
+        previous = Handlers.bot
+        try:
+            Handlers.register(registry, main)
+            self.assertNotIn("gone", registry.commands)
+            self.assertIs(
+                registry.commands["cookies"], registry.commands["cookie"]
+            )
+            ping = registry.commands["ping"].handler
+
+            # +reload re-imports the handlers into the same registry
+            Reload.reload_modules([Handlers])
+            self.assertIsNone(Handlers.bot)
+            Handlers.register(registry, main)
+            self.assertIsNot(registry.commands["ping"].handler, ping)
+            self.assertEqual(
+                registry.commands["ping"].handler.__name__, "ping"
+            )
+            self.assertIs(Handlers.bot, main)
+
+            class Config:
+                def load_from_json(self):
+                    raise ValueError("bad config")
+
+            class Ctx:
+                async def send(self, content):
+                    replies.append(content)
+
+            # a failed +reload still leaves the handlers with the bot
+            replies = []
+            main.config = Config()
+            asyncio.run(registry.commands["reload"].handler(Ctx()))
+            self.assertEqual(replies, [":x: **Reload failed: bad config**"])
+            self.assertIs(Handlers.bot, main)
+        finally:
+            Handlers.bot = previous
+
+    def test_sessions(self):
+        """Test cakebot.Sessions resuming against a fake gateway."""
+
+        import json
+        from tempfile import TemporaryDirectory
+
+        import discord
+        from aiohttp import WSMsgType, web
+
+        from cakebot import Sessions
+
+        user = {
+            "id": "580573141898887199",
+            "username": "Cakebot",
+            "discriminator": "0001",
+            "avatar": None,
+            "bot": True,
+        }
+        guild = {
+            "id": "81384788765712384",
+            "name": "Cake Shop",
+            "unavailable": False,
+            "member_count": 2,
+            "roles": [
+                {
+                    "id": "81384788765712384",
+                    "name": "@everyone",
+                    "position": 0,
+                    "permissions": 104324673,
+                    "permissions_new": "104324673",
+                }
+            ],
+            "channels": [
+                {
+                    "id": "81384788765712385",
+                    "type": 0,
+                    "name": "general",
+                    "position": 0,
+                    "permission_overwrites": [],
+                }
+            ],
+        }
+        gateway = {"url": "", "sessions": set(), "ops": [], "guilds": [guild]}
+
+        def json_response(data):
+            # discord.py wants exactly this content type, without a charset
+            return web.Response(
+                body=json.dumps(data).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+
+        async def me(request):
+            return json_response(user)
+
+        async def application(request):
+            return json_response(
+                {
+                    "id": user["id"],
+                    "name": "Cakebot",
+                    "description": "",
+                    "icon": None,
+                    "bot_public": True,
+                    "bot_require_code_grant": False,
+                    "owner": user,
+                    "verify_key": "",
+                    "flags": 0,
+                }
+            )
+
+        async def bot_gateway(request):
+            return json_response(
+                {
+                    "url": gateway["url"],
+                    "shards": 1,
+                    "session_start_limit": {
+                        "total": 1000,
+                        "remaining": 1000,
+                        "reset_after": 0,
+                        "max_concurrency": 1,
+                    },
+                }
+            )
+
+        async def socket(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.send_json({"op": 10, "d": {"heartbeat_interval": 45000}})
+            session = None
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    break
+                payload = message.json()
+                if payload["op"] in (2, 6):
+                    gateway["ops"].append(payload["op"])
+                if payload["op"] == 2:
+                    session = "session-{0}".format(len(gateway["ops"]))
+                    gateway["sessions"].add(session)
+                    await ws.send_json(
+                        {
+                            "op": 0,
+                            "t": "READY",
+                            "s": 1,
+                            "d": {
+                                "v": 7,
+                                "user": user,
+                                "guilds": [
+                                    {"id": data["id"], "unavailable": True}
+                                    for data in gateway["guilds"]
+                                ],
+                                "session_id": session,
+                                "resume_gateway_url": gateway["url"],
+                                "private_channels": [],
+                                "relationships": [],
+                                "shard": [0, 1],
+                                "application": {"id": user["id"], "flags": 0},
+                            },
+                        }
+                    )
+                    # the guilds stream in after READY, like on Discord
+                    for data in gateway["guilds"]:
+                        await ws.send_json(
+                            {"op": 0, "t": "GUILD_CREATE", "s": 2, "d": data}
+                        )
+                elif payload["op"] == 6:
+                    session = payload["d"]["session_id"]
+                    if session in gateway["sessions"]:
+                        await ws.send_json(
+                            {
+                                "op": 0,
+                                "t": "RESUMED",
+                                "s": payload["d"]["seq"] + 1,
+                                "d": {},
+                            }
+                        )
+                    else:
+                        await ws.send_json({"op": 9, "d": False})
+            # like Discord, closing normally ends the session
+            if ws.close_code == 1000:
+                gateway["sessions"].discard(session)
+            return ws
+
+        class FakeMessage:
+            guild = None
+
+            def __init__(self, id):
+                self.id = id
+
+        async def start(sessions, max_age=90, messages=()):
+            client = Sessions.ResumingClient(
+                intents=discord.Intents(guilds=True), guild_ready_timeout=0.1
+            )
+            client.sessions = sessions
+            client.max_age = max_age
+            ready = asyncio.Event()
+
+            async def on_ready():
+                client.was_ready = client.is_ready()
+                ready.set()
+
+            client.on_ready = on_ready
+            task = asyncio.ensure_future(client.start("token"))
+            await asyncio.wait_for(ready.wait(), 10)
+            for id in messages:
+                client.replayed(FakeMessage(id))
+            await client.close()
+            await asyncio.wait_for(task, 10)
+            return client
+
+        async def scenario(sessions):
+            runner, base = await serve(
+                [
+                    ("/api/users/@me", me),
+                    ("/api/oauth2/applications/@me", application),
+                    ("/api/gateway/bot", bot_gateway),
+                    ("/api/gateway", bot_gateway),
+                    ("/gateway", socket),
+                ]
+            )
+            gateway["url"] = base.replace("http", "ws") + "/gateway"
+            old = discord.http.Route.BASE
+            discord.http.Route.BASE = base + "/api"
+            try:
+                client = await start(sessions, messages=[100, 101])
+                self.assertEqual(gateway["ops"], [2])
+                self.assertEqual(len(sessions.load(0, 60)[4]), 1)
+                # nothing changed since, so nothing needs saving again
+                self.assertEqual(client.snapshot()[1:], ([], [], []))
+                self.assertEqual(client.ready_times.times[0][1], "identify")
+
+                # a graceful shutdown saved the session, so this resumes
+                client = await start(sessions)
+                self.assertEqual(gateway["ops"], [2, 6])
+                self.assertEqual(client.ready_times.times[0][1], "resume")
+                self.assertTrue(client.was_ready)
+                self.assertEqual(client.user.id, int(user["id"]))
+                self.assertIn("shard 0 ready", client.ready_times.render())
+                # only the messages answered before the restart are skipped
+                self.assertTrue(client.replayed(FakeMessage(101)))
+                self.assertFalse(client.replayed(FakeMessage(102)))
+
+                # Discord forgot the session, so it falls back to identify,
+                # and the bot left its guild while it was down
+                gateway["sessions"].clear()
+                gateway["guilds"] = []
+                client = await start(sessions)
+                self.assertEqual(gateway["ops"], [2, 6, 6, 2])
+                self.assertEqual(
+                    client.ready_times.times[0][1], "identify (resume failed)"
+                )
+                self.assertEqual(client.guilds, [])
+
+                # too old to bother trying, and a shard without guilds
+                # still gets its time to ready
+                client = await start(sessions, max_age=0)
+                self.assertEqual(gateway["ops"], [2, 6, 6, 2, 2])
+                self.assertEqual(client.ready_times.times[0][1], "identify")
+            finally:
+                discord.http.Route.BASE = old
+                await runner.cleanup()
+
+        with TemporaryDirectory() as tmp:
+            sessions = Sessions.SessionStore(os.path.join(tmp, "sessions.db"))
+            sessions.save(
+                [(3, "abc", 5, 42, user)],
+                [(3, {"id": 7}), (3, {"id": 8})],
+                replace=[3],
+            )
+            self.assertEqual(
+                sessions.load(3, 60),
+                ("abc", 5, 42, user, [{"id": 7}, {"id": 8}]),
+            )
+            # later saves only touch the guilds that changed
+            sessions.save(
+                [(3, "abc", 9, 43, user)], [(3, {"id": 7, "name": "x"})], [8]
+            )
+            self.assertEqual(
+                sessions.load(3, 60),
+                ("abc", 9, 43, user, [{"id": 7, "name": "x"}]),
+            )
+            self.assertIsNone(sessions.load(3, -1))
+            sessions.forget(3)
+            self.assertIsNone(sessions.load(3, 60))
+
+            asyncio.run(scenario(sessions))
+            sessions.close()
+
 
 if __name__ == "__main__":
     unittest.main()